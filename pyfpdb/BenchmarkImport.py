@@ -0,0 +1,295 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program; if not, write to the Free Software
+#    Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
+########################################################################
+
+"""Import throughput benchmark.
+
+Replays the hand histories of regression-test-files through the stages of an
+import and reports hands/sec per stage as JSON:
+
+    parse          converting the files into Hand objects
+    derive         DerivedStats of each hand (Hand.assembleHand)
+    store          Hands, HandsPlayers, HandsActions incl. id lookups and commits
+    hudcache       Database.storeHudCache
+    sessionscache  Database.storeSessionsCache
+
+By default the hands are written to an in-memory SQLite database, so nothing on
+disk is touched. With --configured-db they go to the database selected in the
+config file, or the one named with --database, whose tables are recreated first.
+To compare backends, run once per database of the config file and give the JSON
+of one run as the baseline of the next:
+
+    BenchmarkImport.py -k -D fpdb_sqlite -o sqlite.json
+    BenchmarkImport.py -k -D fpdb_pg -b sqlite.json
+
+The progress the import prints goes to stderr, stdout only gets the JSON.
+
+The corpus can be repeated to scale it up, the hand numbers of each repetition
+are shifted so its hands are stored again instead of being skipped as duplicates.
+A result saved earlier can be given as baseline, the exit status is 1 if any
+stage got slower than the baseline by more than the tolerance."""
+
+import L10n
+_ = L10n.get_translation()
+
+import sys
+import os
+import datetime
+from time import time
+from optparse import OptionParser
+try:
+    import json
+except ImportError:
+    import simplejson as json
+try:
+    import resource
+except ImportError:     # not on Windows
+    resource = None
+
+import Configuration
+import Options
+import fpdb_import
+
+# regression-test-files directory -> site name of its converter
+SITE_DIRS = {'Absolute':     'Absolute',
+             'Betfair':      'Betfair',
+             'Carbon':       'Carbon',
+             'Everest':      'Everest',
+             'Everleaf':     'Everleaf',
+             'FTP':          'Full Tilt Poker',
+             'OnGame':       'OnGame',
+             'ongame':       'OnGame',
+             'PacificPoker': 'PacificPoker',
+             'PartyPoker':   'PartyPoker',
+             'Stars':        'PokerStars',
+             'UltimateBet':  'Absolute',
+             'Win2day':      'Win2day',
+             'Winamax':      'Winamax',
+             'iPoker':       'iPoker'}
+
+STAGES = ('parse', 'derive', 'store', 'hudcache', 'sessionscache')
+REPEAT_OFFSET = 10**13      # added to siteHandNo for each repetition of the corpus
+
+
+class StageTimer:
+    """Seconds spent in each stage"""
+
+    def __init__(self):
+        self.seconds = dict.fromkeys(STAGES, 0.0)
+
+    def add(self, stage, seconds):
+        self.seconds[stage] += seconds
+
+    def wrap(self, obj, name, stage):
+        """Count the time spent in obj.name() to stage"""
+        method = getattr(obj, name)
+        def timed(*args, **kwargs):
+            start = time()
+            try:
+                return method(*args, **kwargs)
+            finally:
+                self.add(stage, time() - start)
+        setattr(obj, name, timed)
+
+
+def find_files(dir, sitename=None):
+    """Returns [(path, site)] of the hand history files below dir"""
+    files = []
+    for game in ('cash', 'tour'):
+        for subdir in sorted(os.listdir(os.path.join(dir, game))):
+            site = SITE_DIRS.get(subdir)
+            if site is None or (sitename and site != sitename):
+                continue
+            for (path, dirs, names) in os.walk(os.path.join(dir, game, subdir)):
+                dirs.sort()
+                files += [(os.path.join(path, name), site) for name in sorted(names) if name.endswith('.txt')]
+    return files
+
+def use_memory_db(config):
+    """Select an in-memory SQLite database in config"""
+    db = config.supported_databases[config.db_selected]
+    db.db_server = 'sqlite'
+    db.db_name = ':memory:'
+    config.supported_databases[':memory:'] = db
+    config.db_selected = ':memory:'
+
+def peak_rss():
+    """Peak resident set size of the process in kB, None if unknown"""
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        rss /= 1024         # bytes on OS X
+    return rss
+
+def rate(hands, seconds):
+    return round(hands / seconds, 1) if seconds > 0 else None
+
+def run(config, files, repeat, batchsize):
+    """Import files repeat times, returns the result dict"""
+    settings = {}
+    settings.update(config.get_db_parameters())
+    settings.update(config.get_import_parameters())
+    settings.update(config.get_default_paths())
+    importer = fpdb_import.Importer(False, settings, config)
+    importer.setCallHud(False)
+    importer.setFailOnError(False)
+    importer.settings['handBatchSize'] = batchsize
+    db = importer.database
+    if db.database != ':memory:':
+        db.recreate_tables()
+
+    timer = StageTimer()
+    timer.wrap(db, 'storeHudCache', 'hudcache')
+    timer.wrap(db, 'storeSessionsCache', 'sessionscache')
+    (hands, errors, duplicates) = (0, 0, 0)
+    start = time()
+    for rep in xrange(repeat):
+        for (path, site) in files:
+            filter = config.hhcs[site].converter
+            fileId = importer.addFileToList(path, site, filter)[2]
+            t0 = time()
+            hhc = fpdb_import.getConverter(config, path, site, filter, 0, importer.settings)
+            if hhc is None or not hhc.getStatus():
+                errors += 1
+                continue
+            parsed = list(hhc.iterProcessedHands())
+            t1 = time()
+            for hand in parsed:
+                hand.assembleHand()
+                if rep:
+                    try:
+                        hand.hands['siteHandNo'] = long(hand.hands['siteHandNo']) + rep * REPEAT_OFFSET
+                    except ValueError:
+                        pass
+            t2 = time()
+            for handlist in importer.handBatches(parsed):
+                duplicates += importer.importHandBatch(handlist, fileId, assembled = True)
+            t3 = time()
+            timer.add('parse', t1 - t0)
+            timer.add('derive', t2 - t1)
+            timer.add('store', t3 - t2)
+            hands += len(parsed)
+            errors += hhc.numErrors
+    total = time() - start
+    # the caches are updated from within the store stage
+    timer.seconds['store'] -= timer.seconds['hudcache'] + timer.seconds['sessionscache']
+    importer.closeDBs()
+
+    result = {'date':       datetime.datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S"),
+              'python':     sys.version.split()[0],
+              'db_server':  config.supported_databases[config.db_selected].db_server,
+              'database':   db.database,
+              'files':      len(files),
+              'repeat':     repeat,
+              'batchsize':  batchsize,
+              'hands':      hands,
+              'stored':     hands - duplicates,
+              'duplicates': duplicates,
+              'errors':     errors,
+              'seconds':    round(total, 3),
+              'hands_per_sec': rate(hands, total),
+              'peak_rss_kb': peak_rss(),
+              'stages':     {}}
+    for stage in STAGES:
+        result['stages'][stage] = {'seconds': round(timer.seconds[stage], 3)
+                                  ,'hands_per_sec': rate(hands, timer.seconds[stage])}
+    return result
+
+def compare(result, baseline, tolerance):
+    """Add the ratio to the baseline of the total and each stage to result, returns
+       the names of those slower than the baseline by more than tolerance"""
+    pairs = [('total', result, baseline)]
+    for stage in STAGES:
+        pairs.append((stage, result['stages'][stage], baseline.get('stages', {}).get(stage, {})))
+    slower = []
+    result['baseline'] = {}
+    for (name, current, base) in pairs:
+        if not current.get('hands_per_sec') or not base.get('hands_per_sec'):
+            continue
+        ratio = current['hands_per_sec'] / base['hands_per_sec']
+        result['baseline'][name] = {'hands_per_sec': base['hands_per_sec'], 'ratio': round(ratio, 3)}
+        if ratio < 1.0 - tolerance:
+            slower.append(name)
+        print >>sys.stderr, "%-14s %10.1f %10.1f hands/sec  %+6.1f%%" % (name, base['hands_per_sec']
+                                                                        ,current['hands_per_sec'], (ratio - 1.0) * 100)
+    return slower
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv[1:]
+
+    parser = OptionParser(usage="%prog [options]", description=__doc__.split("\n")[0])
+    parser.add_option("-c", "--configFile", dest="config", default="HUD_config.test.xml",
+                      help="config file to read the sites and database from")
+    parser.add_option("-d", "--dir", dest="dir", default="regression-test-files",
+                      help="directory of the hand histories")
+    parser.add_option("-s", "--sitename", dest="sitename", default=None,
+                      help="only files of this site")
+    parser.add_option("-n", "--repeat", dest="repeat", type="int", default=1,
+                      help="import the files this many times")
+    parser.add_option("-B", "--batchsize", dest="batchsize", type="int", default=1000,
+                      help="hands stored per batch")
+    parser.add_option("-k", "--configured-db", dest="configured", action="store_true", default=False,
+                      help="use the database of the config file instead of in-memory SQLite (its tables are recreated)")
+    parser.add_option("-D", "--database", dest="database", default=None,
+                      help="with -k, the name of the database of the config file to use instead of the selected one")
+    parser.add_option("-o", "--output", dest="output", default=None,
+                      help="write the JSON result to this file instead of stdout")
+    parser.add_option("-b", "--baseline", dest="baseline", default=None,
+                      help="compare with the JSON result of an earlier run")
+    parser.add_option("-t", "--tolerance", dest="tolerance", type="float", default=0.1,
+                      help="fraction a stage may be slower than the baseline, default 0.1")
+    (options, args) = parser.parse_args(argv)
+
+    sitename = None
+    if options.sitename:
+        sitename = Options.site_alias(options.sitename)
+        if sitename == False:
+            parser.error("unknown site %s" % options.sitename)
+
+    # the config and the import print their progress, keep stdout for the result
+    stdout = sys.stdout
+    sys.stdout = sys.stderr
+    try:
+        config = Configuration.Config(file = options.config, dbname = options.database or '')
+        if options.database and options.database not in config.supported_databases:
+            parser.error("no database %s in %s" % (options.database, options.config))
+        if not options.configured:
+            use_memory_db(config)
+        files = [(path, site) for (path, site) in find_files(options.dir, sitename) if site in config.hhcs]
+        if not files:
+            parser.error("no hand histories found in %s" % options.dir)
+
+        result = run(config, files, options.repeat, options.batchsize)
+    finally:
+        sys.stdout = stdout
+    slower = []
+    if options.baseline:
+        slower = compare(result, json.load(open(options.baseline)), options.tolerance)
+        if slower:
+            print >>sys.stderr, "slower than baseline:", ", ".join(slower)
+
+    out = json.dumps(result, indent=2, sort_keys=True)
+    if options.output:
+        open(options.output, 'w').write(out + "\n")
+    else:
+        print out
+    return 1 if slower else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -666,14 +666,14 @@ class RawHands:
             if save in ("none", "error", "all"):
                 self.save=save
             else:
-                print (_("Invalid config value for %s, defaulting to %s") % (raw_hands.save, "\"error\""))
+                print (_("Invalid config value for %s, defaulting to %s") % ("raw_hands.save", "\"error\""))
                 self.save="error"
             
             compression=node.getAttribute("compression")
-            if save in ("none", "gzip", "bzip2"):
+            if compression in ("none", "gzip", "bzip2", "lzma"):
                 self.compression=compression
             else:
-                print (_("Invalid config value for %s, defaulting to %s") % (raw_hands.compression, "\"none\""))
+                print (_("Invalid config value for %s, defaulting to %s") % ("raw_hands.compression", "\"none\""))
                 self.compression="none"
     #end def __init__
 
@@ -692,14 +692,14 @@ class RawTourneys:
             if save in ("none", "error", "all"):
                 self.save=save
             else:
-                print (_("Invalid config value for %s, defaulting to %s") % (raw_tourneys.save, "\"error\""))
+                print (_("Invalid config value for %s, defaulting to %s") % ("raw_tourneys.save", "\"error\""))
                 self.save="error"
             
             compression=node.getAttribute("compression")
-            if save in ("none", "gzip", "bzip2"):
+            if compression in ("none", "gzip", "bzip2", "lzma"):
                 self.compression=compression
             else:
-                print (_("Invalid config value for %s, defaulting to %s") % (raw_tourneys.compression, "\"none\""))
+                print (_("Invalid config value for %s, defaulting to %s") % ("raw_tourneys.compression", "\"none\""))
                 self.compression="none"
     #end def __init__
 
@@ -44,6 +44,16 @@ import re
 import Queue
 import codecs
 import math
+import operator
+import hashlib
+import zlib
+import bz2
+import threading
+from array import array
+from bisect import bisect_left
+from cStringIO import StringIO
+from collections import OrderedDict
+from heapq import merge
 
 import logging
 # logging has been set up in fpdb.py or HUD_main.py, use their settings:
@@ -58,6 +68,8 @@ import Configuration
 
 
 #    Other library modules
+from sqlite3 import sqlite_version_info
+
 try:
     import sqlalchemy.pool as pool
     use_pool = True
@@ -65,6 +77,15 @@ except ImportError:
     log.info(_("Not using sqlalchemy connection pool."))
     use_pool = False
 
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        log.info(_("Not using lzma to compress raw hands."))
+        lzma = None
+
 try:
     from numpy import var
     use_numpy = True
@@ -73,7 +94,22 @@ except ImportError:
     use_numpy = False
 
 
-DB_VERSION = 157
+DB_VERSION = 166
+
+# connections of all Database instances in the process come from one pool per driver:
+# at most POOL_SIZE are kept open, POOL_MAX_OVERFLOW more are opened when needed and a
+# connect beyond that waits POOL_TIMEOUT seconds for one to be returned
+POOL_SIZE = 5
+POOL_MAX_OVERFLOW = 10
+POOL_TIMEOUT = 30
+SQLITE_STATEMENT_CACHE = 250    # prepared statements kept per sqlite connection (sqlite3 default 100)
+
+# compressors of the raw hand archive by the name stored with each block
+RAW_CODECS = {'none':  (lambda b: b, str),
+              'gzip':  (lambda b: zlib.compress(b, 9), zlib.decompress),
+              'bzip2': (lambda b: bz2.compress(b, 9), bz2.decompress)}
+if lzma is not None:
+    RAW_CODECS['lzma'] = (lzma.compress, lzma.decompress)
 
 
 # Variance created as sqlite has a bunch of undefined aggregate functions.
@@ -93,12 +129,79 @@ class sqlitemath:
         return a%b
 
 
+def copy_text(rows):
+    """Return rows as a file in postgres COPY text format"""
+    out = StringIO()
+    for row in rows:
+        fields = []
+        for v in row:
+            if v is None:
+                fields.append('\\N')
+            elif v is True or v is False:
+                fields.append('t' if v else 'f')
+            else:
+                if isinstance(v, unicode):
+                    v = v.encode('utf-8')
+                elif isinstance(v, float):
+                    v = repr(v)
+                elif not isinstance(v, str):
+                    v = str(v)
+                fields.append(v.replace('\\', '\\\\').replace('\t', '\\t')
+                               .replace('\n', '\\n').replace('\r', '\\r'))
+        out.write('\t'.join(fields) + '\n')
+    out.seek(0)
+    return out
+
+
+def cluster_intervals(intervals, gap):
+    """Sort (start, end, item) intervals and join those less than gap apart.
+       Returns a list of [start, end, items] in start order."""
+    clusters = []
+    for (start, end, item) in sorted(intervals, key=lambda i: (i[0], i[1])):
+        if clusters and start <= clusters[-1][1] + gap:
+            cl = clusters[-1]
+            if end > cl[1]:
+                cl[1] = end
+            cl[2].append(item)
+        else:
+            clusters.append([start, end, [item]])
+    return clusters
+
+
+def import_datetime(value):
+    """Hands.importTime as read from the db, sqlite returns it as a string"""
+    if not isinstance(value, basestring):
+        return value
+    if len(value) > 19:
+        return datetime.strptime(value[:26], "%Y-%m-%d %H:%M:%S.%f")
+    return datetime.strptime(value, "%Y-%m-%d %H:%M:%S")
+
+
 class Database:
 
     MYSQL_INNODB = 2
     PGSQL = 3
     SQLITE = 4
 
+    COPY_ROWS = 200     # batches this large are loaded with COPY on postgres
+    PLAYER_CACHE_SIZE = 100000      # player ids kept in memory, least recently used are dropped
+    TOURNEY_CACHE_SIZE = 10000      # tourney ids kept in memory
+    TOURNEYSPLAYERS_CACHE_SIZE = 100000 # tourneysPlayers ids kept in memory
+    HAND_ID_BLOCK = 1000    # Hands ids reserved at a time by each connection
+    SQLITE_BULK_CACHE = 262144      # page cache in KiB during a sqlite bulk import
+    SQLITE_BULK_MMAP = 1073741824   # bytes of the db file memory mapped during a sqlite bulk import
+    HUDCACHE_REBUILD_DAYS = 30      # days of hands rebuilt and committed at a time by rebuild_hudcache
+    RAW_BLOCK_SIZE = 262144         # bytes of hand text compressed together in the raw hand archive
+    RAW_BLOCK_CACHE = 8             # uncompressed raw hand blocks kept in memory
+    AFTER_IMPORT_CONNECTIONS = 4    # connections recreating indexes and foreign keys after a bulk import
+    INDEX_BUILD_RATE = 200000.0     # rows per second assumed for an index not yet built in this db
+    MIN_RATE_HANDS = 1000           # hands a bulk import stores before its speed is recorded in ImportRates
+
+    sqls = {}           # shared SQL.Sql instance by db_server, for instances created without one
+
+    # HudCache position of each HandsPlayers position
+    hudCachePositions = {'B':'B', 'S':'S', 0:'D', 1:'C', 2:'M', 3:'M', 4:'M', 5:'E', 6:'E', 7:'E', 8:'E', 9:'E' }
+
     hero_hudstart_def = '1999-12-31'      # default for length of Hero's stats in HUD
     villain_hudstart_def = '1999-12-31'   # default for length of Villain's stats in HUD
 
@@ -120,11 +223,13 @@ class Database:
                 #  {'tab':'Players',         'col':'name',              'drop':0}  unique indexes not dropped
                 #  {'tab':'Hands',           'col':'siteHandNo',        'drop':0}  unique indexes not dropped
                 #, {'tab':'Tourneys',        'col':'siteTourneyNo',     'drop':0}  unique indexes not dropped
+                  {'tab':'Hands',           'col':'importTime',        'drop':0}
                 ]
               , [ # indexes for postgres (list index 3)
                   {'tab':'Gametypes',       'col':'siteId',            'drop':0}
                 , {'tab':'Hands',           'col':'gametypeId',        'drop':0} # mct 22/3/09
                 , {'tab':'Hands',           'col':'fileId',            'drop':0} # mct 22/3/09
+                , {'tab':'Hands',           'col':'importTime',        'drop':0}
                 #, {'tab':'Hands',           'col':'siteHandNo',        'drop':0}  unique indexes not dropped
                 , {'tab':'HandsActions',    'col':'handId',            'drop':1}
                 , {'tab':'HandsActions',    'col':'playerId',          'drop':1}
@@ -149,17 +254,20 @@ class Database:
                 , {'tab':'Backings',        'col':'tourneysPlayersId',  'drop':0}
                 , {'tab':'Backings',        'col':'playerId',          'drop':0}
                 , {'tab':'RawHands',        'col':'id',                'drop':0}
+                , {'tab':'RawHands',        'col':'handId',            'drop':0}
+                , {'tab':'RawHands',        'col':'blockId',           'drop':0}
                 , {'tab':'RawTourneys',        'col':'id',                'drop':0}
                 ]
               , [ # indexes for sqlite (list index 4)
                   {'tab':'Hands',           'col':'gametypeId',        'drop':0}
                 , {'tab':'Hands',           'col':'fileId',            'drop':0}
-                , {'tab':'Boards',          'col':'handId',            'drop':0}
-                , {'tab':'HandsPlayers',    'col':'handId',            'drop':0}
-                , {'tab':'HandsPlayers',    'col':'playerId',          'drop':0}
+                , {'tab':'Hands',           'col':'importTime',        'drop':0}
+                , {'tab':'Boards',          'col':'handId',            'drop':1}
+                , {'tab':'HandsPlayers',    'col':'handId',            'drop':1}
+                , {'tab':'HandsPlayers',    'col':'playerId',          'drop':1}
                 , {'tab':'HandsPlayers',    'col':'tourneysPlayersId', 'drop':0}
-                , {'tab':'HandsActions',    'col':'handId',            'drop':0}
-                , {'tab':'HandsActions',    'col':'playerId',          'drop':0}
+                , {'tab':'HandsActions',    'col':'handId',            'drop':1}
+                , {'tab':'HandsActions',    'col':'playerId',          'drop':1}
                 , {'tab':'HandsActions',    'col':'actionId',          'drop':1}
                 , {'tab':'HudCache',        'col':'gametypeId',        'drop':1}
                 , {'tab':'HudCache',        'col':'playerId',          'drop':0}
@@ -174,6 +282,7 @@ class Database:
                 , {'tab':'Backings',        'col':'tourneysPlayersId',  'drop':0}
                 , {'tab':'Backings',        'col':'playerId',          'drop':0}
                 , {'tab':'RawHands',        'col':'id',                'drop':0}
+                , {'tab':'RawHands',        'col':'handId',            'drop':0}
                 , {'tab':'RawTourneys',     'col':'id',                'drop':0}
                 ]
               ]
@@ -282,17 +391,24 @@ class Database:
         gen = c.get_general_params()
         self.day_start = 0
         self._has_lock = False
+        self.dupIndex = None                # DuplicateIndex of the hands in the db, loaded on first use
+        self.bulkMode = None                # sqlite settings to restore while a bulk import runs
+        self.handIds = (0, 0, False)        # next and end of the reserved Hands ids, reserved in the open transaction
+        self.resetCaches()
         
         if 'day_start' in gen:
             self.day_start = float(gen['day_start'])
             
         self.sessionTimeout = float(self.import_options['sessionTimeout'])
 
-        # where possible avoid creating new SQL instance by using the global one passed in
+        # where possible avoid creating new SQL instance by using the global one passed in,
+        # otherwise share one per db_server: the queries are built and translated to the
+        # backend's placeholder once per process
         if sql is None:
-            self.sql = SQL.Sql(db_server = self.db_server)
-        else:
-            self.sql = sql
+            sql = Database.sqls.get(self.db_server)
+            if sql is None:
+                sql = Database.sqls.setdefault(self.db_server, SQL.Sql(db_server = self.db_server))
+        self.sql = sql
 
         if autoconnect:
             # connect to db
@@ -311,6 +427,7 @@ class Database:
                 self.wrongDbVersion = False
 
             self.pcache      = None     # PlayerId cache
+            self.pcacheSites = set()    # sites whose players were loaded into pcache
             self.cachemiss   = 0        # Delete me later - using to count player cache misses
             self.cachehit    = 0        # Delete me later - using to count player cache hits
 
@@ -389,6 +506,11 @@ class Database:
         self.database = db_params['db-databaseName']
         self.host = db_params['db-host']
 
+    def pooled(self, module, pool_size=POOL_SIZE):
+        """Returns module with connect() drawing from the process wide pool of its
+           connections, closing a connection hands it back to the pool"""
+        return pool.manage(module, pool_size=pool_size, max_overflow=POOL_MAX_OVERFLOW, timeout=POOL_TIMEOUT)
+
     def connect(self, backend=None, host=None, database=None,
                 user=None, password=None, create=False):
         """Connects a database with the given parameters"""
@@ -405,7 +527,7 @@ class Database:
         if backend == Database.MYSQL_INNODB:
             import MySQLdb
             if use_pool:
-                MySQLdb = pool.manage(MySQLdb, pool_size=5)
+                MySQLdb = self.pooled(MySQLdb)
             try:
                 self.connection = MySQLdb.connect(host=host
                                                  ,user=user
@@ -426,7 +548,7 @@ class Database:
             import psycopg2
             import psycopg2.extensions
             if use_pool:
-                psycopg2 = pool.manage(psycopg2, pool_size=5)
+                psycopg2 = self.pooled(psycopg2)
             psycopg2.extensions.register_type(psycopg2.extensions.UNICODE)
             # If DB connection is made over TCP, then the variables
             # host, user and password are required
@@ -464,7 +586,7 @@ class Database:
             create = True
             import sqlite3
             if use_pool:
-                sqlite3 = pool.manage(sqlite3, pool_size=1)
+                sqlite3 = self.pooled(sqlite3, pool_size=1)
             #else:
             #    log.warning("SQLite won't work well without 'sqlalchemy' installed.")
 
@@ -477,7 +599,11 @@ class Database:
             self.db_path = database
             log.info(_("Connecting to SQLite: %s") % self.db_path)
             if os.path.exists(database) or create:
-                self.connection = sqlite3.connect(self.db_path, detect_types=sqlite3.PARSE_DECLTYPES )
+                # the importer's writer threads use connections opened in the main thread,
+                # each connection is only used by one thread at a time
+                self.connection = sqlite3.connect(self.db_path, detect_types=sqlite3.PARSE_DECLTYPES
+                                                 ,check_same_thread=False
+                                                 ,cached_statements=SQLITE_STATEMENT_CACHE )
                 self.__connected = True
                 sqlite3.register_converter("bool", lambda x: bool(int(x)))
                 sqlite3.register_adapter(bool, lambda x: 1 if x else 0)
@@ -538,6 +664,8 @@ class Database:
     def commit(self):
         if self.backend != self.SQLITE:
             self.connection.commit()
+        elif self.bulkMode is not None:
+            pass        # a sqlite bulk import is one transaction, committed by afterBulkImport
         else:
             # sqlite commits can fail because of shared locks on the database (SQLITE_BUSY)
             # re-try commit if it fails in case this happened
@@ -556,9 +684,25 @@ class Database:
             if not ok:
                 log.debug(_("commit failed"))
                 raise FpdbError('sqlite commit failed')
+        self.cacheNew = []
+        self.handIds = self.handIds[:2] + (False,)
+        if self.dupIndex is not None:
+            self.dupIndex.commit()
 
     def rollback(self):
         self.connection.rollback()
+        if self.handIds[2]:
+            self.handIds = (0, 0, False)    # the reservation was rolled back too
+        for (cache, key) in self.cacheNew:
+            cache.pop(key, None)
+        self.cacheNew = []
+        if self.bulkMode is not None:
+            # everything since prepareBulkImport is gone, not only what was added since commit()
+            self.resetPlayerIDs()
+            self.resetCaches()
+            self.resetDuplicateIndex()
+        elif self.dupIndex is not None:
+            self.dupIndex.rollback()
 
     def connected(self):
         """ now deprecated, use is_connected() instead """
@@ -624,6 +768,24 @@ class Database:
             l.append(tab_no)
             return l
 
+    def get_tables_info(self, hand_ids):
+        """get_table_info() of several hands in one query, as a dict by hand id"""
+        c = self.get_cursor()
+        q = self.sql.query['get_tables_name'].replace('<hand_ids>', ", ".join([self.sql.query['placeholder']] * len(hand_ids)))
+        c.execute(q, [int(id) for id in hand_ids])
+        tables = {}
+        for row in c.fetchall():
+            l = list(row[1:])
+            if row[4] == "ring":   # cash game
+                l.append(None)
+                l.append(None)
+            else:    # tournament
+                tour_no, tab_no = re.split(" ", row[1])
+                l.append(tour_no)
+                l.append(tab_no)
+            tables[row[0]] = l
+        return tables
+
     def get_last_hand(self):
         c = self.connection.cursor()
         c.execute(self.sql.query['get_last_hand'])
@@ -740,17 +902,22 @@ class Database:
             if row and row[0]:
                 self.hand_1day_ago = int(row[0])
                 
+        self.date_ndays_ago = self.hud_date_key(hud_days)
+        self.h_date_ndays_ago = self.hud_date_key(h_hud_days)
+
+    def hudCacheDayOffset(self):
+        """Hours from midnight UTC to the start of a hudcache day: the day_start hour in
+           local time"""
         tz = datetime.utcnow() - datetime.today()
-        tz_offset = tz.seconds/3600
-        tz_day_start_offset = self.day_start + tz_offset
-        
-        d = timedelta(days=hud_days, hours=tz_day_start_offset)
-        now = datetime.utcnow() - d
-        self.date_ndays_ago = "d%02d%02d%02d" % (now.year - 2000, now.month, now.day)
-        
-        d = timedelta(days=h_hud_days, hours=tz_day_start_offset)
+        # whole hours, utcnow() is read a moment before today()
+        tz_offset = int(round((tz.days * 86400 + tz.seconds) / 3600.0)) % 24
+        return self.day_start + tz_offset
+
+    def hud_date_key(self, days):
+        """HudCache styleKey of the day n days ago"""
+        d = timedelta(days=days, hours=self.hudCacheDayOffset())
         now = datetime.utcnow() - d
-        self.h_date_ndays_ago = "d%02d%02d%02d" % (now.year - 2000, now.month, now.day)
+        return "d%02d%02d%02d" % (now.year - 2000, now.month, now.day)
 
     def init_player_hud_stat_vars(self, playerid):
         # not sure if this is workable, to be continued ...
@@ -779,7 +946,15 @@ class Database:
                                           }
                            , hero_id = -1
                            , num_seats = 6
+                           , cache = None       # HudStatCache of the caller
                            ):
+        return self.get_stats_from_hands([(hand, type, hud_params, hero_id, num_seats)], cache)[hand]
+
+    def get_stats_params(self, hud_params, num_seats):
+        """The (styleKey, agg_bb_mult, seats_min, seats_max, wanted) of the aggregated
+           stats query for the hero (key True) and the other players (key False).
+           The styleKey of hud_style 'T' is from hud_params['hud_days'] if it is set,
+           otherwise from the last init_hud_stat_vars()"""
         hud_style   = hud_params['hud_style']
         agg_bb_mult = hud_params['agg_bb_mult']
         seats_style = hud_params['seats_style']
@@ -789,8 +964,6 @@ class Database:
         h_seats_style = hud_params['h_seats_style']
         h_seats_cust_nums = hud_params['h_seats_cust_nums']
 
-        stat_dict = {}
-
         if seats_style == 'A':
             seats_min, seats_max = 0, 10
         elif seats_style == 'C':
@@ -814,16 +987,11 @@ class Database:
                  % (seats_style, seats_min, seats_max
                    ,h_seats_style, h_seats_min, h_seats_max) )
 
-        if hud_style == 'S' or h_hud_style == 'S':
-            self.get_stats_from_hand_session(hand, stat_dict, hero_id
-                                            ,hud_style, seats_min, seats_max
-                                            ,h_hud_style, h_seats_min, h_seats_max)
-
-            if hud_style == 'S' and h_hud_style == 'S':
-                return stat_dict
-
         if hud_style == 'T':
-            stylekey = self.date_ndays_ago
+            if 'hud_days' in hud_params:
+                stylekey = self.hud_date_key(hud_params['hud_days'])
+            else:
+                stylekey = self.date_ndays_ago
         elif hud_style == 'A':
             stylekey = '0000000'  # all stylekey values should be higher than this
         elif hud_style == 'S':
@@ -836,7 +1004,10 @@ class Database:
         #    stylekey = date_nhands_ago  needs array by player here ...
 
         if h_hud_style == 'T':
-            h_stylekey = self.h_date_ndays_ago
+            if 'h_hud_days' in hud_params:
+                h_stylekey = self.hud_date_key(hud_params['h_hud_days'])
+            else:
+                h_stylekey = self.h_date_ndays_ago
         elif h_hud_style == 'A':
             h_stylekey = '0000000'  # all stylekey values should be higher than this
         elif h_hud_style == 'S':
@@ -848,29 +1019,175 @@ class Database:
         #elif h_hud_style == 'H':
         #    h_stylekey = date_nhands_ago  needs array by player here ...
 
-        query = 'get_stats_from_hand_aggregated'
-        subs = (hand
-               ,hero_id, stylekey, agg_bb_mult, agg_bb_mult, seats_min, seats_max  # hero params
-               ,hero_id, h_stylekey, h_agg_bb_mult, h_agg_bb_mult, h_seats_min, h_seats_max)    # villain params
+        return {True:  (h_stylekey, h_agg_bb_mult, h_seats_min, h_seats_max, h_hud_style != 'S'),
+                False: (stylekey, agg_bb_mult, seats_min, seats_max, hud_style != 'S')}
+
+    def get_stats_from_hands(self, hands, cache = None, cache_only = ()):
+        """get_stats_from_hand() of several hands, e.g. the latest hand of each table after
+           an import tick. hands is a list of (hand, type, hud_params, hero_id, num_seats),
+           returns {hand: stat_dict}. The hands with the same query parameters are read
+           in one query, with a cache only the hands of players not cached are read.
+           The stats of the hands in cache_only are just added to the cache."""
+        stats = {}
+        groups = {}     # query parameters -> hands
+        if cache is not None:
+            deltas = self.get_stats_deltas([h[0] for h in hands] + list(cache_only))
+            for (hand, rows) in deltas.iteritems():
+                cache.add(self, hand, rows)
+        for (hand, type, hud_params, hero_id, num_seats) in hands:
+            params = self.get_stats_params(hud_params, num_seats)
+            stat_dict = stats[hand] = {}
+            (h_wanted, wanted) = (params[True][4], params[False][4])
+            if not h_wanted or not wanted:
+                self.get_stats_from_hand_session(hand, stat_dict, hero_id
+                                                ,hud_params['hud_style'], params[False][2], params[False][3]
+                                                ,hud_params['h_hud_style'], params[True][2], params[True][3])
+                if not h_wanted and not wanted:
+                    continue
+            if cache is not None:
+                cached = cache.get(hand, deltas[hand], hero_id, params)
+                if cached is not None:
+                    stat_dict.update(cached)
+                    continue
+            groups.setdefault((hero_id, params[False], params[True]), []).append(hand)
+        if not groups:
+            return stats
 
-        #print "get stats: hud style =", hud_style, "query =", query, "subs =", subs
         c = self.connection.cursor()
-
-#       now get the stats
-        c.execute(self.sql.query[query], subs)
-        #for row in c.fetchall():   # needs "explain query plan" in sql statement
-        #    print "query plan: ", row
-        colnames = [desc[0] for desc in c.description]
+        if cache is not None:
+            # the stats read include every hand committed so far, not just those up to this one.
+            # Hands.importTime is set before the importer commits, so a hand committed while they
+            # are read may have an older importTime than the clock here. Which of the recent hands
+            # they include is read in the same snapshot instead
+            (loaded, included) = self.begin_stats_snapshot(c)
+        try:
+            self.get_stats_groups(c, groups, stats)
+        finally:
+            if cache is not None:
+                self.end_stats_snapshot(c)
+        if cache is not None:
+            for ((hero_id, params, h_params), group) in groups.iteritems():
+                for hand in group:
+                    cache.store(loaded, deltas[hand], hero_id, {True: h_params, False: params}, stats[hand], included)
+        return stats
+
+    def begin_stats_snapshot(self, c):
+        """Start a transaction that reads one snapshot of the db and return (loaded, included),
+           the hands imported from loaded on that are committed in it. Any hand imported since is
+           either in included or in no stats read before end_stats_snapshot()."""
+        self.connection.commit()    # a new snapshot for mysql's repeatable read
+        if self.backend == self.PGSQL:
+            self.connection.set_isolation_level(2)  # serializable, one snapshot for the transaction
+        elif self.backend == self.SQLITE:
+            # sqlite3 starts no transaction for a select and commits before the queries that
+            # start with a comment, it leaves them alone in autocommit mode
+            self.connection.isolation_level = None
+            c.execute("BEGIN")
+        c.execute(self.sql.query['get_last_import_time'])
+        last = import_datetime(c.fetchone()[0])
+        if last is None:
+            return (datetime.min, frozenset())
+        # hands committed later are imported after this, give or take the clocks of the
+        # importers and how long they keep a transaction open
+        loaded = last - timedelta(seconds=HudStatCache.COMMIT_WINDOW)
+        c.execute(self.sql.query['get_hands_imported_since'].replace('%s', self.sql.query['placeholder'])
+                 ,(loaded,))
+        return (loaded, frozenset([row[0] for row in c.fetchall()]))
+
+    def end_stats_snapshot(self, c):
+        if self.backend == self.SQLITE:
+            c.execute("COMMIT")
+            self.connection.isolation_level = ""
+        else:
+            self.connection.commit()
+        if self.backend == self.PGSQL:
+            self.connection.set_isolation_level(1)  # go back to normal isolation level
+
+    def get_stats_groups(self, c, groups, stats):
+        """The aggregated stats of get_stats_from_hands(), one query for each group of hands"""
+        for ((hero_id, params, h_params), group) in groups.iteritems():
+            (stylekey, agg_bb_mult, seats_min, seats_max, wanted) = params
+            (h_stylekey, h_agg_bb_mult, h_seats_min, h_seats_max, h_wanted) = h_params
+            query = self.sql.query['get_stats_from_hands_aggregated']
+            query = query.replace('<hand_ids>', ", ".join([self.sql.query['placeholder']] * len(group)))
+            subs = (tuple(group)
+                   +(hero_id, stylekey, agg_bb_mult, agg_bb_mult, seats_min, seats_max  # hero params
+                    ,hero_id, h_stylekey, h_agg_bb_mult, h_agg_bb_mult, h_seats_min, h_seats_max))    # villain params
+
+            #print "get stats: hud style =", hud_style, "query =", query, "subs =", subs
+#           now get the stats
+            c.execute(query, subs)
+            #for row in c.fetchall():   # needs "explain query plan" in sql statement
+            #    print "query plan: ", row
+            # sqlite has no description when a query starting with a comment returns no rows
+            colnames = [desc[0] for desc in c.description or ()]
+            for row in c.fetchall():
+                playerid = row[1]
+                if (playerid == hero_id and h_wanted) or (playerid != hero_id and wanted):
+                    t_dict = {}
+                    for name, val in zip(colnames[1:], row[1:]):
+                        t_dict[name.lower()] = val
+#                        print t_dict
+                    stats[row[0]][t_dict['player_id']] = t_dict
+
+    def get_stats_deltas(self, hands):
+        """The stats of each player in hands with the columns of get_stats_from_hand_aggregated,
+           as {hand: {playerId: (info, stats)}}. info has the seat, screen_name, gametype_id,
+           seats, import_time and HudCache stylekey of the hand. bigblind is summed over HudCache rows by
+           the aggregated query, so it only counts if the hand created the player's row. That
+           is missed if more hands went into the row before this one is read, until the
+           cache reloads the player."""
+        deltas = dict([(hand, {}) for hand in hands])
+        if not hands:
+            return deltas
+        query = self.sql.query['get_stats_from_hand_delta']
+        if self.db_server == 'mysql':
+            query = query.replace("<signed>", 'signed ')
+        else:
+            query = query.replace("<signed>", '')
+        query = query.replace('<hand_ids>', ", ".join([self.sql.query['placeholder']] * len(hands)))
+        c = self.get_cursor()
+        c.execute(query, list(hands))
+        colnames = [desc[0].lower() for desc in c.description]
+        styleKeys = set()
         for row in c.fetchall():
-            playerid = row[0]
-            if (playerid == hero_id and h_hud_style != 'S') or (playerid != hero_id and hud_style != 'S'):
-                t_dict = {}
-                for name, val in zip(colnames, row):
-                    t_dict[name.lower()] = val
-#                    print t_dict
-                stat_dict[t_dict['player_id']] = t_dict
-
-        return stat_dict
+            stats = dict(zip(colnames, row))
+            info = {}
+            for name in ('seat', 'screen_name', 'gametype_id', 'seats', 'start_time', 'import_time', 'position', 'tourney_type_id'):
+                info[name] = stats.pop(name)
+            start = info.pop('start_time')
+            if isinstance(start, basestring):   # sqlite
+                start = datetime.strptime(start[:19], "%Y-%m-%d %H:%M:%S")
+            info['import_time'] = import_datetime(info['import_time'])
+            info['stylekey'] = self.hudCacheStyleKey(start)
+            styleKeys.add(info['stylekey'])
+            deltas[stats.pop('hand_id')][stats.pop('player_id')] = (info, stats)
+
+        players = set()
+        for rows in deltas.itervalues():
+            players.update(rows.keys())
+        if not players:
+            return deltas
+        query = self.sql.query['get_hudcache_new_rows']
+        query = query.replace('<player_ids>', ", ".join([self.sql.query['placeholder']] * len(players)))
+        query = query.replace('<style_keys>', ", ".join([self.sql.query['placeholder']] * len(styleKeys)))
+        c.execute(query, list(styleKeys) + list(players))
+        new = set(c.fetchall())
+        for rows in deltas.itervalues():
+            for (pid, (info, stats)) in rows.iteritems():
+                position = info['position']
+                if isinstance(position, basestring) and position.isdigit():
+                    position = int(position)
+                if (pid, info['gametype_id'], info['seats'], info['stylekey'], self.hudCachePositions.get(position)
+                   ,info['tourney_type_id']) not in new:
+                    stats['bigblind'] = 0
+        return deltas
+
+    def get_similar_gametypes(self, gametypeId, agg_bb_mult):
+        """ids of the gametypes get_stats_from_hand_aggregated sums with gametypeId"""
+        c = self.get_cursor()
+        c.execute(self.sql.query['get_similar_gametypes'], (agg_bb_mult, agg_bb_mult, gametypeId))
+        return frozenset([row[0] for row in c.fetchall()])
 
     # uses query on handsplayers instead of hudcache to get stats on just this session
     def get_stats_from_hand_session(self, hand, stat_dict, hero_id
@@ -960,24 +1277,98 @@ class Database:
 
     def resetPlayerIDs(self):
         self.pcache = None
+        self.pcacheSites = set()
+
+    def resetCaches(self):
+        """Empty the id caches of Gametypes, TourneyTypes, Tourneys and TourneysPlayers.
+           Entries added since the last commit are also dropped by rollback()."""
+        self.gtcache = {}       # Gametypes id by the game's natural key
+        self.ttcache = {}       # TourneyTypes id by the tourney's details
+        self.tcache = LRUCache(self.TOURNEY_CACHE_SIZE)  # (tourneyTypeId, tourneyId) by (siteId, tourNo)
+        self.tpcache = LRUCache(self.TOURNEYSPLAYERS_CACHE_SIZE)   # TourneysPlayers id by (tourneyId, playerId)
+        self.rawcache = LRUCache(self.RAW_BLOCK_CACHE)  # uncompressed RawHandBlocks by id
+        self.cacheNew = []      # (cache, key) of entries added since the last commit
+        self.cachestats = {'Gametypes':[0, 0], 'TourneyTypes':[0, 0], 'Tourneys':[0, 0], 'TourneysPlayers':[0, 0]}
+
+    def cacheAdd(self, cache, key, value):
+        cache[key] = value
+        self.cacheNew.append((cache, key))
+
+    def getCacheStats(self):
+        """Return a dict of cache name to (hits, misses)"""
+        stats = dict([(k, tuple(v)) for (k, v) in self.cachestats.iteritems()])
+        stats['Players'] = (getattr(self, 'cachehit', 0), getattr(self, 'cachemiss', 0))
+        return stats
 
     def getSqlPlayerIDs(self, pnames, siteid):
+        """Return a dict of player name to id for pnames on siteid. The cache is filled
+           with the site's players on first use, players not in it are fetched and new
+           ones inserted together by insertPlayers."""
         result = {}
-        if(self.pcache == None):
-            self.pcache = LambdaDict(lambda  key:self.insertPlayer(key[0], key[1]))
+        if self.pcache is None:
+            self.pcache = LRUCache(self.PLAYER_CACHE_SIZE)
+        if siteid not in self.pcacheSites:
+            self.pcacheSites.add(siteid)
+            self.loadPlayerIDs(siteid)
 
+        missing = []
         for player in pnames:
-            result[player] = self.pcache[(player,siteid)]
-            # NOTE: Using the LambdaDict does the same thing as:
-            #if player in self.pcache:
-            #    #print "DEBUG: cachehit"
-            #    pass
-            #else:
-            #    self.pcache[player] = self.insertPlayer(player, siteid)
-            #result[player] = self.pcache[player]
-
+            id = self.pcache.get((player, siteid))
+            if id is None:
+                missing.append(player)
+            else:
+                result[player] = id
+        self.cachehit += len(result)
+        if missing:
+            self.cachemiss += len(missing)
+            ids = self.insertPlayers(missing, siteid)
+            for player in missing:
+                self.cacheAdd(self.pcache, (player, siteid), ids[player])
+                result[player] = ids[player]
         return result
 
+    def loadPlayerIDs(self, site_id):
+        """Put the most recently added players of site_id in the player cache"""
+        c = self.get_cursor()
+        c.execute(self.sql.query['get_site_player_ids'], (site_id, self.PLAYER_CACHE_SIZE))
+        for (name, id) in reversed(c.fetchall()):
+            self.pcache[(name, site_id)] = id
+
+    def fetchPlayerIDs(self, names, site_id):
+        """Return a dict of name to id for those of names that are in Players"""
+        byname, bylower = {}, {}
+        c = self.get_cursor()
+        for i in xrange(0, len(names), 500):
+            part = [Charset.to_db_utf8(n) for n in names[i:i+500]]
+            q = self.sql.query['get_player_ids'].replace('<names>', ", ".join([self.sql.query['placeholder']] * len(part)))
+            c.execute(q, [site_id] + part)
+            for (name, id) in c.fetchall():
+                byname[name] = id
+                bylower[name.lower()] = id
+        ids = {}
+        for n in names:
+            key = n if isinstance(n, unicode) else Charset.to_db_utf8(n).decode('utf-8')
+            if key in byname:
+                ids[n] = byname[key]
+            elif self.backend == self.MYSQL_INNODB and key.lower() in bylower:
+                ids[n] = bylower[key.lower()]   # mysql compares names case insensitively
+        return ids
+
+    def insertPlayers(self, names, site_id):
+        """Return a dict of name to id for names on site_id, inserting the players
+           that are not in the db yet with one executemany"""
+        ids = self.fetchPlayerIDs(names, site_id)
+        new = [n for n in names if n not in ids]
+        if new:
+            c = self.get_cursor()
+            c.executemany("INSERT INTO Players (name, siteId) VALUES (%s, %s)".replace('%s',self.sql.query['placeholder'])
+                         ,[(Charset.to_db_utf8(n), site_id) for n in new])
+            ids.update(self.fetchPlayerIDs(new, site_id))
+            for n in new:
+                if n not in ids:
+                    ids[n] = self.insertPlayer(n, site_id)
+        return ids
+
     def insertPlayer(self, name, site_id):
         result = None
         _name = Charset.to_db_utf8(name)
@@ -1135,89 +1526,231 @@ class Database:
                     except:
                         print _("Warning:"), _("index %s_%s_idx not dropped: %s, continuing ...") \
                               % (idx['tab'],idx['col'], str(sys.exc_value).rstrip('\n'))
+                elif self.backend == self.SQLITE:
+                    print _("Dropping index:"), idx['tab'], idx['col']
+                    try:
+                        c.execute( "drop index if exists %s_%s_idx" % (idx['tab'],idx['col']) )
+                    except:
+                        print _("Warning:"), _("index %s_%s_idx not dropped: %s, continuing ...") \
+                              % (idx['tab'],idx['col'], str(sys.exc_value).rstrip('\n'))
                 else:
                     return -1
 
         if self.backend == self.PGSQL:
             self.connection.set_isolation_level(1)   # go back to normal isolation level
         self.commit() # seems to clear up errors if there were any in postgres
+        if self.backend == self.SQLITE:
+            # big page cache and memory mapped reads, commit() leaves everything to afterBulkImport
+            c.execute("PRAGMA cache_size")
+            cache = c.fetchone()[0]
+            c.execute("PRAGMA mmap_size")
+            mmap = c.fetchone()     # None before sqlite 3.7.17
+            c.execute("PRAGMA cache_size=-%d" % self.SQLITE_BULK_CACHE)
+            if mmap is not None:
+                c.execute("PRAGMA mmap_size=%d" % self.SQLITE_BULK_MMAP)
+            self.bulkMode = (cache, mmap)
         ptime = time() - stime
         print (_("prepare import took %s seconds") % ptime)
     #end def prepareBulkImport
 
-    def afterBulkImport(self):
-        """Re-create any dropped indexes/foreign keys after bulk import"""
-        stime = time()
+    def afterBulkImportTasks(self):
+        """List the indexes/foreign keys prepareBulkImport drops, as dicts with the
+           statement to create each, the tables it locks and its estimated cost.
+           The list is sorted by cost, biggest tables first."""
+        tasks = []
+        for fk in self.foreignKeys[self.backend]:
+            if fk['drop'] == 1 and self.backend == self.PGSQL:
+                tasks.append({'tab': fk['fktab'], 'col': fk['fkcol'], 'tables': set([fk['fktab'], fk['rtab']])
+                             ,'desc': _("Creating foreign key:") + " %s %s -> %s %s" % (fk['fktab'], fk['fkcol'], fk['rtab'], fk['rcol'])
+                             ,'fail': _("Create foreign key failed:")
+                             ,'sql': ["alter table " + fk['fktab'] + " add constraint "
+                                      + fk['fktab'] + '_' + fk['fkcol'] + '_fkey'
+                                      + " foreign key (" + fk['fkcol']
+                                      + ") references " + fk['rtab'] + "(" + fk['rcol'] + ")"]})
+        for idx in self.indexes[self.backend]:
+            if idx['drop'] == 1:
+                if self.backend == self.PGSQL:
+                    # concurrently leaves the table writable, only one such build runs per table.
+                    # A failed one leaves an invalid index behind, so drop that and build it normally
+                    sql = ["create index concurrently %s_%s_idx on %s(%s)" % (idx['tab'], idx['col'], idx['tab'], idx['col'])
+                          ,"drop index if exists %s_%s_idx" % (idx['tab'], idx['col'])
+                          ,"create index %s_%s_idx on %s(%s)" % (idx['tab'], idx['col'], idx['tab'], idx['col'])]
+                elif self.backend == self.SQLITE:
+                    sql = ["create index if not exists %s_%s_idx on %s(%s)" % (idx['tab'], idx['col'], idx['tab'], idx['col'])]
+                else:
+                    continue
+                tasks.append({'tab': idx['tab'], 'col': idx['col'], 'tables': set([idx['tab']]), 'sql': sql
+                             ,'desc': _("Creating index %s %s") % (idx['tab'], idx['col'])
+                             ,'fail': _("Create index failed:")})
 
         c = self.get_cursor()
+        rows = {}
+        rates = self.getImportRates()
+        for task in tasks:
+            if task['tab'] not in rows:
+                # ids are close enough to a row count and come straight from the primary key
+                c.execute("SELECT max(id) FROM %s" % task['tab'])
+                rows[task['tab']] = c.fetchone()[0] or 0
+            task['rows'] = rows[task['tab']]
+            task['cost'] = task['rows'] / rates.get("%s.%s" % (task['tab'], task['col']), self.INDEX_BUILD_RATE)
+        tasks.sort(key=lambda t: t['cost'], reverse=True)
+        return tasks
+
+    def estimateAfterBulkImport(self, hands=None, tasks=None):
+        """Estimate the seconds afterBulkImport takes to recreate the indexes/foreign keys,
+           from the rates measured so far. Given a number of hands, the tables are scaled
+           from their current size to a db holding that many hands. None on mysql, where
+           afterBulkImport doesn't build them."""
         if self.backend == self.MYSQL_INNODB:
+            return None
+        if tasks is None:
+            tasks = self.afterBulkImportTasks()
+        if hands is not None:
+            c = self.get_cursor()
+            c.execute("SELECT max(id) FROM Hands")
+            inDB = c.fetchone()[0] or 0
+            if not inDB:
+                return 0.0
+            scale = float(hands) / inDB
+        else:
+            scale = 1.0
+        # each task goes to the least busy connection, as afterBulkImport hands them out
+        if self.backend == self.PGSQL:
+            connections = [0.0] * self.AFTER_IMPORT_CONNECTIONS
+        else:
+            connections = [0.0]
+        for task in tasks:
+            connections[connections.index(min(connections))] += task['cost'] * scale
+        return max(connections)
+
+    def estimateIndexUpkeep(self, hands):
+        """Estimate the seconds keeping the indexes/foreign keys up to date adds to storing
+           this many hands, from the speed of the bulk imports run with and without them.
+           None until both have been measured."""
+        rates = self.getImportRates()
+        if 'import' not in rates or 'import.bulk' not in rates:
+            return None
+        return hands / rates['import'] - hands / rates['import.bulk']
+
+    def getImportRates(self):
+        """Dict of the speeds in ImportRates by name"""
+        c = self.get_cursor()
+        c.execute(self.sql.query['getImportRates'])
+        return dict(c.fetchall())
+
+    def setImportRate(self, name, rate):
+        """Record a speed in ImportRates, replacing the last one measured"""
+        c = self.get_cursor()
+        c.execute(self.sql.query['deleteImportRate'].replace('%s', self.sql.query['placeholder']), (name,))
+        c.execute(self.sql.query['insertImportRate'].replace('%s', self.sql.query['placeholder']), (name, rate))
+
+    def afterBulkImport(self, dry_run=False):
+        """Re-create any dropped indexes/foreign keys after bulk import
+
+           On postgres they are built in parallel on a pool of connections, biggest
+           tables first, using create index concurrently. With dry_run the work is
+           only listed along with its estimated time, which is returned."""
+        stime = time()
+
+        if self.backend == self.MYSQL_INNODB:
+            if dry_run:
+                return 0.0
+            c = self.get_cursor()
             c.execute("SET foreign_key_checks=1")
             c.execute("SET autocommit=1")
             return
 
-        if self.backend == self.PGSQL:
-            self.connection.set_isolation_level(0)   # allow table/index operations to work
-        for fk in self.foreignKeys[self.backend]:
-            if fk['drop'] == 1:
-                if self.backend == self.MYSQL_INNODB:
-                    c.execute("SELECT constraint_name " +
-                              "FROM information_schema.KEY_COLUMN_USAGE " +
-                              #"WHERE REFERENCED_TABLE_SCHEMA = 'fpdb'
-                              "WHERE 1=1 " +
-                              "AND table_name = %s AND column_name = %s " +
-                              "AND referenced_table_name = %s " +
-                              "AND referenced_column_name = %s ",
-                              (fk['fktab'], fk['fkcol'], fk['rtab'], fk['rcol']) )
-                    cons = c.fetchone()
-                    #print "afterbulk: cons=", cons
-                    if cons:
-                        pass
-                    else:
-                        print _("Creating foreign key:"), fk['fktab'], fk['fkcol'], "->", fk['rtab'], fk['rcol']
-                        try:
-                            c.execute("alter table " + fk['fktab'] + " add foreign key ("
-                                      + fk['fkcol'] + ") references " + fk['rtab'] + "("
-                                      + fk['rcol'] + ")")
-                        except:
-                            print _("Create foreign key failed:"), str(sys.exc_info())
-                elif self.backend == self.PGSQL:
-                    print _("Creating foreign key:"), fk['fktab'], fk['fkcol'], "->", fk['rtab'], fk['rcol']
-                    try:
-                        c.execute("alter table " + fk['fktab'] + " add constraint "
-                                  + fk['fktab'] + '_' + fk['fkcol'] + '_fkey'
-                                  + " foreign key (" + fk['fkcol']
-                                  + ") references " + fk['rtab'] + "(" + fk['rcol'] + ")")
-                    except:
-                        print _("Create foreign key failed:"), str(sys.exc_info())
-                else:
-                    return -1
+        tasks = self.afterBulkImportTasks()
+        if dry_run:
+            for task in tasks:
+                print "%s (%d rows, %.1f seconds)" % (task['desc'], task['rows'], task['cost'])
+            estimate = self.estimateAfterBulkImport(tasks=tasks)
+            print _("After import estimated to take %.1f seconds") % estimate
+            return estimate
 
-        for idx in self.indexes[self.backend]:
-            if idx['drop'] == 1:
-                if self.backend == self.MYSQL_INNODB:
-                    print _("Creating index %s %s") % (idx['tab'], idx['col'])
-                    try:
-                        s = "alter table %s add index %s(%s)" % (idx['tab'],idx['col'],idx['col'])
-                        c.execute(s)
-                    except:
-                        print _("Create foreign key failed:"), str(sys.exc_info())
-                elif self.backend == self.PGSQL:
-    #                pass
-                    # mod to use tab_col for index name?
-                    print _("Creating index %s %s") % (idx['tab'], idx['col'])
-                    try:
-                        s = "create index %s_%s_idx on %s(%s)" % (idx['tab'], idx['col'], idx['tab'], idx['col'])
-                        c.execute(s)
-                    except:
-                        print _("Create index failed:"), str(sys.exc_info())
-                else:
-                    return -1
+        if self.backend == self.SQLITE and self.bulkMode is not None:
+            c = self.get_cursor()
+            (cache, mmap) = self.bulkMode
+            self.bulkMode = None
+            self.commit()
+            c.execute("PRAGMA cache_size=%d" % cache)
+            if mmap is not None:
+                c.execute("PRAGMA mmap_size=%d" % mmap[0])
 
+        rates = {}
         if self.backend == self.PGSQL:
-            self.connection.set_isolation_level(1)   # go back to normal isolation level
+            # concurrent builds wait for every open transaction on their table, including ours
+            self.commit()
+            cond = threading.Condition()
+            busy = set()
+            workers = []
+            for i in xrange(min(self.AFTER_IMPORT_CONNECTIONS, len(tasks))):
+                db = Database(self.config, sql = self.sql)
+                workers.append(threading.Thread(target=self.afterBulkImportWorker, args=(db, tasks, busy, cond, rates)))
+                workers[-1].start()
+            for w in workers:
+                w.join()
+        else:
+            self.afterBulkImportWorker(self, tasks, set(), threading.Condition(), rates)
+
         self.commit()   # seems to clear up errors if there were any in postgres
+        for (name, rate) in rates.iteritems():
+            self.setImportRate(name, rate)
+        self.commit()
         atime = time() - stime
         print (_("After import took %s seconds") % atime)
+
+    def afterBulkImportWorker(self, db, tasks, busy, cond, rates):
+        """Run afterBulkImport tasks on db until none are left, skipping those
+           whose tables another connection is working on. The rows per second of
+           each build are put in rates."""
+        if db.backend == self.PGSQL:
+            db.connection.set_isolation_level(0)   # allow table/index operations to work
+        c = db.get_cursor()
+        while True:
+            cond.acquire()
+            try:
+                while True:
+                    free = [t for t in tasks if not (t['tables'] & busy)]
+                    if free or not tasks:
+                        break
+                    cond.wait()
+                if not tasks:
+                    break
+                task = free[0]
+                tasks.remove(task)
+                busy.update(task['tables'])
+            finally:
+                cond.release()
+
+            print task['desc']
+            tstart = time()
+            try:
+                c.execute(task['sql'][0])
+            except:
+                if db.backend == self.PGSQL and len(task['sql']) > 1:
+                    print _("Warning:"), _("%s failed: %s, retrying without concurrently ...") \
+                          % (task['desc'], str(sys.exc_value).rstrip('\n'))
+                    try:
+                        for sql in task['sql'][1:]:
+                            c.execute(sql)
+                    except:
+                        print task['fail'], str(sys.exc_info())
+                else:
+                    print task['fail'], str(sys.exc_info())
+            elapsed = time() - tstart
+            if elapsed > 0 and task['rows']:
+                rates["%s.%s" % (task['tab'], task['col'])] = task['rows'] / elapsed
+
+            cond.acquire()
+            busy.difference_update(task['tables'])
+            cond.notifyAll()
+            cond.release()
+
+        if db.backend == self.PGSQL:
+            db.connection.set_isolation_level(1)   # go back to normal isolation level
+        if db is not self:
+            db.disconnect()
     #end def afterBulkImport
 
     def drop_referential_integrity(self):
@@ -1246,6 +1779,8 @@ class Database:
 
         self.drop_tables()
         self.resetPlayerIDs()
+        self.resetCaches()
+        self.resetDuplicateIndex()
         self.create_tables()
         self.createAllIndexes()
         self.commit()
@@ -1266,9 +1801,12 @@ class Database:
             c.execute(self.sql.query['createSitesTable'])
             c.execute(self.sql.query['createGametypesTable'])
             c.execute(self.sql.query['createFilesTable'])
+            c.execute(self.sql.query['createImportRatesTable'])
             c.execute(self.sql.query['createPlayersTable'])
             c.execute(self.sql.query['createAutoratesTable'])
             c.execute(self.sql.query['createHandsTable'])
+            if self.backend == self.PGSQL:
+                c.execute("ALTER SEQUENCE hands_id_seq INCREMENT BY %d" % self.HAND_ID_BLOCK)
             c.execute(self.sql.query['createBoardsTable'])
             c.execute(self.sql.query['createTourneyTypesTable'])
             c.execute(self.sql.query['createTourneysTable'])
@@ -1278,6 +1816,7 @@ class Database:
             c.execute(self.sql.query['createHudCacheTable'])
             c.execute(self.sql.query['createSessionsCacheTable'])
             c.execute(self.sql.query['createBackingsTable'])
+            c.execute(self.sql.query['createRawHandBlocks'])
             c.execute(self.sql.query['createRawHands'])
             c.execute(self.sql.query['createRawTourneys'])
             
@@ -1294,6 +1833,8 @@ class Database:
             c.execute(self.sql.query['addPlayersIndex'])
             c.execute(self.sql.query['addTPlayersIndex'])
             c.execute(self.sql.query['addTTypesIndex'])
+            if self.backend != self.SQLITE or sqlite_version_info >= (3, 9, 0):
+                c.execute(self.sql.query['addHudCacheIndex'])
 
             self.fillDefaultData()
             self.commit()
@@ -1542,7 +2083,7 @@ class Database:
 
     def fillDefaultData(self):
         c = self.get_cursor()
-        c.execute("INSERT INTO Settings (version) VALUES (%s);" % (DB_VERSION))
+        c.execute("INSERT INTO Settings (version, nextHandId) VALUES (%s, 1);" % (DB_VERSION))
         #Fill Sites
         c.execute("INSERT INTO Sites (id,name,code) VALUES ('1', 'Full Tilt Poker', 'FT')")
         c.execute("INSERT INTO Sites (id,name,code) VALUES ('2', 'PokerStars', 'PS')")
@@ -1585,8 +2126,18 @@ class Database:
         self.createAllForeignKeys()
     #end def rebuild_indexes
 
-    def rebuild_hudcache(self, h_start=None, v_start=None):
-        """clears hudcache and rebuilds from the individual handsplayers records"""
+    def rebuild_hudcache(self, h_start=None, v_start=None, start=None, end=None, gametypes=None, resume=False):
+        """rebuilds hudcache from the individual handsplayers records
+
+           The hands are processed HUDCACHE_REBUILD_DAYS days at a time. Each chunk
+           replaces the hudcache rows of its days and is committed along with a
+           checkpoint in Settings, so the HUD keeps working meanwhile. With resume
+           an interrupted rebuild carries on from its checkpoint, with the hud start
+           dates and slice it was started with.
+           By default the whole cache is cleared and rebuilt. Given start and/or end
+           dates ('YYYY-MM-DD', end exclusive) or a list of gametype ids, only that
+           slice of the cache is rebuilt, e.g. the days dropped or added by a
+           change of the hud start dates."""
 
         try:
             stime = time()
@@ -1605,10 +2156,17 @@ class Database:
                     if p_id:
                         self.hero_ids[site_id] = int(p_id)
 
+            checkpoint = None
+            if resume:
+                checkpoint = self.get_hudcache_resume()
+                if checkpoint:
+                    (h_start, v_start, start, end, gametypes) = checkpoint[1]
             if h_start is None:
                 h_start = self.hero_hudstart_def
             if v_start is None:
                 v_start = self.villain_hudstart_def
+            slice = ";".join([h_start, v_start, str(start or '')[:10], str(end or '')[:10]
+                             ,",".join([str(int(g)) for g in gametypes or []])])
 
             if self.hero_ids == {}:
                 where = "WHERE hp.tourneysPlayersId IS NULL"
@@ -1618,14 +2176,13 @@ class Database:
                         + "   or (    hp.playerId in " + str(tuple(self.hero_ids.values())) \
                         + "       and h.startTime > '" + h_start + "'))" \
                         + "   AND hp.tourneysPlayersId IS NULL)"
+            where += " <range_clause>"
             rebuild_sql_cash = self.sql.query['rebuildHudCache'].replace('<tourney_insert_clause>', "")
             rebuild_sql_cash = rebuild_sql_cash.replace('<tourney_select_clause>', "")
             rebuild_sql_cash = rebuild_sql_cash.replace('<tourney_join_clause>', "")
             rebuild_sql_cash = rebuild_sql_cash.replace('<tourney_group_clause>', "")
             rebuild_sql_cash = rebuild_sql_cash.replace('<where_clause>', where)
             #print "rebuild_sql_cash:",rebuild_sql_cash
-            self.get_cursor().execute(self.sql.query['clearHudCache'])
-            self.get_cursor().execute(rebuild_sql_cash)
 
             if self.hero_ids == {}:
                 where = "WHERE hp.tourneysPlayersId >= 0"
@@ -1635,6 +2192,7 @@ class Database:
                         + "   or (    hp.playerId in " + str(tuple(self.hero_ids.values())) \
                         + "       and h.startTime > '" + h_start + "'))" \
                         + "   AND hp.tourneysPlayersId >= 0)"
+            where += " <range_clause>"
             rebuild_sql_tourney = self.sql.query['rebuildHudCache'].replace('<tourney_insert_clause>', ",tourneyTypeId")
             rebuild_sql_tourney = rebuild_sql_tourney.replace('<tourney_select_clause>', ",t.tourneyTypeId")
             rebuild_sql_tourney = rebuild_sql_tourney.replace('<tourney_join_clause>', """INNER JOIN TourneysPlayers tp ON (tp.id = hp.tourneysPlayersId)
@@ -1643,17 +2201,105 @@ class Database:
             rebuild_sql_tourney = rebuild_sql_tourney.replace('<where_clause>', where)
             #print "rebuild_sql_tourney:",rebuild_sql_tourney
 
-            self.get_cursor().execute(rebuild_sql_tourney)
+            # hands go in the same day's rows as when they were imported (see hudCacheStyleKey)
+            hours = self.hudCacheDayOffset()
+            offset = timedelta(hours=hours)
+            style_time = self.sql.query['hudCacheStyleTime'].replace('<minutes>', str(-int(round(hours * 60))))
+            rebuild_sql_cash = rebuild_sql_cash.replace('<style_time>', style_time)
+            rebuild_sql_tourney = rebuild_sql_tourney.replace('<style_time>', style_time)
+
+            clear_sql = self.sql.query['clearHudCacheSlice'].replace('%s', self.sql.query['placeholder'])
+            set_resume = self.sql.query['setHudCacheResume'].replace('%s', self.sql.query['placeholder'])
+            if gametypes:
+                gametype_list = ",".join([str(int(g)) for g in gametypes])
+                clear_sql = clear_sql.replace('<gametype_clause>', "AND gametypeId in (%s)" % gametype_list)
+                gametype_clause = " AND h.gametypeId in (%s)" % gametype_list
+            else:
+                clear_sql = clear_sql.replace('<gametype_clause>', "")
+                gametype_clause = ""
+
+            c = self.get_cursor()
+            c.execute(self.sql.query['getHandsDateRange'])
+            (first, last) = c.fetchone()
+            if first is None:
+                first = last = self.hero_hudstart_def + " 00:00:00"
+            def style_day(t):
+                t = datetime.strptime(str(t)[:19], '%Y-%m-%d %H:%M:%S') - offset
+                return datetime(t.year, t.month, t.day)
+            # no rows to rebuild outside the days of the hands
+            day = style_day(first)
+            if start:
+                day = max(day, datetime.strptime(str(start)[:10], '%Y-%m-%d'))
+            last_day = style_day(last) + timedelta(days=1)
+            if end:
+                last_day = min(last_day, datetime.strptime(str(end)[:10], '%Y-%m-%d'))
+            if checkpoint:
+                day = max(day, datetime.strptime(checkpoint[0], '%Y-%m-%d'))
+            if not (checkpoint or start or end or gametypes):
+                c.execute(self.sql.query['clearHudCache'])
+
+            while day < last_day:
+                next_day = min(day + timedelta(days=self.HUDCACHE_REBUILD_DAYS), last_day)
+                c.execute(clear_sql, (day.strftime('d%y%m%d'), next_day.strftime('d%y%m%d')))
+                range_clause = ("AND h.startTime >= '" + (day + offset).strftime('%Y-%m-%d %H:%M:%S')
+                                + "' AND h.startTime < '" + (next_day + offset).strftime('%Y-%m-%d %H:%M:%S') + "'" + gametype_clause)
+                c.execute(rebuild_sql_cash.replace('<range_clause>', range_clause))
+                c.execute(rebuild_sql_tourney.replace('<range_clause>', range_clause))
+                c.execute(set_resume, (next_day.strftime('%Y-%m-%d'), slice))
+                self.commit()
+                print _("Rebuilt hudcache up to %s") % (next_day.strftime('%Y-%m-%d'),)
+                day = next_day
+            c.execute(set_resume, (None, None))
             self.commit()
             print _("Rebuild hudcache took %.1f seconds") % (time() - stime,)
         except:
+            self.rollback()
             err = traceback.extract_tb(sys.exc_info()[2])[-1]
             print _("Error rebuilding hudcache:"), str(sys.exc_value)
             print err
     #end def rebuild_hudcache
+
+    def get_hudcache_resume(self):
+        """(day, (h_start, v_start, start, end, gametypes)) of an interrupted rebuild_hudcache:
+           the day it got to and the arguments it was started with. None if there is none."""
+        c = self.get_cursor()
+        c.execute(self.sql.query['getHudCacheResume'])
+        (day, slice) = c.fetchone()
+        if not day:
+            return None
+        (h_start, v_start, start, end, gametypes) = slice.split(";")
+        return (day, (h_start, v_start, start or None, end or None, [int(g) for g in gametypes.split(",") if g]))
+
+    def get_hudcache_rebuild_range(self, h_start, v_start):
+        """(start, end) days ('YYYY-MM-DD', end exclusive) of the hudcache that moving the hud
+           start dates to h_start and v_start changes: from the earliest to the latest of
+           those and the days the hero's and the villains' cached rows start now.
+           (None, None), the whole cache, if the dates don't move or can't be read."""
+        old = [self.get_hero_hudcache_start()]
+        c = self.get_cursor()
+        c.execute(self.sql.query['get_villain_hudcache_start'].replace("<playerid_list>", str(tuple(self.hero_ids.values()))))
+        tmp = c.fetchone()
+        if tmp == (None,):
+            old.append(self.villain_hudstart_def)
+        else:
+            old.append("20"+tmp[0][1:3] + "-" + tmp[0][3:5] + "-" + tmp[0][5:7])
+        if old == [h_start, v_start]:
+            return (None, None)
+        try:
+            days = sorted([datetime.strptime(d, '%Y-%m-%d') for d in old + [h_start, v_start]])
+        except ValueError:
+            return (None, None)
+        return (days[0].strftime('%Y-%m-%d'), days[-1].strftime('%Y-%m-%d'))
     
     def rebuild_sessionscache(self):
-        """clears sessionscache and rebuilds from the individual records"""
+        """clears sessionscache and rebuilds from the individual records
+
+           The hero's hands and tourney summaries are streamed in startTime order and
+           split into sessions and game sessions in a single pass: a gap longer than the
+           session timeout closes the session, a gap longer than it within one
+           date/game/player closes the game session. The SessionsCache rows are written
+           in batches and Hands is updated with one statement from a temp table mapping
+           each hand to its session."""
         heros = []
         for site in self.config.get_supported_sites():
             result = self.get_site_id(site)
@@ -1680,58 +2326,101 @@ class Database:
                         where_summary = where_summary + ' OR TourneysPlayers.playerId = %s' % str(i)
         rebuildSessionsCache    = rebuildSessionsCache.replace('<where_clause>', where)
         rebuildSessionsCacheSum = rebuildSessionsCacheSum.replace('<where_clause>', where_summary)
+        rebuild_SC         = self.sql.query['rebuild_SC'].replace('%s', self.sql.query['placeholder'])
+        insert_SessionsMap = self.sql.query['insert_SessionsMap'].replace('%s', self.sql.query['placeholder'])
         
+        stime = time()
         c = self.get_cursor()
         c.execute(self.sql.query['clearSessionsCache'])
         self.commit()
         
-        sc, gsc = {'bk': []}, {'bk': []}
-        c.execute(rebuildSessionsCache)
-        tmp = c.fetchone()
-        while True:
-            pids, game, pdata = {}, {}, {}
-            pdata['pname'] = {}
-            id                              = tmp[0]
-            startTime                       = tmp[1]
-            pids['pname']                   = tmp[2]
-            gid                             = tmp[3]
-            game['type']                    = tmp[4]
-            pdata['pname']['totalProfit']   = tmp[5]
-            pdata['pname']['tourneyTypeId'] = tmp[6]
-            tmp = c.fetchone()
-            sc  = self.prepSessionsCache (id, pids, startTime, sc , heros, tmp == None)
-            gsc = self.storeSessionsCache(id, pids, startTime, game, gid, pdata, sc, gsc, None, heros, tmp == None)
-            if tmp == None:
-                for i, id in sc.iteritems():
-                    if i!='bk':
-                        sid =  id['id']
-                        gid =  gsc[i]['id']
-                        c.execute("UPDATE Hands SET sessionId = %s, gameSessionId = %s WHERE id = %s", (sid, gid, i))
-                break
-        self.commit()
+        tz_dt = datetime.utcnow() - datetime.today()
+        tz = timedelta(hours=int(tz_dt.seconds/3600))
+        THRESHOLD = timedelta(seconds=int(self.sessionTimeout * 60))
         
-        sc, gsc = {'bk': []}, {'bk': []}
-        c.execute(rebuildSessionsCacheSum)        
-        tmp = c.fetchone()
-        while True:
-            pids, game, info = {}, {}, {}
-            id                                = tmp[0]
-            startTime                         = tmp[1]
-            pids['pname']                     = tmp[2]
-            game['type']                      = 'summary'
-            info['tourneyTypeId']             = tmp[3]
-            info['winnings']                  = {}
-            info['winnings']['pname']         = tmp[4]
-            info['winningsCurrency']          = {}
-            info['winningsCurrency']['pname'] = tmp[5]
-            info['buyinCurrency']             = tmp[6]
-            info['buyin']                     = tmp[7]
-            info['fee']                       = tmp[8]
-            tmp = c.fetchone()    
-            sc  = self.prepSessionsCache (id, pids, startTime, sc , heros, tmp == None)
-            gsc = self.storeSessionsCache(id, pids, startTime, game, None, info, sc, gsc, None, heros, tmp == None)
-            if tmp == None:
-                break
+        def naive(t):
+            # sqlite hands come back as text in the stored '+00:00' form
+            if isinstance(t, basestring):
+                return datetime.strptime(t[:19], "%Y-%m-%d %H:%M:%S")
+            return t.replace(tzinfo=None)
+        
+        def hands():
+            hc = self.get_cursor()
+            hc.execute(rebuildSessionsCache)
+            for (id, startTime, playerId, gid, type, totalProfit, tourneyTypeId) in self.fetchmanyIter(hc):
+                if type == 'ring':
+                    yield (naive(startTime), id, (type, gid, None, playerId), 1, 0, totalProfit)
+                else:
+                    yield (naive(startTime), id, (type, None, tourneyTypeId, playerId), 1, 0, 0)
+        
+        def summaries():
+            tc = self.get_cursor()
+            tc.execute(rebuildSessionsCacheSum)
+            for r in self.fetchmanyIter(tc):
+                (winnings, winningsCurrency, buyinCurrency, buyin, fee) = r[4:9]
+                if buyinCurrency == winningsCurrency:
+                      totalProfit = (winnings or 0) - ((buyin or 0) + (fee or 0))
+                else: totalProfit = winnings or 0
+                yield (naive(r[1]), None, ('tour', None, r[3], r[2]), 0, 1, totalProfit)
+        
+        state = {'sid': 0, 'gsid': 0, 'rows': [], 'map': []}
+        def close_session(session, games, closed):
+            # game session rows only get their session bounds once it is complete
+            (start, end, sid) = session
+            for g in closed + games.values():
+                state['gsid'] += 1
+                (date, type, gametypeId, tourneyTypeId, playerId) = g['key']
+                state['rows'].append([state['gsid'], start, end, g['start'], g['end'], sid, date, type
+                                     ,gametypeId, tourneyTypeId, playerId, g['hands'], g['tourneys'], g['profit']])
+                state['map'] += [[h, sid, state['gsid']] for h in g['hids']]
+            if len(state['rows']) >= 1000:
+                c.executemany(rebuild_SC, state['rows'])
+                state['rows'] = []
+            if len(state['map']) >= 10000:
+                c.executemany(insert_SessionsMap, state['map'])
+                state['map'] = []
+        
+        c.execute(self.sql.query['create_SessionsMap'])
+        session, games, closed, count = None, {}, [], 0
+        for (t, hid, game, hands, tourneys, profit) in merge(hands(), summaries()):
+            if session and t - session[1] > THRESHOLD:
+                close_session(session, games, closed)
+                session, games, closed = None, {}, []
+            if not session:
+                state['sid'] += 1
+                session = [t, t, state['sid']]
+            session[1] = t
+            local = t + tz
+            key = ("d%02d%02d%02d" % (local.year - 2000, local.month, local.day), ) + game
+            g = games.get(key)
+            if g and t - g['end'] > THRESHOLD:
+                closed.append(g)
+                g = None
+            if not g:
+                g = games[key] = {'key': key, 'start': t, 'hands': 0, 'tourneys': 0, 'profit': 0, 'hids': []}
+            g['end'] = t
+            g['hands']    += hands
+            g['tourneys'] += tourneys
+            g['profit']   += profit
+            if hid is not None:
+                g['hids'].append(hid)
+            count += 1
+            if count % 10000 == 0:
+                print _("Rebuilding sessionscache: %d records, %.0f per second") % (count, count / (time() - stime))
+        if session:
+            close_session(session, games, closed)
+        if state['rows']:
+            c.executemany(rebuild_SC, state['rows'])
+        if state['map']:
+            c.executemany(insert_SessionsMap, state['map'])
+        if state['gsid'] and self.sql.query['reset_SC_id']:
+            c.execute(self.sql.query['reset_SC_id'])
+        if self.sql.query['index_SessionsMap']:
+            c.execute(self.sql.query['index_SessionsMap'])
+        c.execute(self.sql.query['update_Hands_SessionsMap'])
+        c.execute(self.sql.query['drop_SessionsMap'])
+        self.commit()
+        print _("Rebuild sessionscache took %.1f seconds") % (time() - stime,)
 
     def get_hero_hudcache_start(self):
         """fetches earliest stylekey from hudcache for one of hero's player ids"""
@@ -1782,6 +2471,11 @@ class Database:
             except:
                 print _("Error during analyze:"), str(sys.exc_value)
             self.connection.set_isolation_level(1)   # go back to normal isolation level
+        elif self.backend == self.SQLITE:
+            try:
+                self.get_cursor().execute(self.sql.query['analyze'])
+            except:
+                print _("Error during analyze:"), str(sys.exc_value)
         self.commit()
         atime = time() - stime
         log.info(_("Analyze took %.1f seconds") % (atime,))
@@ -1903,21 +2597,17 @@ class Database:
             bbulk = []
             for h in hbulk:
                 id = h.pop()
-                if hdata['sc'] and hdata['gsc']:
+                if hdata['sc'] and hdata['gsc'] and id in hdata['gsc']:
                     h[4] = hdata['sc'][id]['id']
                     h[5] = hdata['gsc'][id]['id']
                 boards = h.pop()
                 for b in boards:
                     bbulk += [[id] + b]
-            q = self.sql.query['store_hand']
-            q = q.replace('%s', self.sql.query['placeholder'])
-            c = self.get_cursor()
-            c.executemany(q, hbulk)
-            q = self.sql.query['store_boards']
-            q = q.replace('%s', self.sql.query['placeholder'])
+                h.append(id)
             c = self.get_cursor()
-            c.executemany(q, bbulk)
-            self.commit()
+            self.bulk_insert(c, 'store_hand', hbulk)
+            if bbulk:
+                self.bulk_insert(c, 'store_boards', bbulk)
         return hbulk
 
     def storeHandsPlayers(self, hid, pids, pdata, hpbulk, doinsert = False, printdata = False):
@@ -2049,10 +2739,8 @@ class Database:
                             ) )
 
         if doinsert:
-            q = self.sql.query['store_hands_players']
-            q = q.replace('%s', self.sql.query['placeholder'])
             c = self.get_cursor()
-            c.executemany(q, hpbulk)
+            self.bulk_insert(c, 'store_hands_players', hpbulk)
         return hpbulk
 
     def storeHandsActions(self, hid, pids, adata, habulk, doinsert = False, printdata = False):
@@ -2080,28 +2768,62 @@ class Database:
                             ) )
             
         if doinsert:
-            q = self.sql.query['store_hands_actions']
-            q = q.replace('%s', self.sql.query['placeholder'])
             c = self.get_cursor()
-            c.executemany(q, habulk)
+            if habulk:
+                self.bulk_insert(c, 'store_hands_actions', habulk)
         return habulk
 
-    def storeHudCache(self, gid, pids, starttime, pdata, hcbulk, doinsert = False):
-        """Update cached statistics. If update fails because no record exists, do an insert."""
+    def bulk_insert(self, c, name, rows):
+        """Insert rows with the store_ query name. Large batches on postgres are
+           streamed through the matching copy_ query instead, executemany is used
+           for everything else and whenever the COPY fails."""
+        if self.backend == self.PGSQL and len(rows) >= self.COPY_ROWS:
+            c.execute("SAVEPOINT bulk_copy")
+            try:
+                c.copy_expert(self.sql.query[name.replace('store_', 'copy_', 1)], copy_text(rows))
+                c.execute("RELEASE SAVEPOINT bulk_copy")
+                return
+            except:
+                log.warning(_("COPY for %s failed, using INSERT:") % name + " " + str(sys.exc_info()[1]))
+                c.execute("ROLLBACK TO SAVEPOINT bulk_copy")
+        q = self.sql.query[name].replace('%s', self.sql.query['placeholder'])
+        c.executemany(q, rows)
 
-        tz = datetime.utcnow() - datetime.today()
-        tz_offset = tz.seconds/3600
-        tz_day_start_offset = self.day_start + tz_offset
-        
-        d = timedelta(hours=tz_day_start_offset)
-        starttime_offset = starttime - d
-        
-        if self.use_date_in_hudcache:
-            styleKey = datetime.strftime(starttime_offset, 'd%y%m%d')
-            #styleKey = "d%02d%02d%02d" % (hand_start_time.year-2000, hand_start_time.month, hand_start_time.day)
+    def hudcache_upsert(self):
+        """True if the db has the INSERT .. ON CONFLICT/ON DUPLICATE KEY needed for upsert_hudcache"""
+        if self.backend == self.PGSQL:
+            return self.connection.server_version >= 90500
+        elif self.backend == self.SQLITE:
+            return sqlite_version_info >= (3, 24, 0)
+        return True
+
+    def executemany_values(self, c, q, rows, chunk=500):
+        """Execute q, whose VALUES list is <values>, for all rows. executemany already
+           sends multi-row inserts on mysql and sqlite runs in process, postgres gets
+           one statement per chunk rows."""
+        values = "(" + ", ".join([self.sql.query['placeholder']] * len(rows[0])) + ")"
+        if self.backend == self.PGSQL:
+            for i in xrange(0, len(rows), chunk):
+                part = rows[i:i+chunk]
+                c.execute(q.replace('<values>', ", ".join([values] * len(part))), [v for row in part for v in row])
         else:
+            c.executemany(q.replace('<values>', values), rows)
+
+    def hudCacheStyleKey(self, starttime):
+        """styleKey of the HudCache rows of a hand started at starttime"""
+        if not self.use_date_in_hudcache:
             # hard-code styleKey as 'A000000' (all-time cache, no key) for now
-            styleKey = 'A000000'
+            return 'A000000'
+        d = timedelta(hours=self.hudCacheDayOffset())
+        starttime_offset = starttime - d
+        return datetime.strftime(starttime_offset, 'd%y%m%d')
+        #styleKey = "d%02d%02d%02d" % (hand_start_time.year-2000, hand_start_time.month, hand_start_time.day)
+
+    def storeHudCache(self, gid, pids, starttime, pdata, hcbulk, doinsert = False):
+        """Add the hand's stats to the hcbulk dict of HudCache rows and, if doinsert, write
+           them. If update fails because no record exists, do an insert."""
+
+        styleKey = self.hudCacheStyleKey(starttime)
 
         update_hudcache = self.sql.query['update_hudcache']
         update_hudcache = update_hudcache.replace('%s', self.sql.query['placeholder'])
@@ -2109,7 +2831,7 @@ class Database:
         insert_hudcache = insert_hudcache.replace('%s', self.sql.query['placeholder'])
 
         #print "DEBUG: %s %s %s" %(hid, pids, pdata)
-        hcs = []
+        pos = self.hudCachePositions
         for p in pdata:
             #NOTE: Insert new stats at right place because SQL needs strict order
             line = []
@@ -2202,166 +2924,118 @@ class Database:
             line.append(pdata[p]['street3Raises'])               
             line.append(pdata[p]['street4Raises'])               
             
-            hc = {}
-            hc['gametypeId'] = gid
-            hc['playerId'] = pids[p]
-            hc['activeSeats'] = len(pids)
-            pos = {'B':'B', 'S':'S', 0:'D', 1:'C', 2:'M', 3:'M', 4:'M', 5:'E', 6:'E', 7:'E', 8:'E', 9:'E' }
-            hc['position'] = pos[pdata[p]['position']]
-            hc['tourneyTypeId'] = pdata[p]['tourneyTypeId']
-            hc['styleKey'] = styleKey
             for i in range(len(line)):
                 if line[i]==True:  line[i] = 1
                 if line[i]==False: line[i] = 0
-            hc['line'] = line
-            hc['game'] = [hc['gametypeId']
-                         ,hc['playerId']
-                         ,hc['activeSeats']
-                         ,hc['position']
-                         ,hc['tourneyTypeId']
-                         ,hc['styleKey']]
-            hcs.append(hc)
-            
-        for h in hcs:
-            match = False
-            for b in hcbulk:
-                #print h['game']==b['game'], h['game'], b['game']
-                if  h['game']==b['game']:
-                    b['line'] = [sum(l) for l in zip(b['line'], h['line'])]
-                    match = True
-            if not match: hcbulk.append(h)
+            game = (gid, pids[p], len(pids), pos[pdata[p]['position']], pdata[p]['tourneyTypeId'], styleKey)
+            # hcbulk is keyed by (gametypeId, playerId, activeSeats, position, tourneyTypeId, styleKey)
+            if game in hcbulk:
+                hcbulk[game] = map(operator.add, hcbulk[game], line)
+            else:
+                hcbulk[game] = line
         
         if doinsert:
-            inserts = []
             c = self.get_cursor()
-            for hc in hcbulk:
-                row = hc['line'] + hc['game']
-                num = c.execute(update_hudcache, row)
-                # Try to do the update first. Do insert it did not work
-                if ((self.backend == self.PGSQL and c.statusmessage != "UPDATE 1")
-                        or (self.backend == self.MYSQL_INNODB and num == 0)
-                        or (self.backend == self.SQLITE and num.rowcount == 0)):
-                    inserts.append(hc['game'] + hc['line'])
-                    #row = hc['game'] + hc['line']
-                    #num = c.execute(insert_hudcache, row)
-                    #print "DEBUG: Successfully(?: %s) updated HudCacho using INSERT" % num
+            rows = [list(game) + line for (game, line) in hcbulk.iteritems()]
+            if self.hudcache_upsert():
+                if self.backend == self.MYSQL_INNODB:
+                    # NULL tourneyTypeIds (cash games) never hit the unique key in mysql
+                    upserts = [row for row in rows if row[4] is not None]
+                    rows = [row for row in rows if row[4] is None]
                 else:
-                    #print "DEBUG: Successfully updated HudCacho using UPDATE"
-                    pass
-            if inserts:
-                c.executemany(insert_hudcache, inserts)
+                    upserts, rows = rows, []
+                if upserts:
+                    self.executemany_values(c, self.sql.query['upsert_hudcache'], upserts)
+            if rows:
+                # look up which rows exist in one go, then update those and insert the rest
+                existing = self.getHudCacheKeys(c, rows)
+                updates = [row[6:] + row[:6] for row in rows if tuple(row[:6]) in existing]
+                inserts = [row for row in rows if tuple(row[:6]) not in existing]
+                if updates:
+                    c.executemany(update_hudcache, updates)
+                if inserts:
+                    c.executemany(insert_hudcache, inserts)
                              
         return hcbulk
             
+    def getHudCacheKeys(self, c, rows, chunk=500):
+        """Set of the (gametypeId, playerId, activeSeats, position, tourneyTypeId, styleKey)
+           keys of rows that are already in HudCache."""
+        keys = set([tuple(row[:6]) for row in rows])
+        gametypes = list(set([key[0] for key in keys]))
+        players = list(set([key[1] for key in keys]))
+        existing = set()
+        for i in xrange(0, len(players), chunk):
+            part = players[i:i+chunk]
+            q = self.sql.query['select_hudcache_keys']
+            q = q.replace('<gametypeid_list>', "(" + ", ".join([self.sql.query['placeholder']] * len(gametypes)) + ")")
+            q = q.replace('<playerid_list>', "(" + ", ".join([self.sql.query['placeholder']] * len(part)) + ")")
+            c.execute(q, gametypes + part)
+            existing.update([tuple(r) for r in c.fetchall() if tuple(r) in keys])
+        return existing
+
     def prepSessionsCache(self, hid, pids, startTime, sc, heros, doinsert = False):
-        """Update cached sessions. If no record exists, do an insert"""
+        """Collect the hero hands of a batch in sc['bk']. On doinsert they are sorted and
+           clustered into sessions, merged with the overlapping sessions in the db
+           (fetched with one query) and sc[hid] is set to the session of each hand."""
         THRESHOLD = timedelta(seconds=int(self.sessionTimeout * 60))
         
-        select_prepSC    = self.sql.query['select_prepSC'].replace('%s', self.sql.query['placeholder'])
-        update_Hands_sid = self.sql.query['update_Hands_sid'].replace('%s', self.sql.query['placeholder'])
-        update_SC_sid    = self.sql.query['update_SC_sid'].replace('%s', self.sql.query['placeholder'])
-        update_prepSC    = self.sql.query['update_prepSC'].replace('%s', self.sql.query['placeholder'])
-        
-        #print "DEBUG: %s %s %s" %(hid, pids, pdata)
-        hand = {}
         for p, id in pids.iteritems():
             if id in heros:
-                hand['startTime'] = startTime.replace(tzinfo=None)
-                hand['ids'] = []
-        
-        if hand:
-            id = []
-            lower = hand['startTime']-THRESHOLD
-            upper = hand['startTime']+THRESHOLD
-            for i in range(len(sc['bk'])):
-                if ((lower  <= sc['bk'][i]['sessionEnd'])
-                and (upper  >= sc['bk'][i]['sessionStart'])):
-                    if ((hand['startTime'] <= sc['bk'][i]['sessionEnd']) 
-                    and (hand['startTime'] >= sc['bk'][i]['sessionStart'])):
-                         id.append(i)
-                    elif hand['startTime'] < sc['bk'][i]['sessionStart']:
-                         sc['bk'][i]['sessionStart'] = hand['startTime']
-                         id.append(i)
-                    elif hand['startTime'] > sc['bk'][i]['sessionEnd']:
-                         sc['bk'][i]['sessionEnd'] = hand['startTime']
-                         id.append(i)
-            if len(id) == 1:
-                id = id[0]
-                sc['bk'][id]['ids'].append(hid)
-            elif len(id) == 2:
-                if  sc['bk'][id[0]]['startTime'] < sc['bk'][id[1]]['startTime']:
-                    sc['bk'][id[0]]['endTime']   = sc['bk'][id[1]]['endTime']
-                else:
-                    sc['bk'][id[0]]['startTime'] = sc['bk'][id[1]]['startTime']
-                sc['bk'].pop[id[1]]
-                id = id[0]
-                sc['bk'][id]['ids'].append(hid)
-            elif len(id) == 0:
-                hand['id'] = None
-                hand['sessionStart'] = hand['startTime']
-                hand['sessionEnd']   = hand['startTime']
-                id = len(sc['bk'])
-                hand['ids'].append(hid)
-                sc['bk'].append(hand)
+                sc['bk'].append((startTime.replace(tzinfo=None), hid))
+                break
         
-        if doinsert:
+        if doinsert and sc['bk']:
+            select_prepSC    = self.sql.query['select_prepSC'].replace('%s', self.sql.query['placeholder'])
+            update_Hands_sid = self.sql.query['update_Hands_sid'].replace('%s', self.sql.query['placeholder'])
+            update_SC_sid    = self.sql.query['update_SC_sid'].replace('%s', self.sql.query['placeholder'])
+            update_prepSC    = self.sql.query['update_prepSC'].replace('%s', self.sql.query['placeholder'])
             c = self.get_cursor()
+            
+            times = [t for (t, h) in sc['bk']]
+            c.execute(select_prepSC, (min(times) - THRESHOLD, max(times) + THRESHOLD))
+            existing = {}
+            for r in self.fetchallDict(c):
+                (start, end) = existing.get(r['id'], (r['sessionStart'], r['sessionEnd']))
+                existing[r['id']] = (min(start, r['sessionStart']), max(end, r['sessionEnd']))
+            
             c.execute("SELECT max(sessionId) FROM SessionsCache")
-            id = c.fetchone()[0]
-            if id: sid = id
-            else: sid = 0
-            for i in range(len(sc['bk'])):
-                lower = sc['bk'][i]['sessionStart'] - THRESHOLD
-                upper = sc['bk'][i]['sessionEnd']   + THRESHOLD
-                c.execute(select_prepSC, (lower, upper))
-                r = self.fetchallDict(c)
-                num = len(r)
-                if (num == 1):
-                    start, end, update = r[0]['sessionStart'], r[0]['sessionEnd'], False
-                    if sc['bk'][i]['sessionStart'] < start:
-                        start, update = sc['bk'][i]['sessionStart'], True
-                    if sc['bk'][i]['sessionEnd'] > end:
-                        end, update = sc['bk'][i]['sessionEnd'], True
-                    if update: 
-                        c.execute(update_prepSC, [start, end, r[0]['id']])
-                    for h in  sc['bk'][i]['ids']:
-                        sc[h] = {'id': r[0]['id'], 'data': [start, end]}
-                elif (num > 1):
-                    start, end, merge, merge_h, merge_sc = None, None, [], [], []
-                    sid += 1
-                    r.append(sc['bk'][i])
-                    for n in r:                      
-                        if start: 
-                            if  start > n['sessionStart']: 
-                                start = n['sessionStart']
-                        else:   start = n['sessionStart']
-                        if end: 
-                            if  end < n['sessionEnd']: 
-                                end = n['sessionEnd']
-                        else:   end = n['sessionEnd']
-                    for n in r:
-                        if n['id']:
-                            if n['id'] in merge: continue
-                            merge.append(n['id'])   
-                            merge_h.append([sid, n['id']])
-                            merge_sc.append([start, end, sid, n['id']])
-                    c.executemany(update_Hands_sid, merge_h)
-                    c.executemany(update_SC_sid, merge_sc)
-                    for k, v in sc.iteritems(): 
-                        if k!='bk' and v['id'] in merge: 
-                            sc[k]['id'] = sid
-                    for h in sc['bk'][i]['ids']:
-                        sc[h] = {'id': sid, 'data': [start, end]}
-                elif (num == 0):
+            sid = c.fetchone()[0] or 0
+            merge_h, merge_sc, update = [], [], []
+            # hands closer together than the session timeout are one session, along
+            # with the sessions in the db they come that close to
+            intervals = ([(t, t, ('new', h)) for (t, h) in sc['bk']]
+                        +[(start, end, ('old', id)) for id, (start, end) in existing.iteritems()])
+            for (start, end, members) in cluster_intervals(intervals, THRESHOLD):
+                hids = [v for (k, v) in members if k == 'new']
+                if not hids:
+                    continue
+                old = sorted(set([v for (k, v) in members if k == 'old']))
+                if old:
+                    # the oldest session takes over any others the new hands join up
+                    id = old[0]
+                    for o in old[1:]:
+                        merge_h.append([id, o])
+                        merge_sc.append([start, end, id, o])
+                    if len(old) > 1 or existing[id] != (start, end):
+                        update.append([start, end, id])
+                else:
                     sid += 1
-                    start =  sc['bk'][i]['sessionStart']
-                    end   =  sc['bk'][i]['sessionEnd']
-                    for h in sc['bk'][i]['ids']:
-                        sc[h] = {'id': sid, 'data': [start, end]}
+                    id = sid
+                for h in hids:
+                    sc[h] = {'id': id, 'data': [start, end]}
+            if merge_h:
+                c.executemany(update_Hands_sid, merge_h)
+                c.executemany(update_SC_sid, merge_sc)
+            if update:
+                c.executemany(update_prepSC, update)
         return sc
-    
+
     def storeSessionsCache(self, hid, pids, startTime, game, gid, pdata, sc, gsc, tz, heros, doinsert = False):
-        """Update cached sessions. If no record exists, do an insert"""
+        """Collect the hero hands of a batch in gsc['bk']. On doinsert they are clustered
+           into game sessions per date/game/player, merged with the overlapping
+           SessionsCache rows (fetched with one query) and gsc[hid] is set to the
+           SessionsCache id of each hand. prepSessionsCache must have run first."""
         if not tz:
             tz_dt = datetime.utcnow() - datetime.today()
             tz = tz_dt.seconds/3600
@@ -2370,159 +3044,91 @@ class Database:
         local = startTime + timedelta(hours=int(tz))
         date = "d%02d%02d%02d" % (local.year - 2000, local.month, local.day)
         
-        select_SC         = self.sql.query['select_SC'].replace('%s', self.sql.query['placeholder'])
-        update_SC         = self.sql.query['update_SC'].replace('%s', self.sql.query['placeholder'])
-        insert_SC         = self.sql.query['insert_SC'].replace('%s', self.sql.query['placeholder'])
-        delete_SC         = self.sql.query['delete_SC'].replace('%s', self.sql.query['placeholder'])
-        update_Hands_gsid = self.sql.query['update_Hands_gsid'].replace('%s', self.sql.query['placeholder'])
-
         #print "DEBUG: %s %s %s" %(hid, pids, pdata)
-        hand = {}
+        hand = None
         for p, id in pids.iteritems():
             if id in heros:
-                hand['hands'] = 0
-                hand['totalProfit'] = 0
-                hand['playerId'] = id
-                hand['gametypeId'] = None
-                hand['date'] = date
-                hand['startTime'] = startTime.replace(tzinfo=None)
-                hand['hid'] = hid
-                hand['tourneys'] = 0
-                hand['tourneyTypeId'] = None
-                hand['ids'] = []
+                type, gametypeId, tourneyTypeId, hands, tourneys, totalProfit = game['type'], None, None, 0, 0, 0
                 if (game['type']=='summary'):
-                    hand['type'] = 'tour'
-                    hand['tourneys'] = 1
-                    hand['tourneyTypeId'] = pdata['tourneyTypeId']
+                    type = 'tour'
+                    tourneys = 1
+                    tourneyTypeId = pdata['tourneyTypeId']
                     if pdata['buyinCurrency'] == pdata['winningsCurrency'][p]:
-                          hand['totalProfit'] = pdata['winnings'][p] - (pdata['buyin'] + pdata['fee'])
-                    else: hand['totalProfit'] = pdata['winnings'][p]
+                          totalProfit = pdata['winnings'][p] - (pdata['buyin'] + pdata['fee'])
+                    else: totalProfit = pdata['winnings'][p]
                 elif (game['type']=='ring'):
-                    hand['type'] = game['type']
-                    hand['hands'] = 1
-                    hand['gametypeId'] = gid
-                    hand['totalProfit'] = pdata[p]['totalProfit']
+                    hands = 1
+                    gametypeId = gid
+                    totalProfit = pdata[p]['totalProfit']
                 elif (game['type']=='tour'):
-                    hand['type'] = game['type']
-                    hand['hands'] = 1
-                    hand['tourneyTypeId'] = pdata[p]['tourneyTypeId']
-        
+                    hands = 1
+                    tourneyTypeId = pdata[p]['tourneyTypeId']
+                hand = ((date, type, gametypeId, tourneyTypeId, id), startTime.replace(tzinfo=None)
+                       ,hid, hands, tourneys, totalProfit)
         if hand:
-            id = []
-            lower = hand['startTime']-THRESHOLD
-            upper = hand['startTime']+THRESHOLD
-            for i in range(len(gsc['bk'])):
-                if ((hand['date']          == gsc['bk'][i]['date']) 
-                and (hand['gametypeId']    == gsc['bk'][i]['gametypeId'])
-                and (hand['playerId']      == gsc['bk'][i]['playerId']) 
-                and (hand['tourneyTypeId'] == gsc['bk'][i]['tourneyTypeId'])): 
-                    if ((lower <= gsc['bk'][i]['gameEnd'])
-                    and (upper >= gsc['bk'][i]['gameStart'])):
-                        if ((hand['startTime'] <=  gsc['bk'][i]['gameEnd']) 
-                        and (hand['startTime'] >=  gsc['bk'][i]['gameStart'])):
-                            gsc['bk'][i]['hands']         += hand['hands']
-                            gsc['bk'][i]['tourneys']      += hand['tourneys']
-                            gsc['bk'][i]['totalProfit']   += hand['totalProfit']
-                        elif hand['startTime']  <  gsc['bk'][i]['gameStart']:
-                            gsc['bk'][i]['hands']         += hand['hands']
-                            gsc['bk'][i]['tourneys']      += hand['tourneys']
-                            gsc['bk'][i]['totalProfit']   += hand['totalProfit']
-                            gsc['bk'][i]['gameStart']      = hand['startTime']
-                        elif hand['startTime']  >  gsc['bk'][i]['gameEnd']:
-                            gsc['bk'][i]['hands']         += hand['hands']
-                            gsc['bk'][i]['tourneys']      += hand['tourneys']
-                            gsc['bk'][i]['totalProfit']   += hand['totalProfit']
-                            gsc['bk'][i]['gameEnd']        = hand['startTime']
-                        id.append(i)
-            if len(id) == 1:
-                gsc['bk'][id[0]]['ids'].append(hid)
-            elif len(id) == 2:
-                if    gsc['bk'][id[0]]['gameStart'] < gsc['bk'][id[1]]['gameStart']:
-                      gsc['bk'][id[0]]['gameEnd']   = gsc['bk'][id[1]]['gameEnd']
-                else: gsc['bk'][id[0]]['gameStart'] = gsc['bk'][id[1]]['gameStart']
-                gsc['bk'][id[0]]['hands']         += hand['hands']
-                gsc['bk'][id[0]]['tourneys']      += hand['tourneys']
-                gsc['bk'][id[0]]['totalProfit']   += hand['totalProfit']
-                gsc['bk'].pop[id[1]]
-                gsc['bk'][id[0]]['ids'].append(hid)
-            elif len(id) == 0:
-                hand['gameStart'] = hand['startTime']
-                hand['gameEnd']   = hand['startTime']
-                id = len(gsc['bk'])
-                hand['ids'].append(hid)
-                gsc['bk'].append(hand)
+            gsc['bk'].append(hand)
         
-        if doinsert:
+        if doinsert and gsc['bk']:
+            select_SC         = self.sql.query['select_SC_range'].replace('%s', self.sql.query['placeholder'])
+            update_SC         = self.sql.query['update_SC'].replace('%s', self.sql.query['placeholder'])
+            insert_SC         = self.sql.query['insert_SC'].replace('%s', self.sql.query['placeholder'])
+            delete_SC         = self.sql.query['delete_SC'].replace('%s', self.sql.query['placeholder'])
+            update_Hands_gsid = self.sql.query['update_Hands_gsid'].replace('%s', self.sql.query['placeholder'])
             c = self.get_cursor()
-            for i in range(len(gsc['bk'])):
-                hid = gsc['bk'][i]['hid']
-                sid, start, end  = sc[hid]['id'], sc[hid]['data'][0], sc[hid]['data'][1]
-                lower = gsc['bk'][i]['gameStart'] - THRESHOLD
-                upper = gsc['bk'][i]['gameEnd']   + THRESHOLD
-                game = [gsc['bk'][i]['date']
-                       ,gsc['bk'][i]['type']
-                       ,gsc['bk'][i]['gametypeId']
-                       ,gsc['bk'][i]['tourneyTypeId']
-                       ,gsc['bk'][i]['playerId']]
-                row = [lower, upper] + game
-                c.execute(select_SC, row)
-                r = self.fetchallDict(c)
-                num = len(r)
-                if (num == 1):
-                    gstart, gend = r[0]['gameStart'], r[0]['gameEnd']
-                    if gsc['bk'][i]['gameStart'] < gstart:
-                        gstart = gsc['bk'][i]['gameStart']
-                    if gsc['bk'][i]['gameEnd']   > gend:
-                        gend = gsc['bk'][i]['gameEnd']
-                    row = [start, end, gstart, gend
-                          ,gsc['bk'][i]['hands']
-                          ,gsc['bk'][i]['tourneys']
-                          ,gsc['bk'][i]['totalProfit']
-                          ,r[0]['id']]
-                    c.execute(update_SC, row)
-                    for h in gsc['bk'][i]['ids']: gsc[h] = {'id': r[0]['id']} 
-                elif (num > 1):
-                    gstart, gend, hands, tourneys, totalProfit, delete, merge = None, None, 0, 0, 0, [], []
-                    for n in r: delete.append(n['id'])
-                    delete.sort()
-                    for d in delete: c.execute(delete_SC, d)
-                    r.append(gsc['bk'][i])
-                    for n in r:
-                        if gstart:
-                            if  gstart > n['gameStart']: 
-                                gstart = n['gameStart']
-                        else:   gstart = n['gameStart']
-                        if gend: 
-                            if  gend < n['gameEnd']: 
-                                gend = n['gameEnd']
-                        else:   gend = n['gameEnd']
-                        hands         += n['hands']
-                        tourneys      += n['tourneys']
-                        totalProfit   += n['totalProfit']
-                    row = [start, end, gstart, gend, sid] + game + [hands, tourneys, totalProfit]
-                    c.execute(insert_SC, row)
-                    gsid = self.get_last_insert_id(c)
-                    for h in gsc['bk'][i]['ids']: gsc[h] = {'id': gsid}
-                    for m in delete: merge.append([gsid, m])
-                    c.executemany(update_Hands_gsid, merge)
-                elif (num == 0):
-                    gstart =          gsc['bk'][i]['gameStart']
-                    gend =            gsc['bk'][i]['gameEnd']
-                    hands =           gsc['bk'][i]['hands']
-                    tourneys =        gsc['bk'][i]['tourneys']
-                    totalProfit =     gsc['bk'][i]['totalProfit']
-                    row = [start, end, gstart, gend, sid] + game + [hands, tourneys, totalProfit]
-                    c.execute(insert_SC, row)
-                    gsid = self.get_last_insert_id(c)
-                    for h in gsc['bk'][i]['ids']: gsc[h] = {'id': gsid}
-                else:
-                    # Something bad happened
-                    pass
-            self.commit()
+            
+            games = {}
+            for h in gsc['bk']:
+                games.setdefault(h[0], []).append(h)
+            times = [h[1] for h in gsc['bk']]
+            c.execute(select_SC, (min(times) - THRESHOLD, max(times) + THRESHOLD))
+            rows = {}
+            for r in self.fetchallDict(c):
+                rows.setdefault((r['date'], r['type'], r['playerId']), []).append(r)
+            
+            updates, deletes, merge = [], [], []
+            for (key, hands) in games.iteritems():
+                (date, type, gametypeId, tourneyTypeId, playerId) = key
+                # rows without a gametype or tourney type match any, as in select_SC
+                intervals = [(r['gameStart'], r['gameEnd'], ('old', r)) for r in rows.get((date, type, playerId), [])
+                             if  r['gametypeId'] in (None, gametypeId)
+                             and r['tourneyTypeId'] in (None, tourneyTypeId)]
+                intervals += [(h[1], h[1], ('new', h)) for h in hands]
+                for (gstart, gend, members) in cluster_intervals(intervals, THRESHOLD):
+                    new = [v for (k, v) in members if k == 'new']
+                    if not new:
+                        continue
+                    old = sorted([v for (k, v) in members if k == 'old'], key=lambda r: r['id'])
+                    counts = [sum([h[3] for h in new]), sum([h[4] for h in new]), sum([h[5] for h in new])]
+                    (start, end) = sc[new[0][2]]['data']
+                    if old:
+                        # the first row absorbs the new hands and any rows they join up
+                        id = old[0]['id']
+                        for r in old[1:]:
+                            counts = [counts[0] + r['hands'], counts[1] + r['tourneys'], counts[2] + r['totalProfit']]
+                            deletes.append([r['id']])
+                            merge.append([id, r['id']])
+                        updates.append([start, end, gstart, gend] + counts + [id])
+                    else:
+                        c.execute(insert_SC, [start, end, gstart, gend, sc[new[0][2]]['id']
+                                             ,date, type, gametypeId, tourneyTypeId, playerId] + counts)
+                        id = self.get_last_insert_id(c)
+                    for h in new:
+                        gsc[h[2]] = {'id': id}
+            if updates:
+                c.executemany(update_SC, updates)
+            if deletes:
+                c.executemany(delete_SC, deletes)
+                c.executemany(update_Hands_gsid, merge)
             
         return gsc
 
     def getGameTypeId(self, siteid, game, printdata = False):
+        key = (siteid, game['type'], game['category'], game['limitType'], game['currency'],
+               game['mix'], game['sb'], game['bb'], game['maxSeats'], game['ante'])
+        if key in self.gtcache:
+            self.cachestats['Gametypes'][0] += 1
+            return self.gtcache[key]
+        self.cachestats['Gametypes'][1] += 1
         c = self.get_cursor()
         #FIXME: Fixed for NL at the moment
         c.execute(self.sql.query['getGametypeNL'], (siteid, game['type'], game['category'], game['limitType'], game['currency'],
@@ -2541,6 +3147,7 @@ class Database:
                                     game['mix'], int(Decimal(game['sb'])*100), int(Decimal(game['bb'])*100),
                                     int(Decimal(game['bb'])*100), int(Decimal(game['bb'])*200), game['maxSeats'], game['ante']),
                                     printdata = printdata)
+        self.cacheAdd(self.gtcache, key, tmp[0])
         return tmp[0]
 
 
@@ -2570,6 +3177,133 @@ class Database:
         c = self.get_cursor()
         c.execute(q, fdata)
 
+    def storeRawHands(self, fileId, hands):
+        """Save the text of hands, a list of (handId, text), in the raw hand archive.
+           Consecutive hands are compressed together in blocks of about RAW_BLOCK_SIZE
+           bytes, RawHands has the position of each hand in its uncompressed block."""
+        compression = self.config.raw_hands.compression
+        if compression not in RAW_CODECS:
+            compression = 'gzip'    # lzma is not installed
+        compress = RAW_CODECS[compression][0]
+        store_raw_block = self.sql.query['store_raw_block'].replace('%s', self.sql.query['placeholder'])
+        store_raw_hands = self.sql.query['store_raw_hands'].replace('%s', self.sql.query['placeholder'])
+        c = self.get_cursor()
+        
+        rows, texts, size = [], [], 0
+        for i in xrange(len(hands)):
+            (hid, text) = hands[i]
+            if isinstance(text, unicode):
+                text = text.encode('utf-8')
+            rows.append([hid, None, size, len(text)])
+            texts.append(text)
+            size += len(text)
+            if size >= self.RAW_BLOCK_SIZE or i == len(hands) - 1:
+                block = compress(''.join(texts))
+                if self.backend == self.MYSQL_INNODB:
+                    c.execute(store_raw_block, (fileId, compression, block))
+                else:
+                    c.execute(store_raw_block, (fileId, compression, buffer(block)))
+                id = self.get_last_insert_id(c)
+                for row in rows:
+                    row[1] = id
+                c.executemany(store_raw_hands, rows)
+                rows, texts, size = [], [], 0
+
+    def getRawHands(self, handIds):
+        """Return a dict of Hands id to the hand's text for those of handIds in the raw
+           hand archive. Only the blocks holding them are fetched and decompressed."""
+        result = {}
+        c = self.get_cursor()
+        handIds = list(handIds)
+        for i in xrange(0, len(handIds), 500):
+            q = self.sql.query['get_raw_hands'].replace('<hand_ids>', ",".join([str(int(h)) for h in handIds[i:i+500]]))
+            c.execute(q)
+            for (hid, blockId, start, length) in sorted(c.fetchall(), key=lambda r: r[1]):
+                # decoded straight from the block, the hand is not copied out first
+                result[hid] = unicode(buffer(self.getRawBlock(blockId), start, length), 'utf-8')
+        return result
+
+    def getRawBlock(self, blockId):
+        """Return the uncompressed text of a RawHandBlocks block"""
+        if blockId in self.rawcache:
+            return self.rawcache.get(blockId)
+        q = self.sql.query['get_raw_block'].replace('%s', self.sql.query['placeholder'])
+        c = self.get_cursor()
+        c.execute(q, (blockId,))
+        (compression, block) = c.fetchone()
+        block = RAW_CODECS[compression][1](block)
+        self.rawcache[blockId] = block
+        return block
+
+    def getRederiveBatch(self, after, size):
+        """Return [handId, site name, text] of the next size hands after Hands id after
+           in the raw hand archive"""
+        q = self.sql.query['get_rederive_batch'].replace('%s', self.sql.query['placeholder'])
+        c = self.get_cursor()
+        c.execute(q, (after, size))
+        hands = [list(r) for r in c.fetchall()]
+        texts = self.getRawHands([h[0] for h in hands])
+        for hand in hands:
+            hand.append(texts[hand[0]])
+        return hands
+
+    def getHandsPlayersColumns(self):
+        """Return the names of the columns of HandsPlayers, in lower case"""
+        c = self.get_cursor()
+        c.execute(self.sql.query['get_handsplayers_columns'])
+        return [desc[0].lower() for desc in c.description]
+
+    def getRederiveResume(self):
+        c = self.get_cursor()
+        c.execute(self.sql.query['getRederiveResume'])
+        return c.fetchone()[0]
+
+    def setRederiveResume(self, handId):
+        c = self.get_cursor()
+        c.execute(self.sql.query['setRederiveResume'].replace('%s', self.sql.query['placeholder']), (handId,))
+
+    def prepRederive(self, columns):
+        """Create the temp table updateHandsPlayersColumns writes through"""
+        c = self.get_cursor()
+        c.execute(self.sql.query['create_RederivedStats'].replace('<columns>', ", ".join(columns)))
+        c.execute(self.sql.query['index_RederivedStats'])
+
+    def updateHandsPlayersColumns(self, columns, rows):
+        """Set columns of HandsPlayers to the values in rows, [handId, playerId] and a value
+           per column. The rows are loaded into a temp table (see prepRederive) and
+           HandsPlayers is updated from it with one statement."""
+        insert = self.sql.query['insert_RederivedStats'].replace('<columns>', ", ".join(columns))
+        insert = insert.replace('<values>', ", ".join([self.sql.query['placeholder']] * (len(columns) + 2)))
+        sets = [self.sql.query['rederive_set'].replace('<column>', col) for col in columns]
+        update = self.sql.query['update_RederivedStats'].replace('<set_clause>', ",\n".join(sets))
+        c = self.get_cursor()
+        c.executemany(insert, rows)
+        c.execute(update)
+        c.execute(self.sql.query['clear_RederivedStats'])
+
+    def endRederive(self):
+        c = self.get_cursor()
+        c.execute(self.sql.query['drop_RederivedStats'])
+
+    def getBytesPerHand(self):
+        """Return the average size of a hand in the files imported so far, or None"""
+        q = self.sql.query['get_bytes_per_hand']
+        q = q.replace('%s', self.sql.query['placeholder'])
+        c = self.get_cursor()
+        c.execute(q, (True,))
+        (size, hands) = c.fetchone()
+        if size and hands:
+            return float(size) / hands
+        return None
+
+    def getFileByPath(self, path, site):
+        """Return (id, bytesRead) of the latest Files row for path, or None"""
+        q = self.sql.query['get_file_by_path']
+        q = q.replace('%s', self.sql.query['placeholder'])
+        c = self.get_cursor()
+        c.execute(q, (path, site))
+        return c.fetchone()
+
     def getHeroIds(self, pids, sitename):
         #Grab playerIds using hero names in HUD_Config.xml
         try:
@@ -2602,90 +3336,159 @@ class Database:
                 results[i][name] = data[i][n]
         return results
     
+    def fetchmanyIter(self, cursor, size = 1000):
+        """Yield the rows of an executed query, fetching size rows at a time"""
+        while True:
+            rows = cursor.fetchmany(size)
+            if not rows:
+                break
+            for row in rows:
+                yield row
+    
     def nextHandId(self):
+        """Return the next unused Hands id of this connection's reserved block,
+           reserving a new block when it is used up. Call useHandId once it is stored."""
+        (next, end, pending) = self.handIds
+        if next >= end:
+            c = self.get_cursor()
+            if self.sql.query['reserveHandIds'] is None:
+                c.execute(self.sql.query['getNextHandId'])
+                next = c.fetchone()[0]
+            else:
+                # the update locks the Settings row until commit, so no one else gets these ids
+                c.execute(self.sql.query['reserveHandIds'], (self.HAND_ID_BLOCK,))
+                c.execute(self.sql.query['getNextHandId'])
+                next = c.fetchone()[0] - self.HAND_ID_BLOCK
+                pending = True
+            self.handIds = (next, next + self.HAND_ID_BLOCK, pending)
+        return next
+
+    def useHandId(self, id):
+        (next, end, pending) = self.handIds
+        self.handIds = (id + 1, end, pending)
+
+    def resetDuplicateIndex(self):
+        self.dupIndex = None
+
+    def refreshDuplicateIndex(self):
+        """Add hands stored since the last refresh to the duplicate index, loading
+           all of Hands on first use. Call once per batch so hands stored by other
+           importers are seen."""
         c = self.get_cursor()
-        c.execute("SELECT max(id) FROM Hands")
-        id = c.fetchone()[0]
-        if not id: id = 0
-        id += 1
-        return id
+        if self.dupIndex is None:
+            self.dupIndex = DuplicateIndex()
+            c.execute(self.sql.query['getHandKeysSince'], (0,))
+            self.dupIndex.load(c)
+        else:
+            c.execute(self.sql.query['getHandKeysSince'], (self.dupIndex.pendingId,))
+            self.dupIndex.add(c)
 
     def isDuplicate(self, gametypeID, siteHandNo):
-        dup = False
+        if self.dupIndex is None:
+            self.refreshDuplicateIndex()
+        return DuplicateIndex.key(gametypeID, siteHandNo) in self.dupIndex
+
+    def findDuplicateHands(self, keys):
+        """Look the (gametypeId, siteHandNo) of hands up in Hands itself and add those
+           found to the duplicate index. For when a unique key violation shows it missed
+           hands another importer committed with ids below those it has read.
+           Returns the number of hands found that the index did not know."""
+        if self.dupIndex is None:
+            self.refreshDuplicateIndex()
+        q = self.sql.query['isAlreadyInDB'].replace('%s', self.sql.query['placeholder'])
         c = self.get_cursor()
-        c.execute(self.sql.query['isAlreadyInDB'], (gametypeID, siteHandNo))
-        result = c.fetchall()
-        if len(result) > 0:
-            dup = True
-        return dup
+        found = []
+        for (gametypeId, siteHandNo) in keys:
+            key = DuplicateIndex.key(gametypeId, siteHandNo)
+            if key not in self.dupIndex:
+                c.execute(q, (gametypeId, siteHandNo))
+                if c.fetchall():
+                    found.append(key)
+        self.dupIndex.addCommitted(found)
+        return len(found)
 
 #################################
 # Finish of NEWIMPORT CODE
 #################################
 
-    # read HandToWrite objects from q and insert into database
-    def insert_queue_hands(self, q, maxwait=10, commitEachHand=True):
+    # read batches of hands from q and insert into database
+    def insert_queue_hands(self, q, store, done, commitHands=1000, commitWait=1000):
+        """Writer thread: store the (handlist, fileId, assembled) batches put on q with
+           store(db, handlist, fileId, assembled), which returns the number of duplicates.
+           Commits every commitHands hands or commitWait ms, whichever comes first, then
+           reports each committed batch with done(fileId, hands, duplicates, failed).
+           A HandToWrite(True) on the queue stops the writer."""
         n,fails,maxTries,firstWait = 0,0,4,0.1
-        sendFinal = False
-        t0 = time()
+        pending = []    # [batch, duplicates] stored since the last commit
+        uncommitted = 0
+        t0 = lastCommit = time()
         while True:
             try:
-                h = q.get(True)  # (True,maxWait) has probs if 1st part of import is all dups
+                item = q.get(True, commitWait / 1000.0)
             except Queue.Empty:
-                # Queue.Empty exception thrown if q was empty for
-                # if q.empty() also possible - no point if testing for Queue.Empty exception
-                # maybe increment a counter and only break after a few times?
-                # could also test threading.active_count() or look through threading.enumerate()
-                # so break immediately if no threads, but count up to X exceptions if a writer
-                # thread is still alive???
-                print _("queue empty too long - writer stopping ...")
-                break
+                item = None
             except:
                 print _("writer stopping, error reading queue:"), str(sys.exc_info())
                 break
-            #print "got hand", str(h.get_finished())
-
-            tries,wait,again = 0,firstWait,True
-            while again:
-                try:
-                    again = False # set this immediately to avoid infinite loops!
-                    if h.get_finished():
-                        # all items on queue processed
-                        sendFinal = True
-                    else:
-                        self.store_the_hand(h)
-                        # optional commit, could be every hand / every N hands / every time a
-                        # commit message received?? mark flag to indicate if commits outstanding
-                        if commitEachHand:
-                            self.commit()
-                        n = n + 1
-                except:
-                    #print "iqh store error", sys.exc_value # debug
-                    self.rollback()
-                    if re.search('deadlock', str(sys.exc_info()[1]), re.I):
-                        # deadlocks only a problem if hudcache is being updated
-                        tries = tries + 1
-                        if tries < maxTries and wait < 5:    # wait < 5 just to make sure
-                            print _("deadlock detected - trying again ...")
-                            sleep(wait)
-                            wait = wait + wait
-                            again = True
-                        else:
-                            print _("Too many deadlocks - failed to store hand"), h.get_siteHandNo()
-                    if not again:
-                        fails = fails + 1
-                        err = traceback.extract_tb(sys.exc_info()[2])[-1]
-                        print _("***Error storing hand:"), err[2]+"("+str(err[1])+"): "+str(sys.exc_info()[1])
-            # finished trying to store hand
-
-            # always reduce q count, whether or not this hand was saved ok
-            q.task_done()
+            finished = isinstance(item, HandToWrite) and item.get_finished()
+
+            batch = None
+            if item is not None and not finished:
+                batch = [item, 0]
+                pending.append(batch)
+                uncommitted += len(item[0])
+            commit = len(pending) > 0 and (batch is None or uncommitted >= commitHands
+                                           or (time() - lastCommit) * 1000 >= commitWait)
+            if batch is not None or commit:
+                ok = self.store_queue_batches(store, pending, batch is not None, commit, maxTries, firstWait)
+                if commit or not ok:
+                    # if not ok everything since the last commit was rolled back
+                    for (b, dups) in pending:
+                        done(b[1], len(b[0]), dups if ok else 0, not ok)
+                    if ok: n += uncommitted
+                    else:  fails += uncommitted
+                    pending, uncommitted, lastCommit = [], 0, time()
+
+            # always reduce q count, whether or not the batch was saved ok
+            if item is not None:
+                q.task_done()
+            if finished:
+                break
         # while True loop
 
-        self.commit()
-        if sendFinal:
-            q.task_done()
         print _("db writer finished: stored %d hands (%d fails) in %.1f seconds") % (n, fails, time()-t0)
+
+    def store_queue_batches(self, store, pending, storeLast, commit, maxTries, firstWait):
+        """Store the last of the pending batches and/or commit. A deadlock rolls back
+           every pending batch, so they are all stored again before retrying."""
+        tries,wait = 0,firstWait
+        batches = pending[-1:] if storeLast else []
+        while True:
+            try:
+                for b in batches:
+                    (handlist, fileId, assembled) = b[0]
+                    b[1] = store(self, handlist, fileId, assembled)
+                if commit:
+                    self.commit()
+                return True
+            except:
+                #print "iqh store error", sys.exc_value # debug
+                self.rollback()
+                # deadlocks only a problem if hudcache is being updated
+                if re.search('deadlock', str(sys.exc_info()[1]), re.I) and tries < maxTries and wait < 5:
+                    print _("deadlock detected - trying again ...")
+                    tries = tries + 1
+                    sleep(wait)
+                    wait = wait + wait
+                    batches = pending
+                elif isinstance(sys.exc_info()[1], FpdbHandDuplicate) and tries < maxTries:
+                    # the store found hands another importer committed, all is stored again without them
+                    tries = tries + 1
+                    batches = pending
+                else:
+                    err = traceback.extract_tb(sys.exc_info()[2])[-1]
+                    print _("***Error storing hand:"), err[2]+"("+str(err[1])+"): "+str(sys.exc_info()[1])
+                    return False
     # end def insert_queue_hands():
 
 
@@ -2702,6 +3505,10 @@ class Database:
         tourneyTypeId = 1
 
         # Check if Tourney exists, and if so retrieve TTypeId : in that case, check values of the ttype
+        cached = self.tcache.get((hand.siteId, hand.tourNo))
+        if cached is not None:
+            self.cachestats['TourneyTypes'][0] += 1
+            return cached[0]
         cursor = self.get_cursor()
         cursor.execute (self.sql.query['getTourneyTypeIdByTourneyNo'].replace('%s', self.sql.query['placeholder']),
                         (hand.tourNo, hand.siteId)
@@ -2710,16 +3517,20 @@ class Database:
         #print "result of fetching TT by number and site:",result
 
         if result:
+            self.cachestats['TourneyTypes'][1] += 1
             tourneyTypeId = result[0]
         else:
             # Check for an existing TTypeId that matches tourney info, if not found create it
             #print "info that we use to get TT by detail:", hand.siteId, hand.buyinCurrency, hand.buyin, hand.fee, hand.gametype['category'], hand.gametype['limitType'], hand.isKO, hand.isRebuy, hand.isAddOn, hand.speed, hand.isShootout, hand.isMatrix
             #print "the query:",self.sql.query['getTourneyTypeId'].replace('%s', self.sql.query['placeholder'])
-            cursor.execute (self.sql.query['getTourneyTypeId'].replace('%s', self.sql.query['placeholder']),
-                            (hand.siteId, hand.buyinCurrency, hand.buyin, hand.fee, hand.gametype['category'],
-                             hand.gametype['limitType'], hand.maxseats, hand.isKO,
-                             hand.isRebuy, hand.isAddOn, hand.speed, hand.isShootout, hand.isMatrix)
-                            )
+            key = (hand.siteId, hand.buyinCurrency, hand.buyin, hand.fee, hand.gametype['category'],
+                   hand.gametype['limitType'], hand.maxseats, hand.isKO,
+                   hand.isRebuy, hand.isAddOn, hand.speed, hand.isShootout, hand.isMatrix)
+            if key in self.ttcache:
+                self.cachestats['TourneyTypes'][0] += 1
+                return self.ttcache[key]
+            self.cachestats['TourneyTypes'][1] += 1
+            cursor.execute (self.sql.query['getTourneyTypeId'].replace('%s', self.sql.query['placeholder']), key)
             result=cursor.fetchone()
             #print "result of fetching TT by details:",result
 
@@ -2733,10 +3544,18 @@ class Database:
                                  hand.isAddOn, hand.speed, hand.isShootout, hand.isMatrix, hand.added, hand.addedCurrency)
                                 )
                 tourneyTypeId = self.get_last_insert_id(cursor)
+            self.cacheAdd(self.ttcache, key, tourneyTypeId)
         return tourneyTypeId
     #end def createTourneyType
 
     def createOrUpdateTourney(self, hand, source):#note: this method is used on Hand and TourneySummary objects
+        # hands never update a tourney, so a cached id is all they need
+        key = (hand.siteId, hand.tourNo)
+        cached = self.tcache.get(key)
+        if source=="HHC" and cached is not None:
+            self.cachestats['Tourneys'][0] += 1
+            return cached[1]
+        self.cachestats['Tourneys'][1] += 1
         cursor = self.get_cursor()
         q = self.sql.query['getTourneyByTourneyNo'].replace('%s', self.sql.query['placeholder'])
         cursor.execute(q, (hand.siteId, hand.tourNo))
@@ -2783,6 +3602,7 @@ class Database:
             else:
                 raise FpdbParseError(_("invalid source in %s") % Database.createOrUpdateTourney)
             tourneyId = self.get_last_insert_id(cursor)
+        self.cacheAdd(self.tcache, key, (hand.tourneyTypeId, tourneyId))
         return tourneyId
     #end def createOrUpdateTourney
 
@@ -2796,6 +3616,14 @@ class Database:
             else:
                 raise FpdbParseError(_("invalid source in %s") % Database.createOrUpdateTourneysPlayers)
 
+            key = (hand.tourneyId, playerId)
+            if source=="HHC":
+                cached = self.tpcache.get(key)
+                if cached is not None:
+                    self.cachestats['TourneysPlayers'][0] += 1
+                    tourneysPlayersIds[player[1]] = cached
+                    continue
+            self.cachestats['TourneysPlayers'][1] += 1
             cursor = self.get_cursor()
             cursor.execute (self.sql.query['getTourneysPlayersByIds'].replace('%s', self.sql.query['placeholder']),
                             (hand.tourneyId, playerId))
@@ -2847,6 +3675,7 @@ class Database:
                                 (hand.tourneyId, playerId, None, None, None,
                                  hand.rebuyCounts[player], hand.addOnCounts[player], hand.koCounts[player]))
                 tourneysPlayersIds[player[1]]=self.get_last_insert_id(cursor)
+            self.cacheAdd(self.tpcache, key, tourneysPlayersIds[player[1]])
         return tourneysPlayersIds
     #end def createOrUpdateTourneysPlayers
 
@@ -2886,7 +3715,7 @@ class Database:
 
 # Class used to hold all the data needed to write a hand to the db
 # mainParser() in fpdb_parse_logic.py creates one of these and then passes it to
-# self.insert_queue_hands()
+# self.insert_queue_hands(), which now only uses it as the finish message
 
 class HandToWrite:
 
@@ -3048,3 +3877,206 @@ class LambdaDict(dict):
         else:
             self.__setitem__(key, self.l(key))
             return self.get(key)
+
+
+class LRUCache:
+    """Dict like cache of at most size items, dropping the least recently used"""
+    def __init__(self, size):
+        self.size = size
+        self.items = OrderedDict()
+
+    def __len__(self):
+        return len(self.items)
+
+    def __contains__(self, key):
+        return key in self.items
+
+    def pop(self, key, default=None):
+        return self.items.pop(key, default)
+
+    def get(self, key, default=None):
+        try:
+            value = self.items.pop(key)
+        except KeyError:
+            return default
+        self.items[key] = value
+        return value
+
+    def __setitem__(self, key, value):
+        self.items.pop(key, None)
+        self.items[key] = value
+        if len(self.items) > self.size:
+            self.items.popitem(last=False)
+
+
+class DuplicateIndex:
+    """Sorted array of hashes of the (gametypeId, siteHandNo) of the hands in the db,
+       8 bytes a hand. The hashes have 52 bits so even with millions of hands a
+       false duplicate is vanishingly unlikely.
+       Hands read since the last commit are kept in pending, as a rollback of our
+       own inserts means they were never stored."""
+
+    MAXRECENT = 10000   # hashes kept in a set before they are merged into the array
+
+    def __init__(self):
+        self.hashes = array('d')
+        self.recent = set()     # committed, not merged into hashes yet
+        self.pending = set()
+        self.lastId = 0
+        self.pendingId = 0
+
+    @staticmethod
+    def key(gametypeId, siteHandNo):
+        """Hash of a hand, a float so it fits the 'd' array on every platform.
+           Some sites have hand numbers that are not numeric, e.g. 'T5177011761'"""
+        try:
+            siteHandNo = long(siteHandNo)
+        except ValueError:
+            pass
+        return float(int(hashlib.md5("%d %s" % (int(gametypeId), siteHandNo)).hexdigest()[:13], 16))
+
+    def __contains__(self, key):
+        i = bisect_left(self.hashes, key)
+        if i < len(self.hashes) and self.hashes[i] == key:
+            return True
+        return key in self.recent or key in self.pending
+
+    def load(self, cursor):
+        """Fill the index from (id, gametypeId, siteHandNo) rows"""
+        keys = []
+        rows = cursor.fetchmany(10000)
+        while rows:
+            for (id, gametypeId, siteHandNo) in rows:
+                keys.append(DuplicateIndex.key(gametypeId, siteHandNo))
+                self.lastId = max(self.lastId, id)
+            rows = cursor.fetchmany(10000)
+        keys.sort()
+        self.hashes = array('d', keys)
+        self.pendingId = self.lastId
+
+    def add(self, cursor):
+        """Add (id, gametypeId, siteHandNo) rows read since the last commit"""
+        for (id, gametypeId, siteHandNo) in cursor.fetchall():
+            self.pending.add(DuplicateIndex.key(gametypeId, siteHandNo))
+            self.pendingId = max(self.pendingId, id)
+
+    def commit(self):
+        self.recent.update(self.pending)
+        self.pending = set()
+        self.lastId = self.pendingId
+        if len(self.recent) > max(self.MAXRECENT, len(self.hashes) / 8):
+            keys = self.hashes.tolist()
+            keys.extend(self.recent)
+            keys.sort()
+            self.hashes = array('d', keys)
+            self.recent = set()
+
+    def rollback(self):
+        self.pending = set()
+        self.pendingId = self.lastId
+
+    def addCommitted(self, keys):
+        """Add hashes of hands that other connections committed, they stay after a rollback"""
+        self.recent.update(keys)
+
+
+class HudStatCache:
+    """Totals of get_stats_from_hand_aggregated by player, kept by the HUD so a new hand
+       only adds its own stats to them instead of the players' HudCache being summed
+       again. An entry is keyed by playerId and (gametypeId, styleKey, agg_bb_mult,
+       seats_min, seats_max), the parameters of the query for that player.
+       Entries are loaded from the db again after TTL seconds, which picks up hands
+       the HUD was never sent, e.g. from a bulk import."""
+
+    TTL = 600
+    COMMIT_WINDOW = 3600    # seconds a hand's importTime may be older than its commit
+
+    def __init__(self):
+        self.entries = {}       # playerId -> {key: [stats, loaded at utc, loaded at, seat known, hands added, hands loaded]}
+        self.gametypes = {}     # (gametypeId, agg_bb_mult) -> gametypeIds aggregated with it
+        self.known = set()      # gametypeIds that existed when the sets in gametypes were read
+        self.hits = 0
+        self.misses = 0
+
+    def similar(self, db, gametypeId, agg_bb_mult):
+        key = (gametypeId, agg_bb_mult)
+        if key not in self.gametypes:
+            self.gametypes[key] = db.get_similar_gametypes(gametypeId, agg_bb_mult)
+        return self.gametypes[key]
+
+    def add(self, db, hand, rows):
+        """Add the stats of hand, rows from Database.get_stats_deltas(), to the entries of
+           its players that it is counted in and that do not include it yet, i.e. that were
+           loaded before it was committed and it was not added to since"""
+        for (pid, (info, stats)) in rows.iteritems():
+            if info['gametype_id'] not in self.known:
+                # a new gametype, it may have to be aggregated with those already read
+                self.gametypes = {}
+                self.known.add(info['gametype_id'])
+            for (key, entry) in self.entries.get(pid, {}).iteritems():
+                (gametypeId, stylekey, agg_bb_mult, seats_min, seats_max) = key
+                if (info['import_time'] < entry[1] or hand in entry[5] or hand in entry[4]
+                        or info['stylekey'] <= stylekey
+                        or not seats_min <= info['seats'] <= seats_max
+                        or info['gametype_id'] not in self.similar(db, gametypeId, agg_bb_mult)):
+                    continue
+                totals = entry[0]
+                for (name, value) in stats.iteritems():
+                    totals[name] = (totals.get(name) or 0) + (value or 0)
+                entry[4].add(hand)
+                if info['gametype_id'] == gametypeId:
+                    entry[3] = True
+
+    def key(self, pid, rows, hero_id, params):
+        (stylekey, agg_bb_mult, seats_min, seats_max, wanted) = params[pid == hero_id]
+        if not wanted:
+            return None
+        return (rows[pid][0]['gametype_id'], stylekey, agg_bb_mult, seats_min, seats_max)
+
+    def get(self, hand, rows, hero_id, params):
+        """The stat_dict of the players of hand, None unless all of them are cached.
+           params[True] and params[False] are the (styleKey, agg_bb_mult, seats_min,
+           seats_max, wanted) of the hero and the other players."""
+        now = time()
+        stat_dict = {}
+        for (pid, (info, stats)) in rows.iteritems():
+            key = self.key(pid, rows, hero_id, params)
+            if key is None:
+                continue
+            entry = self.entries.get(pid, {}).get(key)
+            if entry is None or now - entry[2] > self.TTL:
+                self.misses += 1
+                return None
+            if entry[0].get('n'):   # like the query, no row for players without stats
+                t_dict = dict(entry[0])
+                t_dict['player_id'] = pid
+                t_dict['seat'] = info['seat'] if entry[3] else -1
+                t_dict['screen_name'] = info['screen_name']
+                stat_dict[pid] = t_dict
+        self.hits += 1
+        return stat_dict
+
+    def store(self, loaded, rows, hero_id, params, stat_dict, included = ()):
+        """Keep the stats of the players of a hand just read from the db. They include the
+           hands imported before the utc time loaded and of those imported since, the hands
+           in included."""
+        now = time()
+        for pid in self.entries.keys():
+            for (key, entry) in self.entries[pid].items():
+                if now - entry[2] > self.TTL:
+                    del self.entries[pid][key]
+            if not self.entries[pid]:
+                del self.entries[pid]
+        for (pid, (info, stats)) in rows.iteritems():
+            key = self.key(pid, rows, hero_id, params)
+            if key is None:
+                continue
+            t_dict = stat_dict.get(pid)
+            if t_dict is None:
+                entry = [dict.fromkeys(stats, 0), loaded, now, False, set(), included]
+            else:
+                totals = dict(t_dict)
+                for name in ('player_id', 'seat', 'screen_name'):
+                    del totals[name]
+                entry = [totals, loaded, now, t_dict['seat'] != -1, set(), included]
+            self.entries.setdefault(pid, {})[key] = entry
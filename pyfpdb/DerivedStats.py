@@ -185,7 +185,8 @@ class DerivedStats():
             self.handsplayers[player[1]]['sitout'] = False #TODO: implement actual sitout detection
             if hand.gametype["type"]=="tour":
                 self.handsplayers[player[1]]['tourneyTypeId']=hand.tourneyTypeId
-                self.handsplayers[player[1]]['tourneysPlayersIds'] = hand.tourneysPlayersIds[player[1]]
+                # not known yet if the stats are derived before the hand is prepared for the db
+                self.handsplayers[player[1]]['tourneysPlayersIds'] = hand.tourneysPlayersIds.get(player[1])
             else:
                 self.handsplayers[player[1]]['tourneysPlayersIds'] = None
             if player[1] in hand.shown:
@@ -23,6 +23,7 @@ import os
 import sys
 from time import time
 from optparse import OptionParser
+import multiprocessing
 import traceback
 
 #    pyGTK modules
@@ -34,6 +35,7 @@ import gobject
 #    fpdb/FreePokerTools modules
 import fpdb_import
 import Configuration
+import Database
 import Exceptions
 
 import logging
@@ -43,7 +45,7 @@ log = logging.getLogger("importer")
 class GuiBulkImport():
 
     # CONFIGURATION  -  update these as preferred:
-    allowThreads = False  # set to True to try out the threads field
+    allowThreads = True   # threads field sets the number of db writer threads
 
     def dopulse(self):
         self.progressbar.pulse()
@@ -363,6 +365,14 @@ def main(argv=None):
                     help=_("Do the required conversion for %s archive format (ie. as provided by support)") % "Full Tilt Poker")
     parser.add_option("-t", "--testdata", action="store_true", dest="testData", default=False,
                     help=_("Generate and print test data for regression testing"))
+    parser.add_option("-p", "--processes", dest="processes", type="int", default=None,
+                    help=_("Number of processes parsing hand histories, defaults to the number of CPUs when importing a directory"))
+    parser.add_option("-r", "--rederive", dest="rederive", default=None, metavar="COLUMNS",
+                    help=_("Recompute these comma separated HandsPlayers columns from the hands in the raw hand archive"))
+    parser.add_option("-R", "--resume", action="store_true", dest="resume", default=False,
+                    help=_("Carry on with an interrupted --rederive"))
+    parser.add_option("-e", "--estimate", action="store_true", dest="estimate", default=False,
+                    help=_("List the indexes and foreign keys a bulk import that drops them has to rebuild, with the time each is estimated to take"))
     (options, argv) = parser.parse_args(args = argv)
 
     if options.usage == True:
@@ -385,7 +395,18 @@ def main(argv=None):
     settings.update(config.get_import_parameters())
     settings.update(config.get_default_paths())
 
-    if not options.filename:
+    if options.estimate:
+        db = Database.Database(config)
+        db.afterBulkImport(dry_run=True)
+        db.disconnect()
+    elif options.rederive:
+        importer = fpdb_import.Importer(False, settings, config, None)
+        importer.setParseProcesses(options.processes or multiprocessing.cpu_count())
+        columns = [col.strip() for col in options.rederive.split(",") if col.strip()]
+        (hands, errors) = importer.rederiveHandsPlayers(columns, options.resume)
+        importer.closeDBs()
+        print _("Re-derived %d hands (%d failed)") % (hands, errors)
+    elif not options.filename:
         i = GuiBulkImport(settings, config, None)
         main_window = gtk.Window()
         main_window.connect('destroy', destroy)
@@ -401,6 +422,10 @@ def main(argv=None):
         importer.setDropIndexes(_("don't drop"))
         importer.setFailOnError(options.failOnError)
         importer.setThreads(-1)
+        if options.processes is not None:
+            importer.setParseProcesses(options.processes)
+        elif os.path.isdir(os.path.expanduser(options.filename)):
+            importer.setParseProcesses(multiprocessing.cpu_count())
         importer.addBulkImportImportFileOrDir(os.path.expanduser(options.filename), site=options.filtername)
         importer.setCallHud(False)
         if options.starsArchive:
@@ -416,4 +441,5 @@ def main(argv=None):
 
 
 if __name__ == '__main__':
+    multiprocessing.freeze_support()
     sys.exit(main())
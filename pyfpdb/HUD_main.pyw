@@ -194,16 +194,18 @@ class HUD_main(object):
 #    need their own access to the database, but should open their own
 #    if it is required.
         self.db_connection = Database.Database(self.config)
+        self.stat_cache = Database.HudStatCache()   # only the new hand's stats are read for players seen before
 
 #       get hero's screen names and player ids
         self.hero, self.hero_ids = {}, {}
         found = False
 
-        while 1:    # wait for a new hand number on stdin
-            new_hand_id = sys.stdin.readline()
-            new_hand_id = string.rstrip(new_hand_id)
-            log.debug(_("Received hand no %s") % new_hand_id)
-            if new_hand_id == "":           # blank line means quit
+        while 1:    # wait for new hand numbers on stdin
+            # the importer sends the hands it stored in an auto-import tick on one line
+            line = sys.stdin.readline()
+            hand_ids = string.split(line)
+            log.debug(_("Received hand no %s") % line.rstrip())
+            if not hand_ids:                # blank line means quit
                 self.destroy()
                 break # this thread is not always killed immediately with gtk.main_quit()
 
@@ -224,73 +226,94 @@ class HUD_main(object):
                         else:
                             self.hero_ids[site_id] = -1
 
-#        get basic info about the new hand from the db
-#        if there is a db error, complain, skip hand, and proceed
+#        get basic info about the new hands from the db
+#        if there is a db error, complain, skip the hands, and proceed
             log.info(_("HUD_main.read_stdin: hand processing starting ..."))
             try:
-                (table_name, max, poker_game, type, site_id, site_name, num_seats, tour_number, tab_number) = \
-                                self.db_connection.get_table_info(new_hand_id)
+                tables = self.db_connection.get_tables_info(hand_ids)
             except Exception:
-                log.exception(_("db error: skipping %s") % new_hand_id)
+                log.exception(_("db error: skipping %s") % line.rstrip())
+                self.db_connection.connection.rollback()
                 continue
 
-            if type == "tour":   # hand is from a tournament
-                temp_key = "%s Table %s" % (tour_number, tab_number)
-            else:
-                temp_key = table_name
+#        each table is updated once, for the last of its hands. The stats of the hands
+#        before it still go into the stat cache, in the order they were played
+            latest = {}
+            for new_hand_id in sorted(tables):
+                latest[self.table_key(tables[new_hand_id])] = new_hand_id
+            superseded = [new_hand_id for new_hand_id in tables if new_hand_id not in latest.values()]
+
+#        get the stats of all tables at once, using each hud's specific params or
+#        the default params for new huds
+            hands = []
+            for (temp_key, new_hand_id) in latest.iteritems():
+                (table_name, max, poker_game, type, site_id, site_name, num_seats, tour_number, tab_number) = tables[new_hand_id]
+                if temp_key in self.hud_dict:
+                    hud_params = self.hud_dict[temp_key].hud_params
+                else:
+                    hud_params = self.hud_params
+                hands.append((new_hand_id, type, hud_params, self.hero_ids[site_id], num_seats))
+            self.db_connection.init_hud_stat_vars( self.hud_params['hud_days'], self.hud_params['h_hud_days'] )
+            stats = self.db_connection.get_stats_from_hands(hands, self.stat_cache, superseded)
 
-#        Update an existing HUD
-            if temp_key in self.hud_dict:
-                # get stats using hud's specific params and get cards
-                self.db_connection.init_hud_stat_vars( self.hud_dict[temp_key].hud_params['hud_days']
-                                                     , self.hud_dict[temp_key].hud_params['h_hud_days'])
-                stat_dict = self.db_connection.get_stats_from_hand(new_hand_id, type, self.hud_dict[temp_key].hud_params,
-                                                                   self.hero_ids[site_id], num_seats)
-
-                try:
-                    self.hud_dict[temp_key].stat_dict = stat_dict
-                except KeyError:    # HUD instance has been killed off, key is stale
-                    log.error(_('hud_dict[%s] was not found\n') % temp_key)
-                    log.error(_('will not send hand\n'))
-                    # Unlocks table, copied from end of function
-                    self.db_connection.connection.rollback()
-                    return
+            for new_hand_id in sorted(latest.values()):
+                self.read_hand(new_hand_id, tables[new_hand_id], stats[new_hand_id])
+            self.db_connection.connection.rollback()
+
+    def table_key(self, table_info):
+        """The key of the HUD of a table in hud_dict"""
+        (table_name, max, poker_game, type, site_id, site_name, num_seats, tour_number, tab_number) = table_info
+        if type == "tour":   # hand is from a tournament
+            return "%s Table %s" % (tour_number, tab_number)
+        return table_name
+
+    def read_hand(self, new_hand_id, table_info, stat_dict):
+        """Update or create the HUD of the table of a new hand with its stats"""
+        (table_name, max, poker_game, type, site_id, site_name, num_seats, tour_number, tab_number) = table_info
+        temp_key = self.table_key(table_info)
 
-                self.hud_dict[temp_key].cards = self.get_cards(new_hand_id)
-                [aw.update_data(new_hand_id, self.db_connection) for aw in self.hud_dict[temp_key].aux_windows]
-                self.update_HUD(new_hand_id, temp_key, self.config)
+#        Update an existing HUD
+        if temp_key in self.hud_dict:
+            try:
+                self.hud_dict[temp_key].stat_dict = stat_dict
+            except KeyError:    # HUD instance has been killed off, key is stale
+                log.error(_('hud_dict[%s] was not found\n') % temp_key)
+                log.error(_('will not send hand\n'))
+                # Unlocks table, copied from end of function
+                self.db_connection.connection.rollback()
+                return
+
+            self.hud_dict[temp_key].cards = self.get_cards(new_hand_id)
+            [aw.update_data(new_hand_id, self.db_connection) for aw in self.hud_dict[temp_key].aux_windows]
+            self.update_HUD(new_hand_id, temp_key, self.config)
 
 #        Or create a new HUD
-            else:
-                # get stats using default params--also get cards
-                self.db_connection.init_hud_stat_vars( self.hud_params['hud_days'], self.hud_params['h_hud_days'] )
-                stat_dict = self.db_connection.get_stats_from_hand(new_hand_id, type, self.hud_params,
-                                                                   self.hero_ids[site_id], num_seats)
-                cards = self.get_cards(new_hand_id)
-                table_kwargs = dict(table_name=table_name, tournament=tour_number, table_number=tab_number)
-                tablewindow = Tables.Table(self.config, site_name, **table_kwargs)
-                if tablewindow.number is None:
+        else:
+            # get cards, the stats are from the default params
+            cards = self.get_cards(new_hand_id)
+            table_kwargs = dict(table_name=table_name, tournament=tour_number, table_number=tab_number)
+            tablewindow = Tables.Table(self.config, site_name, **table_kwargs)
+            if tablewindow.number is None:
 #        If no client window is found on the screen, complain and continue
-                    if type == "tour":
-                        table_name = "%s %s" % (tour_number, tab_number)
-                    log.error(_("HUD create: table name %s not found, skipping.") % table_name)
+                if type == "tour":
+                    table_name = "%s %s" % (tour_number, tab_number)
+                log.error(_("HUD create: table name %s not found, skipping.") % table_name)
+            else:
+                tablewindow.key = temp_key
+                tablewindow.max = max
+                tablewindow.site = site_name
+                # Test that the table window still exists
+                if hasattr(tablewindow, 'number'):
+                    self.create_HUD(new_hand_id, tablewindow, temp_key, max, poker_game, type, stat_dict, cards)
                 else:
-                    tablewindow.key = temp_key
-                    tablewindow.max = max
-                    tablewindow.site = site_name
-                    # Test that the table window still exists
-                    if hasattr(tablewindow, 'number'):
-                        self.create_HUD(new_hand_id, tablewindow, temp_key, max, poker_game, type, stat_dict, cards)
-                    else:
-                        log.error(_('Table "%s" no longer exists\n') % table_name)
-                        return
+                    log.error(_('Table "%s" no longer exists\n') % table_name)
+                    return
 
-            self.db_connection.connection.rollback()
-            if type == "tour":
-                try:
-                    self.hud_dict[temp_key].table.check_table_no(self.hud_dict[temp_key])
-                except KeyError:
-                    pass
+        if type == "tour":
+            try:
+                self.hud_dict[temp_key].table.check_table_no(self.hud_dict[temp_key])
+            except KeyError:
+                pass
 
     def get_cards(self, new_hand_id):
         cards = self.db_connection.get_cards(new_hand_id)
@@ -254,7 +254,6 @@ dealt   whether they were seen in a 'dealt to' line
                                     int(Decimal(self.gametype['bb'])*100), int(Decimal(self.gametype['bb'])*200), int(self.gametype['maxSeats']), int(self.gametype['ante']))
         # Note: the above data is calculated in db.getGameTypeId
         #       Only being calculated above so we can grab the testdata
-        self.dbid_gt = db.getGameTypeId(self.siteId, self.gametype, printdata = printtest)
         
         if self.tourNo!=None:
             self.tourneyTypeId = db.createTourneyType(self)
@@ -262,10 +261,33 @@ dealt   whether they were seen in a 'dealt to' line
             self.tourneysPlayersIds = db.createOrUpdateTourneysPlayers(self, "HHC")
         #db.commit() #commit these transactions'  
         
+    def __getstate__(self):
+        """Hands parsed in another process are pickled back to the importer without
+           their config, the importer attaches its own"""
+        state = self.__dict__.copy()
+        state['config'] = None
+        return state
+
     def assembleHand(self):
         self.stats.getStats(self)
         self.hands = self.stats.getHands()
         self.handsplayers = self.stats.getHandsPlayers()
+        self.handsactions = self.stats.getHandsActions()
+
+    # what prepInsert() and the insert/cache functions read from an assembled hand
+    storedAttributes = frozenset(['hands', 'handsplayers', 'handsactions', 'handid', 'siteId', 'sitename'
+                                 ,'gametype', 'maxseats', 'players', 'startTime', 'callHud', 'cacheSessions'
+                                 ,'tourNo', 'tourneyId', 'tourneyTypeId', 'tourneysPlayersIds', 'buyin'
+                                 ,'buyinCurrency', 'fee', 'buyInChips', 'isKO', 'koBounty', 'isRebuy', 'isAddOn'
+                                 ,'speed', 'isShootout', 'isMatrix', 'added', 'addedCurrency'])
+
+    def compact(self, keepText = False):
+        """Drop everything of an assembled hand but its hands, handsplayers and handsactions
+           rows and what is needed to look up their ids, so parsing processes send back small
+           records. handText is only kept with keepText, for the raw hand archive."""
+        for name in self.__dict__.keys():
+            if name not in self.storedAttributes and not (keepText and name == 'handText'):
+                del self.__dict__[name]
         
     def getHandId(self, db, id):    
         if db.isDuplicate(self.dbid_gt, self.hands['siteHandNo']):
@@ -296,8 +318,7 @@ dealt   whether they were seen in a 'dealt to' line
     
     def insertHandsActions(self, db, habulk, doinsert = False, printtest = False):
         """ Function to inserts HandsActions into database"""
-        handsactions = self.stats.getHandsActions()
-        habulk = db.storeHandsActions(self.dbid_hands, self.dbid_pids, handsactions, habulk, doinsert, printtest)
+        habulk = db.storeHandsActions(self.dbid_hands, self.dbid_pids, self.handsactions, habulk, doinsert, printtest)
         return habulk
 
     def updateHudCache(self, db, hcbulk, doinsert = False):
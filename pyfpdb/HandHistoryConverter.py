@@ -53,6 +53,7 @@ import Configuration
 class HandHistoryConverter():
 
     READ_CHUNK_SIZE = 10000 # bytes to read at a time from file in tail mode
+    STREAM_CHUNK_SIZE = 1048576 # bytes to read at a time from file in stream mode
 
     # filetype can be "text" or "xml"
     # so far always "text"
@@ -68,11 +69,13 @@ class HandHistoryConverter():
 
     # maybe archive params should be one archive param, then call method in specific converter.   if archive:  convert_archive()
     def __init__( self, config, in_path = '-', out_path = '-', follow=False, index=0
-                , autostart=True, starsArchive=False, ftpArchive=False, sitename="PokerStars"):
+                , autostart=True, starsArchive=False, ftpArchive=False, sitename="PokerStars"
+                , stream=False):
         """\
 in_path   (default '-' = sys.stdin)
 out_path  (default '-' = sys.stdout)
-follow :  whether to tail -f the input"""
+follow :  whether to tail -f the input
+stream :  don't parse in start(), hands are parsed as they are read by iterProcessedHands()"""
 
         self.config = config
         self.import_parameters = self.config.get_import_parameters()
@@ -100,6 +103,7 @@ follow :  whether to tail -f the input"""
         self.out_fh = get_out_fh(out_path, self.import_parameters)
 
         self.follow = follow
+        self.stream = stream
         self.compiledPlayers   = set()
         self.maxseats  = 10
 
@@ -133,6 +137,9 @@ Otherwise, finish at EOF.
         try:
             self.numHands = 0
             self.numErrors = 0
+            if self.stream:
+                # nothing read yet, caller pulls hands through iterProcessedHands()
+                return
             if self.follow:
                 #TODO: See how summary files can be handled on the fly (here they should be rejected as before)
                 log.info(_("Tailing '%s'") % self.in_path)
@@ -278,6 +285,98 @@ which it expects to find at self.re_TailSplitHands -- see for e.g. Everleaf.py.
             log.warn(_("Removing text < 50 characters"))
         return handlist
 
+    def allHandsAsGenerator(self):
+        """Generator of handtexts in the file at self.in_path
+
+Reads the file STREAM_CHUNK_SIZE bytes at a time and splits it on re_SplitHands as
+the data arrives, so memory use is flat however big the file is. Yields the same
+handtexts as allHandsAsList().
+"""
+        archives = []
+        if self.starsArchive == True:
+            log.debug(_("Converting starsArchive format to readable"))
+            archives.append(re.compile('^Hand #\d+', re.MULTILINE))
+        if self.ftpArchive == True:
+            log.debug(_("Converting ftpArchive format to readable"))
+            archives.append(re.compile('\*{20}\s#\s\d+\s\*{20,25}\s+', re.MULTILINE))
+
+        pending = u''   # text read but not cleaned up yet, ends with an incomplete line
+        data = u''      # cleaned up text not yet split into hands
+        hands = 0
+        for chunk in self.readFileChunks():
+            if not pending and not data and not hands:
+                chunk = chunk.lstrip()
+            pending = (pending + chunk).replace('\r\n', '\n')
+            # Only clean up complete lines that are followed by more text, so the archive
+            # regexes and any trailing '\r' never see a line cut in half by the read.
+            end = len(pending.rstrip())
+            cut = pending.rfind('\n', 0, end) + 1
+            if cut == 0:
+                continue
+            data += self.cleanHandsText(pending[:cut], archives)
+            pending = pending[cut:]
+
+            # A splitter ending at the end of data could still grow with the next chunk
+            start = 0
+            for m in self.re_SplitHands.finditer(data):
+                if m.end() == len(data):
+                    break
+                hands += 1
+                yield data[start:m.start()]
+                start = m.end()
+            data = data[start:]
+
+        data += self.cleanHandsText(pending.rstrip(), archives)
+        if not hands and data == "":
+            log.error(_("Read no hands."))
+            return
+        handlist = re.split(self.re_SplitHands, data)
+        # Some HH formats leave dangling text after the split
+        # ie. </game> (split) </session>EOL
+        # Remove this dangler if less than 50 characters and warn in the log
+        if len(handlist[-1]) <= 50:
+            handlist.pop()
+            log.warn(_("Removing text < 50 characters"))
+        for handText in handlist:
+            yield handText
+
+    def cleanHandsText(self, text, archives = []):
+        """Remove archive headers from text before it is split into hands"""
+        for m in archives:
+            text = m.sub('', text)
+        return text
+
+    def iterProcessedHands(self):
+        """Generator of Hand objects parsed from in_path as it is read (stream mode).
+
+numHands and numErrors are updated as hands are yielded. Summary files are small, so
+if the first handtext is a summary the whole file is passed to readSummaryInfo().
+"""
+        starttime = time.time()
+        self.numHands = 0
+        self.numErrors = 0
+        handTexts = self.allHandsAsGenerator()
+        try:
+            for handText in handTexts:
+                if self.numHands == 0 and self.isSummary(handText):
+                    self.parsedObjectType = "Summary"
+                    if not self.readSummaryInfo([handText] + list(handTexts)):
+                        log.warning(_("Error converting summary file '%s' (took %.3f seconds)") % (self.in_path, time.time() - starttime))
+                    return
+                self.numHands += 1
+                try:
+                    hand = self.processHand(handText)
+                except FpdbParseError, e:
+                    self.numErrors += 1
+                    log.warning(_("HHC.start(): processHand failed: Exception msg: '%s'") % e)
+                    log.debug(handText)
+                else:
+                    if hand:
+                        yield hand
+        except IOError, ioe:
+            log.exception(_("Error converting '%s'") % self.in_path)
+        log.info(_("Read %d hands (%d failed) in %.3f seconds") % (self.numHands, self.numErrors, time.time() - starttime))
+
     def processHand(self, handText):
         gametype = self.determineGameType(handText)
         log.debug("gametype %s" % gametype)
@@ -496,14 +595,17 @@ or None if we fail to get the info """
                 log.debug(_("Reading stdin with %s") % self.codepage) # is this necessary? or possible? or what?
                 in_fh = codecs.getreader('cp1252')(sys.stdin)
             else:
+                in_fh = open(self.in_path, 'rb')
+                in_fh.seek(self.index)
+                data = in_fh.read()
+                in_fh.close()
                 for kodec in self.__listof(self.codepage):
                     #print "trying", kodec
                     try:
-                        in_fh = codecs.open(self.in_path, 'r', kodec)
-                        whole_file = in_fh.read()
-                        in_fh.close()
-                        self.obs = whole_file[self.index:]
-                        self.index = len(whole_file)
+                        decoder = self.getDecoder(kodec)
+                        self.obs = decoder.decode(data)
+                        # don't step past a character the site hasn't finished writing
+                        self.index += len(data) - len(decoder.getstate()[0])
                         break
                     except:
                         pass
@@ -514,6 +616,56 @@ or None if we fail to get the info """
             doc = xml.dom.minidom.parse(filename)
             self.doc = doc
 
+    def readFileChunks(self):
+        """Generator of decoded text from in_path, starting at byte offset self.index.
+
+Bytes are decoded incrementally, so a multibyte character split across two reads is
+handled. A partial character at the end of the file (the site is still writing it)
+is left unread. self.index follows the first byte not decoded, so when a codec of
+self.codepage fails part way through, the rest is read with the next one.
+"""
+        if self.in_path == '-':
+            log.debug(_("Reading stdin with %s") % self.codepage)
+            for chunk in iter(lambda: sys.stdin.read(self.STREAM_CHUNK_SIZE), ''):
+                yield chunk.decode('cp1252')
+            return
+        in_fh = open(self.in_path, 'rb')
+        try:
+            for kodec in self.__listof(self.codepage):
+                try:
+                    decoder = self.getDecoder(kodec)
+                except LookupError:
+                    continue
+                in_fh.seek(self.index)
+                pos = self.index
+                try:
+                    for data in iter(lambda: in_fh.read(self.STREAM_CHUNK_SIZE), ''):
+                        chunk = decoder.decode(data)
+                        pos += len(data)
+                        self.index = pos - len(decoder.getstate()[0])
+                        if chunk:
+                            yield chunk
+                    return
+                except UnicodeDecodeError:
+                    log.info(_("%s can't be read as %s from byte %d, trying the next codec") % (self.in_path, kodec, self.index))
+            log.error(_("unable to read file with any codec in list!") + " " + self.in_path)
+        finally:
+            in_fh.close()
+
+    def getDecoder(self, kodec):
+        """Return an incremental decoder for reading in_path from byte offset self.index.
+A utf-16 file only has its BOM at the start, so when resuming part way through the
+byte order is taken from the start of the file."""
+        if self.index > 0 and codecs.lookup(kodec).name == 'utf-16':
+            in_fh = open(self.in_path, 'rb')
+            bom = in_fh.read(2)
+            in_fh.close()
+            if bom == codecs.BOM_UTF16_BE:
+                kodec = 'utf-16-be'
+            else:
+                kodec = 'utf-16-le'
+        return codecs.getincrementaldecoder(kodec)()
+
     def guessMaxSeats(self, hand):
         """Return a guess at maxseats when not specified in HH."""
         # if some other code prior to this has already set it, return it
@@ -553,6 +705,7 @@ or None if we fail to get the info """
         return self.out_path
 
     def getLastCharacterRead(self):
+        """Return the byte offset in in_path reading stopped at"""
         return self.index
 
     def isSummary(self, topline):
@@ -87,6 +87,8 @@ class Hud:
         self.stat_windows  = {}
         self.popup_windows = {}
         self.aux_windows   = []
+        self.stat_results  = {}     # player_id -> (stat_dict entry of the player, {stat: result})
+        self.parsed_colors = {}     # colour spec -> gtk.gdk.Color
 
         # configure default font and colors from the configuration
         (font, font_size) = config.get_default_font(self.table.site)
@@ -94,8 +96,8 @@ class Hud:
         self.hud_ui     = config.get_hud_ui_parameters()
         self.site_params = config.get_site_parameters(self.table.site)
 
-        self.backgroundcolor = gtk.gdk.color_parse(self.colors['hudbgcolor'])
-        self.foregroundcolor = gtk.gdk.color_parse(self.colors['hudfgcolor'])
+        self.backgroundcolor = self.parse_color(self.colors['hudbgcolor'])
+        self.foregroundcolor = self.parse_color(self.colors['hudfgcolor'])
 
         self.font = pango.FontDescription("%s %s" % (font, font_size))
         # do we need to add some sort of condition here for dealing with a request for a font that doesn't exist?
@@ -658,6 +660,8 @@ class Hud:
             self.stats[config.supported_games[self.poker_game].stats[stat].row] \
                       [config.supported_games[self.poker_game].stats[stat].col] = \
                       config.supported_games[self.poker_game].stats[stat].stat_name
+        # look up the function of each stat once instead of on every update
+        self.stat_funcs = [[Stats.get_stat(stat) if stat else None for stat in row] for row in self.stats]
 
 #        if os.name == "nt": # we call update_table_position() regularly in Windows to see if we're moving around.  See comments on that function for why this isn't done in X.
 #            gobject.timeout_add(500, self.update_table_position)
@@ -668,7 +672,10 @@ class Hud:
             if self.update_table_position() == False: # we got killed by finding our table was gone
                 return
 
-        self.label.modify_fg(gtk.STATE_NORMAL, gtk.gdk.color_parse(self.colors['hudfgcolor']))
+        self.label.modify_fg(gtk.STATE_NORMAL, self.parse_color(self.colors['hudfgcolor']))
+        for player_id in self.stat_results.keys():
+            if player_id not in self.stat_dict:     # left the table
+                del self.stat_results[player_id]
         for s in self.stat_dict:
             try:
                 statd = self.stat_dict[s]
@@ -684,35 +691,57 @@ class Hud:
                 self.create(hand, config, self.stat_dict, self.cards)
                 self.stat_windows[statd['seat']].player_id = statd['player_id']
 
+            # the stats of a player are only computed again when the player's stat_dict changed
+            cached = self.stat_results.get(statd['player_id'])
+            if cached is None or cached[0] != statd:
+                cached = self.stat_results[statd['player_id']] = (statd, {})
+            results = cached[1]
+
             for r in xrange(0, config.supported_games[self.poker_game].rows):
                 for c in xrange(0, config.supported_games[self.poker_game].cols):
                     this_stat = config.supported_games[self.poker_game].stats[self.stats[r][c]]
-                    number = Stats.do_stat(self.stat_dict, player = statd['player_id'], stat = self.stats[r][c])
+                    number = results.get(self.stats[r][c])
+                    if number is None:
+                        number = results[self.stats[r][c]] = self.stat_funcs[r][c](self.stat_dict, statd['player_id'])
                     statstring = "%s%s%s" % (this_stat.hudprefix, str(number[1]), this_stat.hudsuffix)
                     window = self.stat_windows[statd['seat']]
 
                     if this_stat.hudcolor != "":
-                        window.label[r][c].modify_fg(gtk.STATE_NORMAL, gtk.gdk.color_parse(this_stat.hudcolor))
+                        color = this_stat.hudcolor
                     else:
-                        window.label[r][c].modify_fg(gtk.STATE_NORMAL, gtk.gdk.color_parse(self.colors['hudfgcolor']))	
+                        color = self.colors['hudfgcolor']
                     
                     if this_stat.stat_loth != "":
                         if number[0] < (float(this_stat.stat_loth)/100):
-                            window.label[r][c].modify_fg(gtk.STATE_NORMAL, gtk.gdk.color_parse(this_stat.stat_locolor))
+                            color = this_stat.stat_locolor
 
                     if this_stat.stat_hith != "":
                         if number[0] > (float(this_stat.stat_hith)/100):
-                            window.label[r][c].modify_fg(gtk.STATE_NORMAL, gtk.gdk.color_parse(this_stat.stat_hicolor))
+                            color = this_stat.stat_hicolor
 
-                    window.label[r][c].set_text(statstring)
                     if statstring != "xxx": # is there a way to tell if this particular stat window is visible already, or no?
                         unhidewindow = True
                     tip = "%s\n%s\n%s, %s" % (statd['screen_name'], number[5], number[3], number[4])
-                    Stats.do_tip(window.e_box[r][c], tip)
+
+                    # only the widgets whose text, colour or tooltip changed are touched
+                    rendered = window.rendered.get((r, c), (None, None, None))
+                    if color != rendered[1]:
+                        window.label[r][c].modify_fg(gtk.STATE_NORMAL, self.parse_color(color))
+                    if statstring != rendered[0]:
+                        window.label[r][c].set_text(statstring)
+                    if tip != rendered[2]:
+                        Stats.do_tip(window.e_box[r][c], tip)
+                    window.rendered[(r, c)] = (statstring, color, tip)
             if unhidewindow: #and not window.window.visible: # there is no "visible" attribute in gtk.Window, although the docs seem to indicate there should be
                 window.window.show_all()
             unhidewindow = False
 
+    def parse_color(self, color):
+        """gtk.gdk.Color of a colour spec from the config, each one is only parsed once"""
+        if color not in self.parsed_colors:
+            self.parsed_colors[color] = gtk.gdk.color_parse(color)
+        return self.parsed_colors[color]
+
     def topify_window(self, window, parentwindow=None):
         window.set_focus_on_map(False)
         window.set_accept_focus(False)
@@ -787,6 +816,7 @@ class Stat_Window:
         self.player_id = player_id  # looks like this isn't used ;)
         self.sb_click = 0           # used to figure out button clicks
         self.popups = []            # list of open popups for this stat window
+        self.rendered = {}          # (row, col) -> (text, colour, tooltip) last shown in the label
         self.useframes = parent.config.get_frames(parent.site)
 
         self.window = gtk.Window()
@@ -113,6 +113,11 @@ class PartyPoker(HandHistoryConverter):
             return []
         return filter(lambda text: len(text.strip()), list)
 
+    def allHandsAsGenerator(self):
+        for handText in HandHistoryConverter.allHandsAsGenerator(self):
+            if len(handText.strip()):
+                yield handText
+
     def guessMaxSeats(self, hand):
         """Return a guess at max_seats when not specified in HH."""
         mo = self.maxOccSeat(hand)
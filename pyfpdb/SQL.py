@@ -99,15 +99,43 @@ class Sql:
         ################################
         if db_server == 'mysql':
             self.query['createSettingsTable'] = """CREATE TABLE Settings (
-                                        version SMALLINT NOT NULL)
+                                        version SMALLINT NOT NULL,
+                                        nextHandId BIGINT UNSIGNED NOT NULL,
+                                        hudCacheResume CHAR(10),
+                                        hudCacheSlice TEXT,
+                                        rederiveResume BIGINT UNSIGNED)
                                 ENGINE=INNODB"""
         elif db_server == 'postgresql':
-            self.query['createSettingsTable'] =  """CREATE TABLE Settings (version SMALLINT NOT NULL)"""
+            self.query['createSettingsTable'] =  """CREATE TABLE Settings (version SMALLINT NOT NULL, nextHandId BIGINT NOT NULL, hudCacheResume CHAR(10), hudCacheSlice TEXT, rederiveResume BIGINT)"""
 
         elif db_server == 'sqlite':
             self.query['createSettingsTable'] = """CREATE TABLE Settings
-            (version INTEGER NOT NULL) """
+            (version INTEGER NOT NULL, nextHandId INTEGER NOT NULL, hudCacheResume TEXT, hudCacheSlice TEXT, rederiveResume INTEGER) """
             
+        ################################
+        # Create ImportRates
+        ################################
+        # speeds measured by bulk imports: rows per second of each index/foreign key rebuild
+        # by 'table.column', hands per second stored with indexes ('import') and without
+        # them ('import.bulk')
+        if db_server == 'mysql':
+            self.query['createImportRatesTable'] = """CREATE TABLE ImportRates (
+                        name VARCHAR(64) NOT NULL, PRIMARY KEY (name),
+                        rate FLOAT NOT NULL)
+                        ENGINE=INNODB"""
+        elif db_server == 'postgresql':
+            self.query['createImportRatesTable'] = """CREATE TABLE ImportRates (
+                        name VARCHAR(64), PRIMARY KEY (name),
+                        rate FLOAT NOT NULL)"""
+        elif db_server == 'sqlite':
+            self.query['createImportRatesTable'] = """CREATE TABLE ImportRates (
+                        name TEXT NOT NULL PRIMARY KEY,
+                        rate REAL NOT NULL)"""
+
+        self.query['getImportRates'] = """SELECT name, rate FROM ImportRates"""
+        self.query['deleteImportRate'] = """DELETE FROM ImportRates WHERE name = %s"""
+        self.query['insertImportRate'] = """INSERT INTO ImportRates (name, rate) VALUES (%s, %s)"""
+
         ################################
         # Create InsertLock
         ################################
@@ -118,30 +146,61 @@ class Sql:
                         ENGINE=INNODB"""
 
         ################################
-        # Create RawHands (this table is all but identical with RawTourneys)
+        # Create RawHandBlocks
         ################################
+        # hand histories saved compressed, a block of consecutive hands of a file at a time
+        if db_server == 'mysql':
+            self.query['createRawHandBlocks'] = """CREATE TABLE RawHandBlocks (
+                        id BIGINT UNSIGNED AUTO_INCREMENT NOT NULL, PRIMARY KEY (id),
+                        fileId INT UNSIGNED,
+                        compression VARCHAR(8) NOT NULL,
+                        rawBlock LONGBLOB NOT NULL)
+                        ENGINE=INNODB"""
+        elif db_server == 'postgresql':
+            self.query['createRawHandBlocks'] =  """CREATE TABLE RawHandBlocks (
+                        id BIGSERIAL, PRIMARY KEY (id),
+                        fileId INT,
+                        compression VARCHAR(8) NOT NULL,
+                        rawBlock BYTEA NOT NULL)"""
+        elif db_server == 'sqlite':
+            self.query['createRawHandBlocks'] = """CREATE TABLE RawHandBlocks (
+                        id INTEGER PRIMARY KEY,
+                        fileId INT,
+                        compression TEXT NOT NULL,
+                        rawBlock BLOB NOT NULL)"""
+
+        ################################
+        # Create RawHands
+        ################################
+        # where in the uncompressed RawHandBlocks block the text of each hand is
         if db_server == 'mysql':
             self.query['createRawHands'] = """CREATE TABLE RawHands (
                         id BIGINT UNSIGNED AUTO_INCREMENT NOT NULL, PRIMARY KEY (id),
-                        handId BIGINT NOT NULL,
-                        rawHand TEXT NOT NULL,
+                        handId BIGINT NOT NULL, INDEX (handId),
+                        blockId BIGINT UNSIGNED NOT NULL, FOREIGN KEY (blockId) REFERENCES RawHandBlocks(id),
+                        textStart INT NOT NULL,
+                        textLength INT NOT NULL,
                         complain BOOLEAN NOT NULL DEFAULT FALSE)
                         ENGINE=INNODB"""
         elif db_server == 'postgresql':
             self.query['createRawHands'] =  """CREATE TABLE RawHands (
                         id BIGSERIAL, PRIMARY KEY (id),
                         handId BIGINT NOT NULL,
-                        rawHand TEXT NOT NULL,
+                        blockId BIGINT NOT NULL, FOREIGN KEY (blockId) REFERENCES RawHandBlocks(id),
+                        textStart INT NOT NULL,
+                        textLength INT NOT NULL,
                         complain BOOLEAN NOT NULL DEFAULT FALSE)"""
         elif db_server == 'sqlite':
             self.query['createRawHands'] = """CREATE TABLE RawHands (
                         id INTEGER PRIMARY KEY,
                         handId BIGINT NOT NULL,
-                        rawHand TEXT NOT NULL,
+                        blockId INT NOT NULL,
+                        textStart INT NOT NULL,
+                        textLength INT NOT NULL,
                         complain BOOLEAN NOT NULL DEFAULT FALSE)"""
         
         ################################
-        # Create RawTourneys (this table is all but identical with RawHands)
+        # Create RawTourneys
         ################################
         if db_server == 'mysql':
             self.query['createRawTourneys'] = """CREATE TABLE RawTourneys (
@@ -1206,7 +1265,9 @@ class Sql:
                         partial INT,
                         errs INT,
                         ttime100 INT,
-                        finished BOOLEAN)
+                        finished BOOLEAN,
+                        path TEXT,
+                        bytesRead BIGINT)
                         ENGINE=INNODB"""
         elif db_server == 'postgresql':
             self.query['createFilesTable'] = """CREATE TABLE Files (
@@ -1223,7 +1284,9 @@ class Sql:
                         partial INT,
                         errs INT,
                         ttime100 INT,
-                        finished BOOLEAN)"""
+                        finished BOOLEAN,
+                        path TEXT,
+                        bytesRead BIGINT)"""
         elif db_server == 'sqlite':
             self.query['createFilesTable'] = """CREATE TABLE Files (
                         id INTEGER PRIMARY KEY,
@@ -1239,7 +1302,9 @@ class Sql:
                         partial INT,
                         errs INT,
                         ttime100 INT,
-                        finished BOOLEAN
+                        finished BOOLEAN,
+                        path TEXT,
+                        bytesRead INT
                         )""" 
 
         ################################
@@ -1656,6 +1721,18 @@ class Sql:
         elif db_server == 'sqlite':
             self.query['addHandsIndex'] = """CREATE UNIQUE INDEX siteHandNo ON Hands (siteHandNo, gametypeId)"""
 
+        # tourneyTypeId is NULL for cash games, and NULLs never conflict in a unique index, so
+        # postgres and sqlite index COALESCE(tourneyTypeId, 0). mysql has no index expressions.
+        if db_server == 'mysql':
+            self.query['addHudCacheIndex'] = """ALTER TABLE HudCache ADD UNIQUE INDEX hudcache_key(gametypeId, playerId
+                                                , activeSeats, position, tourneyTypeId, styleKey)"""
+        elif db_server == 'postgresql':
+            self.query['addHudCacheIndex'] = """CREATE UNIQUE INDEX hudcache_key ON HudCache (gametypeId, playerId
+                                                , activeSeats, position, COALESCE(tourneyTypeId, 0), styleKey)"""
+        elif db_server == 'sqlite':
+            self.query['addHudCacheIndex'] = """CREATE UNIQUE INDEX hudcache_key ON HudCache (gametypeId, playerId
+                                                , activeSeats, position, COALESCE(tourneyTypeId, 0), styleKey)"""
+
         if db_server == 'mysql':
             self.query['addPlayersIndex'] = """ALTER TABLE Players ADD UNIQUE INDEX name(name, siteId)"""
         elif db_server == 'postgresql':
@@ -1991,6 +2068,148 @@ class Sql:
                 #  where %s is the number of active players at the current table (and
                 #  1.25 would be a config value so user could change it)
 
+#    get_stats_from_hand_aggregated of several hands at once, the first column is the hand id
+#    each edit must match the query above exactly once, so a change to it can't leave this behind
+        q = self.query['get_stats_from_hand_aggregated']
+        for (old, new) in (("SELECT hc.playerId ", "SELECT h.id                              AS hand_id,\n                       hc.playerId ")
+                          ,("WHERE h.id = %s", "WHERE h.id in (<hand_ids>)")
+                          ,("GROUP BY hc.PlayerId", "GROUP BY h.id, hc.PlayerId")
+                          ,("ORDER BY hc.PlayerId", "ORDER BY h.id, hc.PlayerId")):
+            assert q.count(old) == 1, "get_stats_from_hands_aggregated: %r" % old
+            q = q.replace(old, new)
+        self.query['get_stats_from_hands_aggregated'] = q
+
+#    the latest hands committed, for the HUD's stat cache to tell which of them its totals include
+        self.query['get_last_import_time'] = """SELECT max(importTime) FROM Hands"""
+        self.query['get_hands_imported_since'] = """SELECT id FROM Hands WHERE importTime >= %s"""
+
+#    the stats of a single hand with the columns of get_stats_from_hand_aggregated, which the
+#    HUD's stat cache adds to the totals it already has for the players
+        self.query['get_stats_from_hand_delta'] = """
+                SELECT h.id                                                    AS hand_id,
+                       hp.playerId                                             AS player_id,
+                       hp.seatNo                                               AS seat,
+                       p.name                                                  AS screen_name,
+                       h.gametypeId                                            AS gametype_id,
+                       h.seats                                                 AS seats,
+                       h.startTime                                             AS start_time,
+                       h.importTime                                            AS import_time,
+                       hp.position                                             AS position,
+                       t.tourneyTypeId                                         AS tourney_type_id,
+                       1                                                       AS n,
+                       cast(hp.street0VPI as <signed>integer)                  AS vpip,
+                       cast(hp.street0Aggr as <signed>integer)                 AS pfr,
+                       cast(hp.street0_3BChance as <signed>integer)            AS TB_opp_0,
+                       cast(hp.street0_3BDone as <signed>integer)              AS TB_0,
+                       cast(hp.street0_4BChance as <signed>integer)            AS FB_opp_0,
+                       cast(hp.street0_4BDone as <signed>integer)              AS FB_0,
+                       cast(hp.street0_C4BChance as <signed>integer)           AS CFB_opp_0,
+                       cast(hp.street0_C4BDone as <signed>integer)             AS CFB_0,
+                       cast(hp.street0_FoldTo3BChance as <signed>integer)      AS F3B_opp_0,
+                       cast(hp.street0_FoldTo3BDone as <signed>integer)        AS F3B_0,
+                       cast(hp.street0_FoldTo4BChance as <signed>integer)      AS F4B_opp_0,
+                       cast(hp.street0_FoldTo4BDone as <signed>integer)        AS F4B_0,
+                       cast(hp.street0_SqueezeChance as <signed>integer)       AS SQZ_opp_0,
+                       cast(hp.street0_SqueezeDone as <signed>integer)         AS SQZ_0,
+                       cast(hp.raiseToStealChance as <signed>integer)          AS RTS_opp,
+                       cast(hp.raiseToStealDone as <signed>integer)            AS RTS,
+                       cast(hp.success_Steal as <signed>integer)               AS SUC_ST,
+                       cast(hp.street1Seen as <signed>integer)                 AS saw_f,
+                       cast(hp.street1Seen as <signed>integer)                 AS saw_1,
+                       cast(hp.street2Seen as <signed>integer)                 AS saw_2,
+                       cast(hp.street3Seen as <signed>integer)                 AS saw_3,
+                       cast(hp.street4Seen as <signed>integer)                 AS saw_4,
+                       cast(hp.sawShowdown as <signed>integer)                 AS sd,
+                       cast(hp.street1Aggr as <signed>integer)                 AS aggr_1,
+                       cast(hp.street2Aggr as <signed>integer)                 AS aggr_2,
+                       cast(hp.street3Aggr as <signed>integer)                 AS aggr_3,
+                       cast(hp.street4Aggr as <signed>integer)                 AS aggr_4,
+                       cast(hp.otherRaisedStreet1 as <signed>integer)          AS was_raised_1,
+                       cast(hp.otherRaisedStreet2 as <signed>integer)          AS was_raised_2,
+                       cast(hp.otherRaisedStreet3 as <signed>integer)          AS was_raised_3,
+                       cast(hp.otherRaisedStreet4 as <signed>integer)          AS was_raised_4,
+                       cast(hp.foldToOtherRaisedStreet1 as <signed>integer)    AS f_freq_1,
+                       cast(hp.foldToOtherRaisedStreet2 as <signed>integer)    AS f_freq_2,
+                       cast(hp.foldToOtherRaisedStreet3 as <signed>integer)    AS f_freq_3,
+                       cast(hp.foldToOtherRaisedStreet4 as <signed>integer)    AS f_freq_4,
+                       cast(hp.wonWhenSeenStreet1 as <signed>integer)          AS w_w_s_1,
+                       cast(hp.wonAtSD as <signed>integer)                     AS wmsd,
+                       cast(hp.raiseFirstInChance as <signed>integer)          AS steal_opp,
+                       cast(hp.raisedFirstIn as <signed>integer)               AS steal,
+                       cast(hp.foldSbToStealChance as <signed>integer)         AS SBstolen,
+                       cast(hp.foldedSbToSteal as <signed>integer)             AS SBnotDef,
+                       cast(hp.foldBbToStealChance as <signed>integer)         AS BBstolen,
+                       cast(hp.foldedBbToSteal as <signed>integer)             AS BBnotDef,
+                       cast(hp.street1CBChance as <signed>integer)             AS CB_opp_1,
+                       cast(hp.street1CBDone as <signed>integer)               AS CB_1,
+                       cast(hp.street2CBChance as <signed>integer)             AS CB_opp_2,
+                       cast(hp.street2CBDone as <signed>integer)               AS CB_2,
+                       cast(hp.street3CBChance as <signed>integer)             AS CB_opp_3,
+                       cast(hp.street3CBDone as <signed>integer)               AS CB_3,
+                       cast(hp.street4CBChance as <signed>integer)             AS CB_opp_4,
+                       cast(hp.street4CBDone as <signed>integer)               AS CB_4,
+                       cast(hp.foldToStreet1CBChance as <signed>integer)       AS f_cb_opp_1,
+                       cast(hp.foldToStreet1CBDone as <signed>integer)         AS f_cb_1,
+                       cast(hp.foldToStreet2CBChance as <signed>integer)       AS f_cb_opp_2,
+                       cast(hp.foldToStreet2CBDone as <signed>integer)         AS f_cb_2,
+                       cast(hp.foldToStreet3CBChance as <signed>integer)       AS f_cb_opp_3,
+                       cast(hp.foldToStreet3CBDone as <signed>integer)         AS f_cb_3,
+                       cast(hp.foldToStreet4CBChance as <signed>integer)       AS f_cb_opp_4,
+                       cast(hp.foldToStreet4CBDone as <signed>integer)         AS f_cb_4,
+                       cast(hp.totalProfit as <signed>integer)                 AS net,
+                       gt.bigblind                                             AS bigblind,
+                       cast(hp.street1CheckCallRaiseChance as <signed>integer) AS ccr_opp_1,
+                       cast(hp.street1CheckCallRaiseDone as <signed>integer)   AS ccr_1,
+                       cast(hp.street2CheckCallRaiseChance as <signed>integer) AS ccr_opp_2,
+                       cast(hp.street2CheckCallRaiseDone as <signed>integer)   AS ccr_2,
+                       cast(hp.street3CheckCallRaiseChance as <signed>integer) AS ccr_opp_3,
+                       cast(hp.street3CheckCallRaiseDone as <signed>integer)   AS ccr_3,
+                       cast(hp.street4CheckCallRaiseChance as <signed>integer) AS ccr_opp_4,
+                       cast(hp.street4CheckCallRaiseDone as <signed>integer)   AS ccr_4,
+                       cast(hp.street0Calls as <signed>integer)                AS call_0,
+                       cast(hp.street1Calls as <signed>integer)                AS call_1,
+                       cast(hp.street2Calls as <signed>integer)                AS call_2,
+                       cast(hp.street3Calls as <signed>integer)                AS call_3,
+                       cast(hp.street4Calls as <signed>integer)                AS call_4,
+                       cast(hp.street0Bets as <signed>integer)                 AS bet_0,
+                       cast(hp.street1Bets as <signed>integer)                 AS bet_1,
+                       cast(hp.street2Bets as <signed>integer)                 AS bet_2,
+                       cast(hp.street3Bets as <signed>integer)                 AS bet_3,
+                       cast(hp.street4Bets as <signed>integer)                 AS bet_4,
+                       cast(hp.street0Raises as <signed>integer)               AS raise_0,
+                       cast(hp.street1Raises as <signed>integer)               AS raise_1,
+                       cast(hp.street2Raises as <signed>integer)               AS raise_2,
+                       cast(hp.street3Raises as <signed>integer)               AS raise_3,
+                       cast(hp.street4Raises as <signed>integer)               AS raise_4
+                FROM Hands h
+                     INNER JOIN HandsPlayers hp ON (hp.handId = h.id)
+                     INNER JOIN Players p       ON (p.id = hp.playerId)
+                     INNER JOIN Gametypes gt    ON (gt.id = h.gametypeId)
+                     LEFT JOIN Tourneys t       ON (t.id = h.tourneyId)
+                WHERE h.id in (<hand_ids>)
+            """
+
+#    HudCache rows created by a single hand: it is the only one counted in them
+        self.query['get_hudcache_new_rows'] = """
+                SELECT playerId, gametypeId, activeSeats, styleKey, position, tourneyTypeId
+                FROM HudCache
+                WHERE styleKey in (<style_keys>)
+                AND   HDs = 1
+                AND   playerId in (<player_ids>)
+            """
+
+#    gametypes aggregated with a gametype by get_stats_from_hand_aggregated
+        self.query['get_similar_gametypes'] = """
+                SELECT gt1.id from Gametypes gt1, Gametypes gt2
+                WHERE  gt1.siteid = gt2.siteid
+                AND    gt1.type = gt2.type
+                AND    gt1.category = gt2.category
+                AND    gt1.limittype = gt2.limittype
+                AND    gt1.bigblind <= gt2.bigblind * %s
+                AND    gt1.bigblind >= gt2.bigblind / %s
+                AND    gt2.id = %s
+            """
+
         if db_server == 'mysql':
             self.query['get_stats_from_hand_session'] = """
                     SELECT hp.playerId                                              AS player_id, /* playerId and seats must */
@@ -2371,6 +2590,17 @@ class Sql:
                 GROUP BY h.tableName, gt.maxSeats, gt.category, gt.type, s.id, s.name
             """
 
+        self.query['get_tables_name'] = """
+                SELECT h.id, h.tableName, gt.maxSeats, gt.category, gt.type, s.id, s.name
+                     , count(1) as numseats
+                FROM Hands h, Gametypes gt, Sites s, HandsPlayers hp
+                WHERE h.id in (<hand_ids>)
+                    AND   gt.id = h.gametypeId
+                    AND   s.id = gt.siteID
+                    AND   hp.handId = h.id
+                GROUP BY h.id, h.tableName, gt.maxSeats, gt.category, gt.type, s.id, s.name
+            """
+
         self.query['get_actual_seat'] = """
                 select seatNo
                 from HandsPlayers
@@ -3679,6 +3909,28 @@ class Sql:
         ####################################
       
         self.query['clearHudCache'] = """DELETE FROM HudCache"""
+
+        # styleKeys are 'dYYMMDD' so a range of them is a range of days
+        self.query['clearHudCacheSlice'] = """DELETE FROM HudCache
+                                               WHERE styleKey >= %s AND styleKey < %s
+                                               <gametype_clause>"""
+
+        self.query['getHandsDateRange'] = """SELECT min(startTime), max(startTime) FROM Hands"""
+
+        # date a chunked hudcache rebuild has got to and the slice of the cache it rebuilds,
+        # NULL once it is done
+        self.query['getHudCacheResume'] = """SELECT hudCacheResume, hudCacheSlice FROM Settings"""
+        self.query['setHudCacheResume'] = """UPDATE Settings SET hudCacheResume = %s, hudCacheSlice = %s"""
+
+        # startTime moved by <minutes>, to the time of day the hudcache's days start
+        if db_server == 'mysql':
+            self.query['hudCacheStyleTime'] = """DATE_ADD(h.startTime, INTERVAL <minutes> MINUTE)"""
+        elif db_server == 'postgresql':
+            self.query['hudCacheStyleTime'] = """(h.startTime + INTERVAL '<minutes> minutes')"""
+        elif db_server == 'sqlite':
+            self.query['hudCacheStyleTime'] = """datetime(h.startTime, '<minutes> minutes')"""
+
+        self.query['getHandsStartAfter'] = """SELECT min(startTime) FROM Hands WHERE id > %s"""
        
         if db_server == 'mysql':
             self.query['rebuildHudCache'] = """
@@ -3796,7 +4048,7 @@ class Sql:
                             else 'E'
                        end                                            AS hc_position
                       <tourney_select_clause>
-                      ,date_format(h.startTime, 'd%y%m%d')
+                      ,date_format(<style_time>, 'd%y%m%d')
                       ,count(1)
                       ,sum(wonWhenSeenStreet1)
                       ,sum(wonWhenSeenStreet2)
@@ -3894,7 +4146,7 @@ class Sql:
                         ,h.seats
                         ,hc_position
                         <tourney_group_clause>
-                        ,date_format(h.startTime, 'd%y%m%d')
+                        ,date_format(<style_time>, 'd%y%m%d')
 """
         elif db_server == 'postgresql':
             self.query['rebuildHudCache'] = """
@@ -4012,7 +4264,7 @@ class Sql:
                             else 'E'
                        end                                            AS hc_position
                       <tourney_select_clause>
-                      ,'d' || to_char(h.startTime, 'YYMMDD')
+                      ,'d' || to_char(<style_time>, 'YYMMDD')
                       ,count(1)
                       ,sum(wonWhenSeenStreet1)
                       ,sum(wonWhenSeenStreet2)
@@ -4110,7 +4362,7 @@ class Sql:
                         ,h.seats
                         ,hc_position
                         <tourney_group_clause>
-                        ,to_char(h.startTime, 'YYMMDD')
+                        ,to_char(<style_time>, 'YYMMDD')
 """
         else:   # assume sqlite
             self.query['rebuildHudCache'] = """
@@ -4228,7 +4480,7 @@ class Sql:
                             else 'E'
                        end                                            AS hc_position
                       <tourney_select_clause>
-                      ,'d' || substr(strftime('%Y%m%d', h.startTime),3,7)
+                      ,'d' || substr(strftime('%Y%m%d', <style_time>),3,7)
                       ,count(1)
                       ,sum(wonWhenSeenStreet1)
                       ,sum(wonWhenSeenStreet2)
@@ -4326,7 +4578,7 @@ class Sql:
                         ,h.seats
                         ,hc_position
                         <tourney_group_clause>
-                        ,'d' || substr(strftime('%Y%m%d', h.startTime),3,7)
+                        ,'d' || substr(strftime('%Y%m%d', <style_time>),3,7)
 """
 
         self.query['insert_hudcache'] = """
@@ -4445,6 +4697,25 @@ class Sql:
                     %s, %s, %s, %s, %s,
                     %s, %s, %s, %s)"""
 
+        # Same columns as insert_hudcache, <values> is replaced with one or more rows of
+        # placeholders. Conflicts on the hudcache_key index add the new stats to the row.
+        hudcache_cols = self.query['insert_hudcache'].split('(')[1].split(')')[0].replace(',', ' ').split()
+        if db_server == 'mysql':
+            self.query['upsert_hudcache'] = """
+            INSERT INTO HudCache (%s)
+            VALUES <values>
+            ON DUPLICATE KEY UPDATE
+            %s""" % (", ".join(hudcache_cols)
+                    ,",\n            ".join(["%s=%s+VALUES(%s)" % (c, c, c) for c in hudcache_cols[6:]]))
+        else:
+            self.query['upsert_hudcache'] = """
+            INSERT INTO HudCache (%s)
+            VALUES <values>
+            ON CONFLICT (gametypeId, playerId, activeSeats, position, COALESCE(tourneyTypeId, 0), styleKey)
+            DO UPDATE SET
+            %s""" % (", ".join(hudcache_cols)
+                    ,",\n            ".join(["%s=HudCache.%s+EXCLUDED.%s" % (c, c, c) for c in hudcache_cols[6:]]))
+
         self.query['update_hudcache'] = """
             UPDATE HudCache SET
             HDs=HDs+%s,
@@ -4542,11 +4813,24 @@ class Sql:
             AND   (case when tourneyTypeId is NULL then 1 else 
                    (case when tourneyTypeId+0=%s then 1 else 0 end) end)=1
             AND   styleKey=%s"""
+
+        # keys of the HudCache rows of some gametypes and players, <gametypeid_list> and
+        # <playerid_list> are replaced with lists of placeholders
+        self.query['select_hudcache_keys'] = """
+            SELECT gametypeId, playerId, activeSeats, position, tourneyTypeId, styleKey
+            FROM HudCache
+            WHERE gametypeId IN <gametypeid_list>
+            AND   playerId IN <playerid_list>"""
             
         self.query['get_hero_hudcache_start'] = """select min(hc.styleKey)
                                                    from HudCache hc
                                                    where hc.playerId in <playerid_list>
                                                    and   hc.styleKey like 'd%'"""
+
+        self.query['get_villain_hudcache_start'] = """select min(hc.styleKey)
+                                                   from HudCache hc
+                                                   where hc.playerId not in <playerid_list>
+                                                   and   hc.styleKey like 'd%'"""
             
         ####################################
         # Queries to rebuild/modify sessionscache
@@ -4563,7 +4847,7 @@ class Sql:
                     HandsPlayers.totalProfit as totalProfit,
                     Tourneys.tourneyTypeId as tourneyTypeId
                     FROM Gametypes, HandsPlayers, Hands
-                    LEFT JOIN Tourneys ON Hands.tourneyId = Tourneys.tourneyTypeId
+                    LEFT JOIN Tourneys ON Hands.tourneyId = Tourneys.id
                     WHERE HandsPlayers.handId = Hands.id
                     AND   Hands.gametypeId = Gametypes.id
                     AND (case when HandsPlayers.playerId = <where_clause> then 1 else 0 end) = 1
@@ -4606,6 +4890,25 @@ class Sql:
                     sessionEnd=%s
                     WHERE sessionId=%s"""
                     
+        self.query['select_SC_range'] = """
+                    SELECT id,
+                    sessionStart,
+                    sessionEnd,
+                    gameStart,
+                    gameEnd,
+                    sessionId,
+                    date,
+                    type,
+                    gametypeId,
+                    tourneyTypeId,
+                    playerId,
+                    hands,
+                    tourneys,
+                    totalProfit
+                    FROM SessionsCache
+                    WHERE gameEnd>=%s
+                    AND gameStart<=%s"""
+
         self.query['update_SC'] = """
                     UPDATE SessionsCache SET 
                     sessionStart=%s,
@@ -4681,7 +4984,85 @@ class Sql:
         self.query['delete_SC'] = """
                     DELETE FROM SessionsCache
                     WHERE id=%s"""
-        
+
+        self.query['rebuild_SC'] = """
+                    insert into SessionsCache (
+                    id,
+                    sessionStart,
+                    sessionEnd,
+                    gameStart,
+                    gameEnd,
+                    sessionId,
+                    date,
+                    type,
+                    gametypeId,
+                    tourneyTypeId,
+                    playerId,
+                    hands,
+                    tourneys,
+                    totalProfit)
+                    values (%s, %s, %s, %s, %s, %s, %s,
+                            %s, %s, %s, %s, %s, %s, %s)"""
+
+        if db_server == 'postgresql':
+            self.query['reset_SC_id'] = """
+                    SELECT setval('sessionscache_id_seq', (SELECT max(id) FROM SessionsCache))"""
+        else:
+            self.query['reset_SC_id'] = None
+
+        # temp table mapping each hand to its session for the set-based update
+        if db_server == 'mysql':
+            self.query['create_SessionsMap'] = """
+                    CREATE TEMPORARY TABLE SessionsMap (
+                    handId BIGINT UNSIGNED NOT NULL,
+                    sessionId INT UNSIGNED,
+                    gameSessionId INT UNSIGNED,
+                    INDEX (handId))
+                    ENGINE=INNODB"""
+        elif db_server == 'postgresql':
+            self.query['create_SessionsMap'] = """
+                    CREATE TEMPORARY TABLE SessionsMap (
+                    handId BIGINT NOT NULL,
+                    sessionId INT,
+                    gameSessionId INT)"""
+        elif db_server == 'sqlite':
+            self.query['create_SessionsMap'] = """
+                    CREATE TEMP TABLE SessionsMap (
+                    handId INT NOT NULL,
+                    sessionId INT,
+                    gameSessionId INT)"""
+
+        self.query['insert_SessionsMap'] = """
+                    INSERT INTO SessionsMap (handId, sessionId, gameSessionId)
+                    VALUES (%s, %s, %s)"""
+
+        if db_server == 'mysql':
+            self.query['index_SessionsMap'] = None
+            self.query['update_Hands_SessionsMap'] = """
+                    UPDATE Hands, SessionsMap SET
+                    Hands.sessionId=SessionsMap.sessionId,
+                    Hands.gameSessionId=SessionsMap.gameSessionId
+                    WHERE Hands.id=SessionsMap.handId"""
+        elif db_server == 'postgresql':
+            self.query['index_SessionsMap'] = """
+                    CREATE INDEX SessionsMap_handId_idx ON SessionsMap (handId)"""
+            self.query['update_Hands_SessionsMap'] = """
+                    UPDATE Hands SET
+                    sessionId=SessionsMap.sessionId,
+                    gameSessionId=SessionsMap.gameSessionId
+                    FROM SessionsMap
+                    WHERE Hands.id=SessionsMap.handId"""
+        elif db_server == 'sqlite':
+            self.query['index_SessionsMap'] = """
+                    CREATE INDEX SessionsMap_handId_idx ON SessionsMap (handId)"""
+            self.query['update_Hands_SessionsMap'] = """
+                    UPDATE Hands SET
+                    sessionId=(SELECT sessionId FROM SessionsMap WHERE handId=Hands.id),
+                    gameSessionId=(SELECT gameSessionId FROM SessionsMap WHERE handId=Hands.id)
+                    WHERE id IN (SELECT handId FROM SessionsMap)"""
+
+        self.query['drop_SessionsMap'] = """DROP TABLE SessionsMap"""
+
         ####################################
         # Database management queries
         ####################################
@@ -4770,6 +5151,20 @@ class Sql:
         self.query['isAlreadyInDB'] = """SELECT id FROM Hands 
                                          WHERE gametypeId=%s AND siteHandNo=%s
         """
+
+        # Blocks of Hands ids are handed out by the hands_id_seq sequence on postgres,
+        # which create_tables sets to step by the block size, and from the reserved
+        # range in Settings elsewhere
+        if db_server == 'postgresql':
+            self.query['reserveHandIds'] = None
+            self.query['getNextHandId'] = """SELECT nextval('hands_id_seq')"""
+        else:
+            self.query['reserveHandIds'] = """UPDATE Settings SET nextHandId = nextHandId + %s"""
+            self.query['getNextHandId'] = """SELECT nextHandId FROM Settings"""
+
+        self.query['getHandKeysSince'] = """SELECT id, gametypeId, siteHandNo FROM Hands
+                                            WHERE id > %s
+        """
         
         self.query['getTourneyTypeIdByTourneyNo'] = """SELECT tt.id,
                                                               tt.buyin,
@@ -4931,12 +5326,14 @@ class Sql:
                                             street2Pot,
                                             street3Pot,
                                             street4Pot,
-                                            showdownPot
+                                            showdownPot,
+                                            id
                                              )
                                              values
                                               (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s,
                                                %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s,
-                                               %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)"""
+                                               %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s,
+                                               %s)"""
 
 
         self.query['store_hands_players'] = """insert into HandsPlayers (
@@ -5120,6 +5517,25 @@ class Sql:
                     %s, %s
                 )"""
 
+        # COPY versions of the store queries above, used for large batches on postgres
+        if db_server == 'postgresql':
+            for name in ('store_hand', 'store_hands_players', 'store_hands_actions', 'store_boards'):
+                table = self.query[name].split()[2]
+                cols = self.query[name].split('(')[1].split(')')[0].replace(',', ' ').split()
+                self.query[name.replace('store_', 'copy_', 1)] = "COPY %s (%s) FROM STDIN" % (table, ", ".join(cols))
+
+        ################################
+        # queries for Players Table
+        ################################
+
+        self.query['get_site_player_ids'] = """SELECT name, id FROM Players
+                                              WHERE siteId=%s
+                                              ORDER BY id DESC LIMIT %s"""
+
+        # <names> is replaced with a placeholder for each name
+        self.query['get_player_ids'] = """SELECT name, id FROM Players
+                                         WHERE siteId=%s AND name IN (<names>)"""
+
         ################################
         # queries for Files Table
         ################################
@@ -5135,11 +5551,13 @@ class Sql:
                         partial,
                         errs,
                         ttime100,
-                        finished)
+                        finished,
+                        path,
+                        bytesRead)
                values (
                     %s, %s, %s, %s, %s,
                     %s, %s, %s, %s, %s,
-                    %s
+                    %s, %s, %s
                 )"""
         
         self.query['update_file'] = """
@@ -5153,9 +5571,105 @@ class Sql:
                     partial=partial+%s,
                     errs=errs+%s,
                     ttime100=ttime100+%s,
-                    finished=%s
+                    finished=%s,
+                    bytesRead=%s
                     WHERE id=%s"""
         
+        self.query['get_file_by_path'] = """
+                    SELECT id, bytesRead
+                    FROM Files
+                    WHERE path=%s
+                    AND site=%s
+                    ORDER BY id DESC"""
+
+        self.query['store_raw_block'] = """
+                    INSERT INTO RawHandBlocks (fileId, compression, rawBlock)
+                    VALUES (%s, %s, %s)"""
+
+        self.query['store_raw_hands'] = """
+                    INSERT INTO RawHands (handId, blockId, textStart, textLength)
+                    VALUES (%s, %s, %s, %s)"""
+
+        self.query['get_raw_hands'] = """
+                    SELECT r.handId, r.blockId, r.textStart, r.textLength
+                    FROM RawHands r
+                    WHERE r.handId IN (<hand_ids>)"""
+
+        self.query['get_raw_block'] = """
+                    SELECT compression, rawBlock
+                    FROM RawHandBlocks
+                    WHERE id=%s"""
+
+        # re-deriving HandsPlayers columns from the raw hand archive, a batch at a time
+        self.query['get_rederive_batch'] = """
+                    SELECT r.handId, s.name
+                    FROM RawHands r
+                    INNER JOIN Hands h ON (h.id = r.handId)
+                    INNER JOIN Gametypes g ON (g.id = h.gametypeId)
+                    INNER JOIN Sites s ON (s.id = g.siteId)
+                    WHERE r.handId > %s
+                    ORDER BY r.handId
+                    LIMIT %s"""
+
+        self.query['get_handsplayers_columns'] = """SELECT * FROM HandsPlayers WHERE 1=0"""
+
+        self.query['getRederiveResume'] = """SELECT rederiveResume FROM Settings"""
+        self.query['setRederiveResume'] = """UPDATE Settings SET rederiveResume = %s"""
+
+        if db_server == 'mysql':
+            self.query['create_RederivedStats'] = """
+                    CREATE TEMPORARY TABLE RederivedStats ENGINE=INNODB AS
+                    SELECT handId, playerId, <columns> FROM HandsPlayers WHERE 1=0"""
+        elif db_server == 'postgresql':
+            self.query['create_RederivedStats'] = """
+                    CREATE TEMPORARY TABLE RederivedStats AS
+                    SELECT handId, playerId, <columns> FROM HandsPlayers WHERE 1=0"""
+        elif db_server == 'sqlite':
+            self.query['create_RederivedStats'] = """
+                    CREATE TEMP TABLE RederivedStats AS
+                    SELECT handId, playerId, <columns> FROM HandsPlayers WHERE 1=0"""
+
+        self.query['index_RederivedStats'] = """
+                    CREATE INDEX RederivedStats_idx ON RederivedStats (handId, playerId)"""
+
+        self.query['insert_RederivedStats'] = """
+                    INSERT INTO RederivedStats (handId, playerId, <columns>)
+                    VALUES (<values>)"""
+
+        # <set_clause> is <rederive_set> repeated for each column
+        if db_server == 'mysql':
+            self.query['rederive_set'] = """hp.<column> = r.<column>"""
+            self.query['update_RederivedStats'] = """
+                    UPDATE HandsPlayers hp, RederivedStats r SET
+                    <set_clause>
+                    WHERE hp.handId = r.handId
+                    AND hp.playerId = r.playerId"""
+        elif db_server == 'postgresql':
+            self.query['rederive_set'] = """<column> = r.<column>"""
+            self.query['update_RederivedStats'] = """
+                    UPDATE HandsPlayers SET
+                    <set_clause>
+                    FROM RederivedStats r
+                    WHERE HandsPlayers.handId = r.handId
+                    AND HandsPlayers.playerId = r.playerId"""
+        elif db_server == 'sqlite':
+            self.query['rederive_set'] = """<column> = (SELECT r.<column> FROM RederivedStats r
+                                   WHERE r.handId = HandsPlayers.handId AND r.playerId = HandsPlayers.playerId)"""
+            self.query['update_RederivedStats'] = """
+                    UPDATE HandsPlayers SET
+                    <set_clause>
+                    WHERE EXISTS (SELECT 1 FROM RederivedStats r
+                                  WHERE r.handId = HandsPlayers.handId AND r.playerId = HandsPlayers.playerId)"""
+
+        self.query['clear_RederivedStats'] = """DELETE FROM RederivedStats"""
+        self.query['drop_RederivedStats'] = """DROP TABLE RederivedStats"""
+
+        self.query['get_bytes_per_hand'] = """
+                    SELECT sum(bytesRead), sum(hands)
+                    FROM Files
+                    WHERE finished=%s
+                    AND bytesRead IS NOT NULL"""
+        
         ################################
         # Counts for DB stats window
         ################################
@@ -5183,7 +5697,8 @@ class Sql:
         # If using sqlite, use the ? placeholder instead of %s
         if db_server == 'sqlite':
             for k,q in self.query.iteritems():
-                self.query[k] = re.sub('%s','?',q)
+                if q is not None:
+                    self.query[k] = re.sub('%s','?',q)
 
 if __name__== "__main__":
 #    just print the default queries and exit
@@ -90,24 +90,32 @@ def do_tip(widget, tip):
     widget.set_tooltip_text(_tip)
 
 
+stat_funcs = {}     # stat name as used in the config -> function returning its result
+
+def get_stat(stat):
+    """Returns the function computing stat, called with (stat_dict, player). The
+       name is only looked up the first time, the HUD resolves its stats up front."""
+    if stat not in stat_funcs:
+        match = re_Places.search(stat)
+        if match:   # override if necessary
+            func = globals()[stat[0:-2]]
+            places = int(stat[-1:])
+
+            # If decimal places have been defined, override result[1]
+            # NOTE: decimal place override ALWAYS assumes the raw result is a
+            # fraction (x/100); manual decimal places really only make sense for
+            # percentage values. Also, profit/100 hands (bb/BB) already default
+            # to three decimal places anyhow, so they are unlikely override
+            # candidates.
+            def override(stat_dict, player):
+                return __stat_override(places, func(stat_dict, player))
+            stat_funcs[stat] = override
+        else:
+            stat_funcs[stat] = globals()[stat]
+    return stat_funcs[stat]
+
 def do_stat(stat_dict, player = 24, stat = 'vpip'):
-    statname = stat
-    match = re_Places.search(stat)
-    if match:   # override if necessary
-        statname = stat[0:-2]
-
-    result = eval("%(stat)s(stat_dict, %(player)d)" % {'stat': statname, 'player': player})
-
-    # If decimal places have been defined, override result[1]
-    # NOTE: decimal place override ALWAYS assumes the raw result is a
-    # fraction (x/100); manual decimal places really only make sense for
-    # percentage values. Also, profit/100 hands (bb/BB) already default
-    # to three decimal places anyhow, so they are unlikely override
-    # candidates.
-    if match:
-        places = int(stat[-1:])
-        result = __stat_override(places, result)
-    return result
+    return get_stat(stat)(stat_dict, player)
 
 #    OK, for reference the tuple returned by the stat is:
 #    0 - The stat, raw, no formating, eg 0.33333333
@@ -938,7 +946,8 @@ def ffreq4(stat_dict, player):
 def build_stat_descriptions(stats_file):
     for method in dir(stats_file):
         if method in ("Charset", "Configuration", "Database", "GInitiallyUnowned", "gtk", "pygtk",
-                        "player", "c", "db_connection", "do_stat", "do_tip", "stat_dict", "h", "re",
+                        "player", "c", "db_connection", "do_stat", "do_tip", "get_stat", "stat_funcs",
+                        "stat_dict", "h", "re",
                         "re_Percent", "re_Places", "L10n", "sys", "_", "log", "encoder", "codecs",
                         "logging"):
             continue
@@ -955,7 +964,7 @@ if __name__== "__main__":
     #TODO: fix
     statlist = dir()
     misslist = [ "Configuration", "Database", "Charset", "codecs", "encoder"
-               , "do_stat", "do_tip", "GInitiallyUnowned", "gtk", "pygtk"
+               , "do_stat", "do_tip", "get_stat", "stat_funcs", "GInitiallyUnowned", "gtk", "pygtk"
                , "re", "re_Places"
                ]
     statlist = [ x for x in statlist if x not in dir(sys) ]
@@ -618,6 +618,15 @@ class fpdb:
             self.dia_confirm.vbox.add(hb2)
             hb2.show_all()
 
+            # an interrupted rebuild can carry on with the dates it was started with
+            checkpoint = self.db.get_hudcache_resume()
+            resume = gtk.CheckButton()
+            if checkpoint:
+                resume.set_label(_("Resume the interrupted rebuild, done up to %s") % checkpoint[0])
+                resume.set_active(True)
+                self.dia_confirm.vbox.add(resume)
+                resume.show()
+
             response = self.dia_confirm.run()
             if response == gtk.RESPONSE_YES:
                 lbl = gtk.Label(_(" Rebuilding HUD Cache ... "))
@@ -626,7 +635,13 @@ class fpdb:
                 while gtk.events_pending():
                     gtk.main_iteration_do(False)
 
-                self.db.rebuild_hudcache(self.h_start_date.get_text(), self.start_date.get_text())
+                if resume.get_active():
+                    self.db.rebuild_hudcache(resume=True)
+                else:
+                    # only the days between the old and new start dates change
+                    h_start, v_start = self.h_start_date.get_text(), self.start_date.get_text()
+                    (start, end) = self.db.get_hudcache_rebuild_range(h_start, v_start)
+                    self.db.rebuild_hudcache(h_start, v_start, start, end)
             elif response == gtk.RESPONSE_NO:
                 print _('User cancelled rebuilding hud cache')
 
@@ -30,6 +30,7 @@ import re
 import Queue
 from collections import deque # using Queue for now
 import threading
+import multiprocessing
 
 import logging
 # logging has been set up in fpdb.py or HUD_main.py, use their settings:
@@ -80,7 +81,7 @@ class Importer:
         self.updatedtime = {}
         self.lines      = None
         self.faobs      = None       # File as one big string
-        self.pos_in_file = {}        # dict to remember how far we have read in the file
+        self.pos_in_file = {}        # dict to remember how many bytes we have read in the file
         #Set defaults
         self.callHud    = self.config.get_import_parameters().get("callFpdbHud")
 
@@ -88,7 +89,7 @@ class Importer:
         self.settings.setdefault("handCount", 0)
         #self.settings.setdefault("allowHudcacheRebuild", True) # NOT USED NOW
         #self.settings.setdefault("forceThreads", 2)            # NOT USED NOW
-        self.settings.setdefault("writeQSize", 1000)           # no need to change
+        self.settings.setdefault("writeQSize", 1000)           # hands waiting for the writer threads
         self.settings.setdefault("writeQMaxWait", 10)          # not used
         self.settings.setdefault("dropIndexes", "don't drop")
         self.settings.setdefault("dropHudCache", "don't drop")
@@ -96,8 +97,17 @@ class Importer:
         self.settings.setdefault("ftpArchive", False)
         self.settings.setdefault("testData", False)
         self.settings.setdefault("cacheHHC", False)
+        self.settings.setdefault("handBatchSize", 1000)        # hands parsed before they are stored
+        self.settings.setdefault("parseProcesses", 0)          # >1 parses files in a process pool
+        self.settings.setdefault("commitHands", 1000)          # writer threads commit every commitHands hands
+        self.settings.setdefault("commitWait", 1000)           # ... or every commitWait ms
 
         self.writeq = None
+        self.writeLock = threading.Lock()   # serialises id lookups/allocation between writer threads
+        self.writers = []
+        self.lookupdb = None                # Players etc. when there are several writer threads
+        self.queuedResults = {}             # fileId -> [duplicates, failed] from the writer threads
+        self.hudHands = []                  # Hands.ids not sent to the HUD yet
         self.database = Database.Database(self.config, sql = self.sql)
         self.writerdbs = []
         self.settings.setdefault("threads", 1) # value set by GuiBulkImport
@@ -131,6 +141,9 @@ class Importer:
             for i in xrange(self.settings['threads'] - len(self.writerdbs)):
                 self.writerdbs.append( Database.Database(self.config, sql = self.sql) )
 
+    def setParseProcesses(self, value):
+        self.settings['parseProcesses'] = value
+
     def setDropIndexes(self, value):
         self.settings['dropIndexes'] = value
 
@@ -163,6 +176,8 @@ class Importer:
 
     def closeDBs(self):
         self.database.disconnect()
+        if self.lookupdb is not None:
+            self.lookupdb.disconnect()
         for i in xrange(len(self.writerdbs)):
             self.writerdbs[i].disconnect()
             
@@ -170,27 +185,47 @@ class Importer:
         hands = stored + dups + partial + errs
         now = datetime.datetime.utcnow()
         ttime100 = ttime * 100
-        self.database.updateFile([type, now, now, hands, stored, dups, partial, errs, ttime100, True, id])
+        bytesRead = self.pos_in_file.get(file, 0)
+        self.database.updateFile([type, now, now, hands, stored, dups, partial, errs, ttime100, True, bytesRead, id])
     
-    def addFileToList(self, file, site, filter):
+    def addFileToList(self, file, site, filter, resume=False):
+        """Register file in the Files table, returns [site, filter, fileId].
+           With resume, the latest Files row for the same path is reused and
+           reading continues from the byte offset stored there."""
         now = datetime.datetime.utcnow()
+        path = file
+        try:
+            path = unicode(path, sys.getfilesystemencoding(), "replace")
+        except TypeError:
+            pass
+        if resume:
+            row = self.database.getFileByPath(path, site)
+            if row is not None:
+                id, bytesRead = row
+                if bytesRead and os.path.getsize(file) >= bytesRead:
+                    self.pos_in_file[file] = bytesRead
+                    # runUpdated only imports again once the file grows past what we already have
+                    self.updatedsize[file] = bytesRead
+                    self.updatedtime[file] = time()
+                    log.info(_("Resuming %s at byte %d") % (file, bytesRead))
+                return [site] + [filter] + [id]
         file = os.path.splitext(os.path.basename(file))[0]
         try: #TODO: this is a dirty hack. GBI needs it, GAI fails with it.
             file = unicode(file, "utf8", "replace")
         except TypeError:
             pass
-        id = self.database.storeFile([file, site, now, now, 0, 0, 0, 0, 0, 0, False])
+        id = self.database.storeFile([file, site, now, now, 0, 0, 0, 0, 0, 0, False, path, 0])
         self.database.commit()
         return [site] + [filter] + [id]
 
     #Add an individual file to filelist
-    def addImportFile(self, filename, site = "default", filter = "passthrough"):
+    def addImportFile(self, filename, site = "default", filter = "passthrough", resume = False):
         #TODO: test it is a valid file -> put that in config!!
         #print "addimportfile: filename is a", filename.__class__
         # filename not guaranteed to be unicode
         if filename in self.filelist or not os.path.exists(filename):
             return
-        self.filelist[filename] = self.addFileToList(filename, site, filter)
+        self.filelist[filename] = self.addFileToList(filename, site, filter, resume)
         if site not in self.siteIds:
             # Get id from Sites table in DB
             result = self.database.get_site_id(site)
@@ -233,7 +268,7 @@ class Importer:
             #print "addImportDirectory: checking files in", dir
             for file in os.listdir(dir):
                 #print "                    adding file ", file
-                self.addImportFile(os.path.join(dir, file), site, filter)
+                self.addImportFile(os.path.join(dir, file), site, filter, resume=True)
         else:
             log.warning(_("Attempted to add non-directory '%s' as an import directory") % str(dir))
 
@@ -247,7 +282,7 @@ class Importer:
         starttime = time()
         log.info(_("Started at %s -- %d files to import. indexes: %s") % (start, len(self.filelist), self.settings['dropIndexes']))
         if self.settings['dropIndexes'] == 'auto':
-            self.settings['dropIndexes'] = self.calculate_auto2(self.database, 12.0, 500.0)
+            self.settings['dropIndexes'] = self.calculate_auto_indexes(self.database)
         if 'dropHudCache' in self.settings and self.settings['dropHudCache'] == 'auto':
             self.settings['dropHudCache'] = self.calculate_auto2(self.database, 25.0, 500.0)    # returns "drop"/"don't drop"
 
@@ -255,53 +290,81 @@ class Importer:
             self.database.prepareBulkImport()
         else:
             log.info(_("No need to drop indexes."))
+        c = self.database.get_cursor()
+        c.execute(self.database.sql.query['get_last_hand'])
+        last_hand = c.fetchone()[0] or 0
         #print "dropInd =", self.settings['dropIndexes'], "  dropHudCache =", self.settings['dropHudCache']
 
-        if self.settings['threads'] <= 0:
+        istart = time()
+        threads = self.settings['threads']
+        if threads > 0 and self.database.bulkMode is not None:
+            log.info(_("SQLite bulk import runs in one transaction, not using writer threads"))
+            threads = 0
+        if threads <= 0:
             (totstored, totdups, totpartial, toterrors) = self.importFiles(None)
         else:
-            # create queue (will probably change to deque at some point):
-            self.writeq = Queue.Queue( self.settings['writeQSize'] )
+            # bounded queue of hand batches, so parsing can't run away from the writers:
+            self.writeq = Queue.Queue( max(2, self.settings['writeQSize'] / self.settings['handBatchSize']) )
+            self.queuedResults = {}
+            writers = threads
+            if writers > 1 and self.database.backend == Database.Database.SQLITE:
+                log.info(_("SQLite allows only one writer at a time, using one writer thread"))
+                writers = 1
+            if writers > 1 and self.lookupdb is None:
+                self.lookupdb = Database.Database(self.config, sql = self.sql)
             # start separate thread(s) to read hands from queue and write to db:
-            for i in xrange(self.settings['threads']):
+            self.writers = []
+            for i in xrange(writers):
                 t = threading.Thread( target=self.writerdbs[i].insert_queue_hands
-                                    , args=(self.writeq, self.settings["writeQMaxWait"])
+                                    , args=(self.writeq, self.storeQueuedBatch, self.queuedBatchDone
+                                           ,self.settings['commitHands'], self.settings['commitWait'])
                                     , name="dbwriter-"+str(i) )
                 t.setDaemon(True)
                 t.start()
+                self.writers.append(t)
             # read hands and write to q:
             (totstored, totdups, totpartial, toterrors) = self.importFiles(self.writeq)
-
-            if self.writeq.empty():
-                print _("writers finished already")
-                pass
-            else:
-                print _("waiting for writers to finish ...")
-                #for t in threading.enumerate():
-                #    print "    "+str(t)
-                #self.writeq.join()
-                #using empty() might be more reliable:
-                while not self.writeq.empty() and len(threading.enumerate()) > 1:
-                    # TODO: Do we need to actually tell the progress indicator to move, or is it already moving, and we just need to process events...
-                    while gtk.events_pending(): # see http://faq.pygtk.org/index.py?req=index for more hints (3.7)
-                        gtk.main_iteration(False)
-                    sleep(0.5)
-                print _("                              ... writers finished")
+            self.writeq = None
+        itime = time() - istart
 
         # Tidying up after import
         if self.settings['dropIndexes'] == 'drop':
             self.database.afterBulkImport()
         else:
             log.info (_("No need to rebuild indexes."))
+        if totstored >= self.database.MIN_RATE_HANDS and itime > 0:
+            # what keeping the indexes costs, for calculate_auto_indexes
+            if self.settings['dropIndexes'] == 'drop':
+                self.database.setImportRate('import.bulk', totstored / itime)
+            else:
+                self.database.setImportRate('import', totstored / itime)
+            self.database.commit()
         if 'dropHudCache' in self.settings and self.settings['dropHudCache'] == 'drop':
-            self.database.rebuild_hudcache()
+            self.rebuildHudCacheAfter(last_hand)
         else:
             log.info (_("No need to rebuild hudcache."))
         self.database.analyzeDB()
+        if self.callHud:
+            self.sendToHud()
         endtime = time()
         return (totstored, totdups, totpartial, toterrors, endtime-starttime)
     # end def runImport
 
+    def rebuildHudCacheAfter(self, last_hand):
+        """Rebuild the hudcache from the day of the first hand with an id above last_hand on,
+           or all of it when an earlier rebuild was interrupted."""
+        c = self.database.get_cursor()
+        c.execute(self.database.sql.query['getHandsStartAfter'].replace('%s', self.database.sql.query['placeholder']), (last_hand,))
+        start = c.fetchone()[0]
+        if start is None:
+            log.info(_("No new hands, no need to rebuild hudcache."))
+        elif self.database.get_hudcache_resume():
+            self.database.rebuild_hudcache()
+        else:
+            # the day of the hudcache rows the hand went in
+            key = self.database.hudCacheStyleKey(datetime.datetime.strptime(str(start)[:19], '%Y-%m-%d %H:%M:%S'))
+            self.database.rebuild_hudcache(start="20%s-%s-%s" % (key[1:3], key[3:5], key[5:7]))
+
     def importFiles(self, q):
         """"Read filenames in self.filelist and pass to import_file_dict().
             Uses a separate database connection if created as a thread (caller
@@ -316,12 +379,26 @@ class Importer:
         #prepare progress popup window
         ProgressDialog = ProgressBar(len(self.filelist), self.parent)
         
+        if self.settings['parseProcesses'] > 1:
+            parsed = self.parseFilesInPool(self.filelist.keys())
+        else:
+            parsed = None
+
+        queued = []
         for file in self.filelist:
             
             ProgressDialog.progress_update(file, str(self.database.getHandCount()))
             
-            (stored, duplicates, partial, errors, ttime) = self.import_file_dict(file, self.filelist[file][0]
-                                                           ,self.filelist[file][1], self.filelist[file][2], q)
+            if parsed is not None:
+                result = self.importParsedFile(file, parsed.next(), self.filelist[file][2], q)
+            else:
+                result = self.import_file_dict(file, self.filelist[file][0]
+                                              ,self.filelist[file][1], self.filelist[file][2], q)
+            if q is not None:
+                # duplicates are only known once the writers have stored the hands
+                queued.append((file, result))
+                continue
+            (stored, duplicates, partial, errors, ttime) = result
             totstored += stored
             totdups += duplicates
             totpartial += partial
@@ -331,10 +408,19 @@ class Importer:
         self.database.commit()
         del ProgressDialog
         
-        for i in xrange( self.settings['threads'] ):
-            print _("sending finish message queue length ="), q.qsize()
-            db.send_finish_msg(q)
-
+        if q is not None:
+            self.waitForWriters(q)
+            for (file, (stored, duplicates, partial, errors, ttime)) in queued:
+                (dups, failed) = self.queuedResults.get(self.filelist[file][2], (0, 0))
+                duplicates += dups
+                stored -= dups + failed
+                errors += failed
+                totstored += stored
+                totdups += duplicates
+                totpartial += partial
+                toterrors += errors
+                self.logImport('bulk', file, stored, duplicates, partial, errors, ttime, self.filelist[file][2])
+            self.database.commit()
         
         return (totstored, totdups, totpartial, toterrors)
     # end def importFiles
@@ -361,9 +447,41 @@ class Importer:
            Example values of scale and increment params might be 10 and 500 meaning
            roughly: drop if importing more than 10% (100/scale) of hands in db or if
            less than 500 hands in db"""
-        size_per_hand = 1300.0  # wag based on a PS 6-up FLHE file. Actual value not hugely important
-                                # as values of scale and increment compensate for it anyway.
-                                # decimal used to force float arithmetic
+        new_hands = self.estimateNewHands(db)
+
+        # if hands_in_db is zero or very low, we want to drop indexes, otherwise compare
+        # import size with db size somehow:
+        ret = "don't drop"
+        if self.settings['handsInDB'] < scale * new_hands + increment:
+            ret = "drop"
+        #print "auto2: handsindb =", self.settings['handsInDB'], "new_hands =", new_hands, \
+        #      "inc =", increment, "return:", ret
+        return ret
+
+    def calculate_auto_indexes(self, db):
+        """drop/don't drop the indexes for the files to import: drop if rebuilding them
+           after the import takes less time than keeping them up to date during it, as
+           measured by earlier bulk imports. Until both have been measured, or on mysql,
+           calculate_auto2 decides."""
+        new_hands = self.estimateNewHands(db)
+        keep = db.estimateIndexUpkeep(new_hands)
+        rebuild = db.estimateAfterBulkImport(self.settings['handsInDB'] + new_hands)
+        if keep is None or rebuild is None:
+            return self.calculate_auto2(db, 12.0, 500.0)
+        log.info(_("Keeping the indexes up to date estimated to take %.1f seconds, rebuilding them %.1f seconds")
+                 % (keep, rebuild))
+        if rebuild < keep:
+            return "drop"
+        return "don't drop"
+
+    def estimateNewHands(self, db):
+        """Number of hands in the files to import, guessed from their size. Also sets
+           settings['handsInDB'] if not set yet"""
+        size_per_hand = db.getBytesPerHand()    # measured from the files imported so far
+        if not size_per_hand:
+            size_per_hand = 1300.0  # wag based on a PS 6-up FLHE file. Actual value not hugely important
+                                    # as values of scale and increment compensate for it anyway.
+                                    # decimal used to force float arithmetic
 
         # get number of hands in db
         if 'handsInDB' not in self.settings:
@@ -380,15 +498,7 @@ class Importer:
             if os.path.exists(file):
                 stat_info = os.stat(file)
                 total_size += stat_info.st_size
-
-        # if hands_in_db is zero or very low, we want to drop indexes, otherwise compare
-        # import size with db size somehow:
-        ret = "don't drop"
-        if self.settings['handsInDB'] < scale * (total_size/size_per_hand) + increment:
-            ret = "drop"
-        #print "auto2: handsindb =", self.settings['handsInDB'], "total_size =", total_size, "size_per_hand =", \
-        #      size_per_hand, "inc =", increment, "return:", ret
-        return ret
+        return total_size/size_per_hand
 
     #Run import on updated files, then store latest update time. Called from GuiAutoImport.py
     def runUpdated(self):
@@ -416,6 +526,8 @@ class Importer:
                         (stored, duplicates, partial, errors, ttime) = self.import_file_dict(file, self.filelist[file][0]
                                                                       ,self.filelist[file][1], self.filelist[file][2], None)
                         self.logImport('auto', file, stored, duplicates, partial, errors, ttime, self.filelist[file][2])
+                        # bytesRead in Files is where the next start resumes reading the file
+                        self.database.commit()
                         try:
                             if not os.path.isdir(file): # Note: This assumes that whatever calls us has an "addText" func
                                 self.caller.addText(" %d stored, %d duplicates, %d partial, %d errors (time = %f)" % (stored, duplicates, partial, errors, ttime))
@@ -441,6 +553,7 @@ class Importer:
 
         self.addToDirList = {}
         self.removeFromFileList = {}
+        self.sendToHud()
         self.database.rollback()
         #rulog.writelines("  finished\n")
         #rulog.close()
@@ -459,68 +572,23 @@ class Importer:
               log.info((_("Converting %s") % file) + " (" + str(q.qsize()) + ")")
         else: log.info(_("Converting %s") % file)
             
-        filter_name = filter.replace("ToFpdb", "")
-        mod = __import__(filter)
-        obj = getattr(mod, filter_name, None)
-        if callable(obj):
-            
-            if file in self.pos_in_file:  idx = self.pos_in_file[file]
-            else: self.pos_in_file[file], idx = 0, 0
-                
-            hhc = obj( self.config, in_path = file, index = idx
-                      ,starsArchive = self.settings['starsArchive']
-                      ,ftpArchive   = self.settings['ftpArchive']
-                      ,sitename     = site)
-            
+        if file in self.pos_in_file:  idx = self.pos_in_file[file]
+        else: self.pos_in_file[file], idx = 0, 0
+
+        hhc = getConverter(self.config, file, site, filter, idx, self.settings)
+        if hhc is not None:
             if hhc.getStatus():
-                if self.caller: hhc.progressNotify()
-                handlist = hhc.getProcessedHands()
+                # hands are parsed as the file is read and stored a batch at a time,
+                # so a huge file never has to be held in memory all at once
+                for handlist in self.handBatches(hhc.iterProcessedHands()):
+                    if self.caller: hhc.progressNotify()
+                    if q is not None:
+                        q.put((handlist, fileId, False))
+                    else:
+                        duplicates += self.importHandBatch(handlist, fileId)
+                    if self.settings['cacheHHC']:
+                        hhc.processedHands.extend(handlist)
                 self.pos_in_file[file] = hhc.getLastCharacterRead()
-                (hbulk, hpbulk, habulk, hcbulk, phands, ihands, to_hud) = ([], [], [], [], [], [], [])
-                sc, gsc = {'bk': []}, {'bk': []}
-                
-                ####Lock Placeholder####
-                for hand in handlist:
-                    hand.prepInsert(self.database, printtest = self.settings['testData'])
-                    self.database.commit()
-                    phands.append(hand)
-                ####Lock Placeholder####
-                
-                for hand in phands:
-                    hand.assembleHand()
-                
-                ####Lock Placeholder####
-                id = self.database.nextHandId()
-                for i in range(len(phands)):
-                    doinsert = len(phands)==i+1
-                    hand = phands[i]
-                    try:
-                        id = hand.getHandId(self.database, id)
-                        sc, gsc = hand.updateSessionsCache(self.database, sc, gsc, None, doinsert)
-                        hbulk = hand.insertHands(self.database, hbulk, fileId, doinsert, self.settings['testData'])
-                        hcbulk = hand.updateHudCache(self.database, hcbulk, doinsert)
-                        ihands.append(hand)
-                        to_hud.append(hand.dbid_hands)
-                    except Exceptions.FpdbHandDuplicate:
-                        duplicates += 1
-                self.database.commit()
-                ####Lock Placeholder####
-                
-                for i in range(len(ihands)):
-                    doinsert = len(ihands)==i+1
-                    hand = ihands[i]
-                    hpbulk = hand.insertHandsPlayers(self.database, hpbulk, doinsert, self.settings['testData'])
-                    habulk = hand.insertHandsActions(self.database, habulk, doinsert, self.settings['testData'])
-                self.database.commit()
-
-                #pipe the Hands.id out to the HUD
-                if self.callHud:
-                    for hid in to_hud:
-                        try:
-                            print _("fpdb_import: sending hand to hud"), hid, "pipe =", self.caller.pipe_to_hud
-                            self.caller.pipe_to_hud.stdin.write("%s" % (hid) + os.linesep)
-                        except IOError, e:
-                            log.error(_("Failed to send hand to HUD: %s") % e)
 
                 errors = getattr(hhc, 'numErrors')
                 stored = getattr(hhc, 'numHands')
@@ -535,7 +603,6 @@ class Importer:
                 # TODO: appropriate response?
                 return (0, 0, 0, 1, time() - ttime)
         else:
-            log.warning(_("Unknown filter filter_name:'%s' in filter:'%s'") %(filter_name, filter))
             return (0, 0, 0, 1, time() - ttime)
 
         ttime = time() - ttime
@@ -544,6 +611,299 @@ class Importer:
         return (stored, duplicates, partial, errors, ttime)
 
 
+    def parseFilesInPool(self, files):
+        """Convert files and derive their stats in a pool of settings['parseProcesses']
+           processes. Yields (batches, job) for each file in order, see parseFile(). At
+           most two files per process are parsed ahead of the caller and each of them
+           only gets two batches ahead of it."""
+        processes = self.settings['parseProcesses']
+        pool = multiprocessing.Pool(processes, initParseProcess, (self.config.file, self.config.site_ids))
+        manager = multiprocessing.Manager()
+        try:
+            jobs = deque()
+            for file in files:
+                queue = manager.Queue(2)
+                args = (file, self.filelist[file][0], self.filelist[file][1], self.pos_in_file.get(file, 0)
+                       ,{'starsArchive': self.settings['starsArchive'], 'ftpArchive': self.settings['ftpArchive']}
+                       ,queue, self.settings['handBatchSize'])
+                jobs.append((queue, pool.apply_async(parseFile, (args,))))
+                if len(jobs) >= 2 * processes:
+                    (queue, job) = jobs.popleft()
+                    yield (iter(queue.get, None), job)
+            while jobs:
+                (queue, job) = jobs.popleft()
+                yield (iter(queue.get, None), job)
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+            manager.shutdown()
+
+    def importParsedFile(self, file, parsed, fileId, q=None):
+        """Store the batches of hands of a file as parseFile() sends them, the parent
+           only assigns ids and writes to the database (or hands them to the writer
+           threads on q)"""
+        (batches, job) = parsed
+        if os.path.isdir(file):
+            self.addToDirList[file] = self.filelist[file][:2]
+            job.get()
+            return (0,0,0,0,0)
+
+        ttime = time()
+        duplicates = 0
+        for handlist in batches:
+            for hand in handlist:
+                hand.config = self.config
+            if q is not None:
+                q.put((handlist, fileId, True))
+            else:
+                duplicates += self.importHandBatch(handlist, fileId, assembled = True)
+        (numHands, numErrors, bytesRead, ptime) = job.get()
+        if numHands is None:
+            return (0, 0, 0, 1, time() - ttime)
+        self.pos_in_file[file] = bytesRead
+
+        stored = numHands - duplicates - numErrors
+        return (stored, duplicates, 0, numErrors, time() - ttime)
+
+    def storeQueuedBatch(self, db, handlist, fileId, assembled):
+        """Called by the writer threads to store a batch of hands taken off writeq"""
+        return self.importHandBatch(handlist, fileId, assembled, db)
+
+    def queuedBatchDone(self, fileId, hands, duplicates, failed):
+        """Called by the writer threads once a batch is committed or has failed"""
+        self.writeLock.acquire()
+        try:
+            result = self.queuedResults.setdefault(fileId, [0, 0])
+            result[0] += duplicates
+            if failed:
+                result[1] += hands
+        finally:
+            self.writeLock.release()
+
+    def waitForWriters(self, q):
+        """Send each writer thread its finish message and wait for them to drain q"""
+        for t in self.writers:
+            self.database.send_finish_msg(q)
+        print _("waiting for writers to finish ...")
+        for t in self.writers:
+            while t.isAlive():
+                # TODO: Do we need to actually tell the progress indicator to move, or is it already moving, and we just need to process events...
+                while gtk.events_pending(): # see http://faq.pygtk.org/index.py?req=index for more hints (3.7)
+                    gtk.main_iteration(False)
+                t.join(0.5)
+        self.writers = []
+        print _("                              ... writers finished")
+
+    def handBatches(self, hands):
+        """Group the Hand objects from a converter into lists of settings['handBatchSize']"""
+        batch = []
+        for hand in hands:
+            batch.append(hand)
+            if len(batch) >= self.settings['handBatchSize']:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    def importHandBatch(self, handlist, fileId, assembled = False, db = None):
+        """Store a list of parsed hands in the database, return number of duplicates.
+           assembled hands had their DerivedStats computed by a parsing process.
+           Writer threads pass their own db and commit themselves."""
+        queued = db is not None
+        if not queued:
+            db = self.database
+        (hpbulk, habulk, phands) = ([], [], [])
+        
+        # Players, Gametypes and Tourneys are shared by the writer threads, so they
+        # look them up on one connection and commit at once for the others to see
+        prepdb = db
+        if queued and self.lookupdb is not None:
+            prepdb = self.lookupdb
+        if queued: self.writeLock.acquire()
+        try:
+            # new players of the whole batch are inserted together
+            players = {}
+            for hand in handlist:
+                players.setdefault(hand.siteId, set()).update([p[1] for p in hand.players])
+            for (siteId, names) in players.iteritems():
+                prepdb.getSqlPlayerIDs(list(names), siteId)
+            for hand in handlist:
+                hand.prepInsert(prepdb, printtest = self.settings['testData'])
+                if assembled:
+                    # the tourney ids come from the db so they were not known when the stats were derived
+                    hand.hands['tourneyId'] = hand.tourneyId
+                    if hand.gametype['type'] == 'tour':
+                        for (name, stats) in hand.handsplayers.iteritems():
+                            stats['tourneyTypeId'] = hand.tourneyTypeId
+                            stats['tourneysPlayersIds'] = hand.tourneysPlayersIds[name]
+                if not queued: db.commit()
+                phands.append(hand)
+            if queued: prepdb.commit()
+        finally:
+            if queued: self.writeLock.release()
+        
+        if not assembled:
+            for hand in phands:
+                hand.assembleHand()
+        
+        while True:
+            try:
+                (ihands, to_hud, duplicates) = self.storeHands(db, prepdb, phands, fileId, queued)
+                break
+            except db.connection.IntegrityError:
+                # the duplicate index only reads hands with ids above those it has seen, so it
+                # misses hands another importer commits later from a block it reserved earlier
+                if db.bulkMode is not None:
+                    raise       # the rollback would take the whole bulk import with it
+                db.rollback()
+                if not db.findDuplicateHands([(hand.dbid_gt, hand.hands['siteHandNo']) for hand in phands]):
+                    raise
+                if queued:
+                    # the rollback dropped the writer's other batches too, it stores them again
+                    raise Exceptions.FpdbHandDuplicate(_("hands stored by another importer"))
+
+        for i in range(len(ihands)):
+            doinsert = len(ihands)==i+1
+            hand = ihands[i]
+            hpbulk = hand.insertHandsPlayers(db, hpbulk, doinsert, self.settings['testData'])
+            habulk = hand.insertHandsActions(db, habulk, doinsert, self.settings['testData'])
+        if not queued: db.commit()
+
+        # the HUD is sent the Hands.ids once the whole tick is imported
+        if self.callHud:
+            self.hudHands.extend(to_hud)
+        return duplicates
+
+    def storeHands(self, db, prepdb, phands, fileId, queued):
+        """Give the new hands of a batch their ids and store them in Hands and the caches.
+           Returns (stored hands, their ids, number of duplicates)."""
+        (ihands, to_hud, hbulk, hcbulk) = ([], [], [], {})
+        sc, gsc = {'bk': []}, {'bk': []}
+        duplicates = 0
+        db.refreshDuplicateIndex()
+        # Hands ids come from blocks reserved in the db, the writer threads share
+        # the blocks of the lookup connection
+        if queued: self.writeLock.acquire()
+        try:
+            for hand in phands:
+                try:
+                    id = prepdb.nextHandId()
+                    hand.getHandId(db, id)
+                    prepdb.useHandId(id)
+                    ihands.append(hand)
+                    to_hud.append(hand.dbid_hands)
+                except Exceptions.FpdbHandDuplicate:
+                    duplicates += 1
+            if queued and prepdb is not db: prepdb.commit()
+        finally:
+            if queued: self.writeLock.release()
+        # duplicates are weeded out first, so the last hand always writes the bulk lists
+        for i in range(len(ihands)):
+            doinsert = len(ihands)==i+1
+            hand = ihands[i]
+            sc, gsc = hand.updateSessionsCache(db, sc, gsc, None, doinsert)
+            hbulk = hand.insertHands(db, hbulk, fileId, doinsert, self.settings['testData'])
+            hcbulk = hand.updateHudCache(db, hcbulk, doinsert)
+        if ihands and self.config.raw_hands.save == "all":
+            db.storeRawHands(fileId, [(hand.dbid_hands, hand.handText) for hand in ihands])
+        if not queued: db.commit()
+        return (ihands, to_hud, duplicates)
+
+    def sendToHud(self):
+        """Pipe the Hands.ids stored since the last call out to the HUD, on one line so it
+           can update each table once, for its latest hand"""
+        if not self.hudHands:
+            return
+        try:
+            print _("fpdb_import: sending hand to hud"), " ".join([str(hid) for hid in self.hudHands]), "pipe =", self.caller.pipe_to_hud
+            self.caller.pipe_to_hud.stdin.write(" ".join([str(hid) for hid in self.hudHands]) + os.linesep)
+        except IOError, e:
+            log.error(_("Failed to send hand to HUD: %s") % e)
+        self.hudHands = []
+
+    def rederiveHandsPlayers(self, columns, resume = False):
+        """Recompute columns of HandsPlayers from the hands in the raw hand archive, e.g.
+           after a fix to their calculation in DerivedStats, without re-importing files.
+           Batches of handBatchSize hands are parsed again, in a pool of parseProcesses
+           processes if set, and each is written with one update and committed along
+           with a checkpoint. With resume an interrupted run carries on from there.
+           Returns (hands, errors)."""
+        db = self.database
+        size = self.settings['handBatchSize']
+        processes = self.settings['parseProcesses']
+        after = 0
+        if resume:
+            after = db.getRederiveResume() or 0
+        self.checkRederiveColumns(columns, after)
+        starttime = time()
+        (total, toterrors) = (0, 0)
+        
+        def batches(after):
+            while True:
+                hands = db.getRederiveBatch(after, size)
+                if not hands:
+                    break
+                after = hands[-1][0]
+                yield (hands, columns)
+        
+        if processes > 1:
+            pool = multiprocessing.Pool(processes, initParseProcess, (self.config.file, self.config.site_ids))
+            derived = self.rederiveInPool(pool, batches(after), processes)
+        else:
+            pool = None
+            derived = (deriveHands(self.config, hands, columns) for (hands, columns) in batches(after))
+        
+        db.prepRederive(columns)
+        try:
+            for (hands, last, errors) in derived:
+                rows = []
+                for (hid, siteId, players) in hands:
+                    pids = db.getSqlPlayerIDs(players.keys(), siteId)
+                    for (name, values) in players.iteritems():
+                        rows.append([hid, pids[name]] + values)
+                db.updateHandsPlayersColumns(columns, rows)
+                db.setRederiveResume(last)
+                db.commit()
+                total += len(hands)
+                toterrors += errors
+                print _("Re-derived %d hands (%d failed), %.0f hands/sec") % (total, toterrors, total / (time() - starttime))
+            db.setRederiveResume(None)
+            db.commit()
+        finally:
+            if pool is not None:
+                pool.terminate()
+                pool.join()
+            db.endRederive()
+        return (total, toterrors)
+
+    def checkRederiveColumns(self, columns, after):
+        """Raise FpdbError unless each of columns is a column of HandsPlayers that
+           DerivedStats computes, as seen in the first hands to re-derive that parse"""
+        db = self.database
+        stored = set(db.getHandsPlayersColumns()) - set(['id', 'handid', 'playerid'])
+        unknown = [col for col in columns if col.lower() not in stored]
+        for (hid, site, text) in db.getRederiveBatch(after, 10):
+            try:
+                stats = deriveHand(self.config, site, text).handsplayers.values()[0]
+            except Exception:
+                continue
+            unknown += [col for col in columns if col not in stats and col not in unknown]
+            break
+        if unknown:
+            raise Exceptions.FpdbError(_("Can't re-derive HandsPlayers columns: %s") % ", ".join(unknown))
+
+    def rederiveInPool(self, pool, batches, processes):
+        """Yield deriveHands() of each batch in order, at most two batches per process
+           are parsed ahead of the caller"""
+        jobs = deque()
+        for args in batches:
+            jobs.append(pool.apply_async(rederiveHands, (args,)))
+            if len(jobs) >= 2 * processes:
+                yield jobs.popleft().get()
+        while jobs:
+            yield jobs.popleft().get()
+
     def printEmailErrorMessage(self, errors, filename, line):
         traceback.print_exc(file=sys.stderr)
         print (_("Error No.%s please send the hand causing this to fpdb-main@lists.sourceforge.net so we can fix the problem.") % errors)
@@ -558,6 +918,95 @@ class Importer:
         logfile.close()
         
         
+def getConverter(config, file, site, filter, index, settings):
+    """Return a streaming HandHistoryConverter for file, None if filter is unknown"""
+    filter_name = filter.replace("ToFpdb", "")
+    mod = __import__(filter)
+    obj = getattr(mod, filter_name, None)
+    if not callable(obj):
+        log.warning(_("Unknown filter filter_name:'%s' in filter:'%s'") %(filter_name, filter))
+        return None
+    return obj( config, in_path = file, index = index
+               ,starsArchive = settings['starsArchive']
+               ,ftpArchive   = settings['ftpArchive']
+               ,sitename     = site
+               ,stream       = True)
+
+parseConfig = None # Configuration of a parsing process, set by initParseProcess()
+
+def initParseProcess(configFile, siteIds):
+    """Initializer of the Importer's parsing processes"""
+    global parseConfig
+    parseConfig = Configuration.Config(file = configFile)
+    parseConfig.set_site_ids(siteIds)
+
+def parseFile(args):
+    """Convert a file and derive the stats of its hands in a parsing process. The
+       hands are compacted and put on queue in lists of batchSize as they are parsed,
+       then None. Returns (numHands, numErrors, bytesRead, seconds), numHands is None
+       if the file could not be converted"""
+    (file, site, filter, index, settings, queue, batchSize) = args
+    starttime = time()
+    try:
+        if os.path.isdir(file):
+            return (0, 0, index, 0)
+        hhc = getConverter(parseConfig, file, site, filter, index, settings)
+        if hhc is None or not hhc.getStatus():
+            return (None, 0, index, time() - starttime)
+        keepText = parseConfig.raw_hands.save == "all"
+        hands = []
+        for hand in hhc.iterProcessedHands():
+            hand.assembleHand()
+            hand.compact(keepText)
+            hands.append(hand)
+            if len(hands) >= batchSize:
+                queue.put(hands)
+                hands = []
+        if hands:
+            queue.put(hands)
+        return (hhc.numHands, hhc.numErrors, hhc.getLastCharacterRead(), time() - starttime)
+    finally:
+        queue.put(None)
+
+def rederiveHands(args):
+    """deriveHands() in one of rederiveHandsPlayers' parsing processes"""
+    (hands, columns) = args
+    return deriveHands(parseConfig, hands, columns)
+
+rederiveConverters = {} # converter of each site, reused for every hand
+
+def deriveHand(config, site, text):
+    """Parse the text of a hand of site and derive its stats"""
+    hhc = rederiveConverters.get(site)
+    if hhc is None:
+        hhc = getConverter(config, os.devnull, site, config.hhcs[site].converter, 0
+                          ,{'starsArchive': False, 'ftpArchive': False})
+        rederiveConverters[site] = hhc
+    hand = hhc.processHand(text)
+    hand.saveActions = False
+    hand.assembleHand()
+    return hand
+
+def deriveHands(config, hands, columns):
+    """Parse and derive the stats of a list of [handId, site, text] again. Returns
+       (derived, lastId, errors), derived is a list of (handId, siteId, players) with
+       players a dict of player name to the values of columns"""
+    derived = []
+    errors = 0
+    for (hid, site, text) in hands:
+        try:
+            hand = deriveHand(config, site, text)
+        except Exception, e:
+            errors += 1
+            log.warning(_("Re-deriving hand %s failed: %s") % (hid, e))
+            continue
+        players = {}
+        for (name, stats) in hand.handsplayers.iteritems():
+            players[name] = [stats[col] for col in columns]
+        derived.append((hid, hand.siteId, players))
+    return (derived, hands[-1][0], errors)
+
+
 class ProgressBar:
 
     """
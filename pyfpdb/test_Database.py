@@ -16,6 +16,7 @@
 #In the "official" distribution you can find the license in agpl-3.0.txt.
 
 import sqlite3
+import datetime
 import Database
 import math
 
@@ -81,3 +82,93 @@ def testSQLiteModFunction():
         idx = idx+1
 
     cur.execute("DROP TABLE test")
+
+def testLRUCache():
+    cache = Database.LRUCache(3)
+    for i in range(3):
+        cache[i] = i * 10
+    assert cache.get(0) == 0    # 0 is now the most recently used
+    cache[3] = 30
+    assert 1 not in cache
+    assert len(cache) == 3
+    assert cache.get(0) == 0 and cache.get(2) == 20 and cache.get(3) == 30
+    assert cache.get(1) is None
+
+def testRawCodecs():
+    text = u"PokerStars Hand #1: Hold'em No Limit (€0.01/€0.02)\n".encode('utf-8') * 50
+    for (name, (compress, decompress)) in Database.RAW_CODECS.iteritems():
+        block = compress(text)
+        assert decompress(buffer(block)) == text, name
+
+def testHudStatCache():
+    class FakeDb:
+        def get_similar_gametypes(self, gametypeId, agg_bb_mult):
+            return frozenset([1, 2])
+    def hand(gid, seat, vpip, minute):
+        return {7: ({'seat': seat, 'screen_name': u'Hero', 'gametype_id': gid, 'seats': 6, 'stylekey': 'd110101'
+                    ,'import_time': datetime.datetime(2011, 1, 1, 12, minute)},
+                    {'n': 1, 'vpip': vpip, 'bigblind': 0})}
+    cache = Database.HudStatCache()
+    params = {True: ('d000000', 1000, 0, 10, True), False: ('d000000', 1000, 0, 10, True)}
+    rows = hand(1, 3, 1, 5)
+    assert cache.get(10, rows, 7, params) is None
+    cache.store(datetime.datetime(2011, 1, 1, 12, 10), rows, 7, params
+               ,{7: {'player_id': 7, 'seat': 3, 'screen_name': u'Hero', 'n': 5, 'vpip': 2, 'bigblind': 4}})
+    cache.add(FakeDb(), 10, rows)               # already included when the stats were read
+    cache.add(FakeDb(), 8, hand(2, 5, 1, 11))   # another table of a similar gametype, imported later
+    cache.add(FakeDb(), 8, hand(2, 5, 1, 11))   # ... and only added once
+    cache.add(FakeDb(), 14, hand(3, 5, 1, 12))  # not aggregated with gametype 1
+    stats = cache.get(14, rows, 7, params)[7]
+    assert (stats['n'], stats['vpip'], stats['bigblind'], stats['seat']) == (6, 3, 4, 3)
+    assert cache.hits == 1 and cache.misses == 1
+
+def testDuplicateIndex():
+    class FakeCursor:
+        def __init__(self, rows):
+            self.rows = rows
+        def fetchmany(self, size):
+            (rows, self.rows) = (self.rows[:size], self.rows[size:])
+            return rows
+        def fetchall(self):
+            return self.fetchmany(len(self.rows))
+    key = Database.DuplicateIndex.key
+    index = Database.DuplicateIndex()
+    index.MAXRECENT = 2
+    index.load(FakeCursor([(1, 1, '100'), (3, 1, '300'), (2, 2, '100')]))
+    assert key(1, 100) in index and key(2, '100') in index and key(1, 300) in index
+    assert key(2, 300) not in index
+    assert index.lastId == 3
+
+    index.add(FakeCursor([(4, 1, 'T400')]))
+    assert key(1, 'T400') in index
+    index.rollback()                        # our own insert was never stored
+    assert key(1, 'T400') not in index and index.pendingId == 3
+
+    index.add(FakeCursor([(4, 1, 'T400'), (5, 1, '500')]))
+    index.commit()
+    assert index.lastId == 5 and len(index.hashes) == 3 and len(index.recent) == 2
+    index.add(FakeCursor([(6, 1, '600')]))
+    index.commit()                          # more than MAXRECENT, merged into the array
+    assert len(index.hashes) == 6 and not index.recent
+    assert list(index.hashes) == sorted(index.hashes)
+    for (gametypeId, siteHandNo) in ((1, 100), (2, 100), (1, 300), (1, 'T400'), (1, 500), (1, 600)):
+        assert key(gametypeId, siteHandNo) in index
+    assert key(1, 700) not in index
+
+def testCopyText():
+    rows = [(1, u'Hërö\ttab', 'a\\b\nc\rd', None, True, False, 0.1, 2L)
+           ,(None, '', 1.5, u'\\N')]
+    text = Database.copy_text(rows).read()
+    assert text == ('1\tH\xc3\xabr\xc3\xb6\\ttab\ta\\\\b\\nc\\rd\t\\N\tt\tf\t0.1\t2\n'
+                    '\\N\t\t1.5\t\\\\N\n')
+
+def testClusterIntervals():
+    # overlapping and nested intervals are joined, the end is the furthest of them
+    assert Database.cluster_intervals([(0, 10, 'a'), (5, 20, 'b'), (6, 8, 'c')], 0) == [[0, 20, ['a', 'b', 'c']]]
+    # intervals exactly gap apart are joined, one more and they are not
+    assert Database.cluster_intervals([(0, 10, 'a'), (15, 20, 'b')], 5) == [[0, 20, ['a', 'b']]]
+    assert Database.cluster_intervals([(0, 10, 'a'), (16, 20, 'b')], 5) == [[0, 10, ['a']], [16, 20, ['b']]]
+    # unsorted input comes back in start order
+    assert Database.cluster_intervals([(30, 40, 'c'), (0, 10, 'a'), (12, 14, 'b'), (38, 50, 'd')], 2) == \
+           [[0, 14, ['a', 'b']], [30, 50, ['c', 'd']]]
+    assert Database.cluster_intervals([], 5) == []
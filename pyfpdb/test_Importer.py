@@ -0,0 +1,376 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#This program is free software: you can redistribute it and/or modify
+#it under the terms of the GNU Affero General Public License as published by
+#the Free Software Foundation, version 3 of the License.
+#
+#This program is distributed in the hope that it will be useful,
+#but WITHOUT ANY WARRANTY; without even the implied warranty of
+#MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+#GNU General Public License for more details.
+#
+#You should have received a copy of the GNU Affero General Public License
+#along with this program. If not, see <http://www.gnu.org/licenses/>.
+#In the "official" distribution you can find the license in agpl-3.0.txt.
+
+# Imports into a SQLite database in a temporary directory, run from pyfpdb/
+
+import os
+import shutil
+import tempfile
+
+import Configuration
+import Database
+import Exceptions
+import fpdb_import
+
+STARS = "regression-test-files/cash/Stars/Flop/"
+MICROGRIND = STARS + "NLHE-FR-USD-0.01-0.02-201005.microgrind.txt"     # 96 hands
+
+
+class Caller:
+    """Stands in for the auto import gui"""
+    def addText(self, text):
+        pass
+
+def new_config(dir):
+    config = Configuration.Config(file = "HUD_config.test.xml")
+    config.dir_database = dir
+    return config
+
+def new_importer(config, **settings):
+    s = {}
+    s.update(config.get_db_parameters())
+    s.update(config.get_import_parameters())
+    s.update(config.get_default_paths())
+    importer = fpdb_import.Importer(Caller(), s, config)
+    importer.setCallHud(False)
+    importer.setFailOnError(True)
+    importer.setThreads(settings.pop('threads', 0))
+    importer.settings.update(settings)
+    return importer
+
+def count(db, query):
+    c = db.get_cursor()
+    c.execute(query)
+    return c.fetchone()
+
+def bulk_import(files, **settings):
+    """Import files into a new database, return the stored hands, players and actions"""
+    dir = tempfile.mkdtemp()
+    try:
+        config = new_config(dir)
+        Database.Database(config).recreate_tables()
+        importer = new_importer(config, **settings)
+        for file in files:
+            importer.addBulkImportImportFileOrDir(file, site = "PokerStars")
+        importer.runImport()
+        c = importer.database.get_cursor()
+        rows = []
+        for q in ("SELECT siteHandNo, gametypeId, seats, street1Pot FROM Hands ORDER BY siteHandNo"
+                 ,"SELECT h.siteHandNo, p.name, hp.winnings, hp.street0VPI FROM HandsPlayers hp"
+                  " JOIN Hands h ON h.id = hp.handId JOIN Players p ON p.id = hp.playerId"
+                  " ORDER BY h.siteHandNo, p.name"
+                 ,"SELECT h.siteHandNo, ha.actionNo, ha.actionId, ha.amount FROM HandsActions ha"
+                  " JOIN Hands h ON h.id = ha.handId ORDER BY h.siteHandNo, ha.actionNo"):
+            c.execute(q)
+            rows.append(c.fetchall())
+        importer.closeDBs()
+        return rows
+    finally:
+        shutil.rmtree(dir)
+
+def testParsingProcessesMatchSerialImport():
+    files = [MICROGRIND, STARS + "NLHE-6max-USD-0.05-0.10-200912.Allin-pre.txt"]
+    serial = bulk_import(files)
+    assert len(serial[0]) == 97
+    assert bulk_import(files, parseProcesses = 2, handBatchSize = 10) == serial
+
+def testAutoImportResumesAfterRestart():
+    dir = tempfile.mkdtemp()
+    try:
+        config = new_config(dir)
+        Database.Database(config).recreate_tables()
+        filter = config.hhcs['PokerStars'].converter
+        hhdir = os.path.join(dir, 'hh')
+        os.mkdir(hhdir)
+        path = os.path.join(hhdir, 'hands.txt')
+        text = open(MICROGRIND, 'rb').read()
+        half = text.index("PokerStars Game #", len(text) / 2)
+        open(path, 'wb').write(text[:half])
+
+        importer = new_importer(config)
+        importer.addImportDirectory(hhdir, True, 'PokerStars', filter)
+        importer.runUpdated()       # only notes the new file
+        importer.runUpdated()
+        importer.closeDBs()
+
+        # a new importer carries on where the last one stopped
+        open(path, 'ab').write(text[half:])
+        importer = new_importer(config)
+        importer.addImportDirectory(hhdir, True, 'PokerStars', filter)
+        assert importer.pos_in_file[path] == half
+        importer.runUpdated()
+        db = importer.database
+        assert count(db, "SELECT count(*) FROM Hands") == (96,)
+        assert count(db, "SELECT sum(stored), sum(dups), max(bytesRead) FROM Files") == (96, 0, len(text))
+        importer.closeDBs()
+    finally:
+        shutil.rmtree(dir)
+
+def testWriterThreadsMatchSerialImport():
+    files = [MICROGRIND, STARS + "NLHE-6max-USD-0.05-0.10-200912.Allin-pre.txt"]
+    serial = bulk_import(files)
+    # SQLite gets one writer thread, fed through writeq like the others
+    assert bulk_import(files, threads = 2, handBatchSize = 10) == serial
+    assert bulk_import(files, threads = 2, parseProcesses = 2, handBatchSize = 10) == serial
+
+def testSQLiteBulkImportRollback():
+    dir = tempfile.mkdtemp()
+    try:
+        config = new_config(dir)
+        Database.Database(config).recreate_tables()
+        importer = new_importer(config)
+        db = importer.database
+        db.prepareBulkImport()
+        importer.addBulkImportImportFileOrDir(MICROGRIND, site = "PokerStars")
+        assert importer.importFiles(None)[:2] == (96, 0)
+        db.refreshDuplicateIndex()
+        db.commit()     # the transaction stays open, the index takes in the hands all the same
+        assert not db.dupIndex.pending
+        assert len(db.dupIndex.hashes) + len(db.dupIndex.recent) == 96
+
+        db.rollback()
+        assert db.dupIndex is None
+        assert count(db, "SELECT count(*) FROM Hands") == (0,)
+        importer.clearFileList()
+        importer.addBulkImportImportFileOrDir(MICROGRIND, site = "PokerStars")
+        assert importer.importFiles(None)[:2] == (96, 0)
+        db.afterBulkImport()
+        assert count(db, "SELECT count(*) FROM Hands") == (96,)
+        importer.closeDBs()
+    finally:
+        shutil.rmtree(dir)
+
+def twoImporters(threads):
+    """Hands the other importer commits from the id block it reserved first are below
+       the ids this importer's duplicate index has read, they are duplicates all the same"""
+    dir = tempfile.mkdtemp()
+    try:
+        config = new_config(dir)
+        Database.Database(config).recreate_tables()
+        a = new_importer(config)
+        b = new_importer(config, threads = threads)
+        def run(importer, *files):
+            importer.clearFileList()
+            for file in files:
+                importer.addBulkImportImportFileOrDir(file, site = "PokerStars")
+            return importer.runImport()[:4]
+        sixmax = STARS + "NLHE-6max-USD-0.05-0.10-200911.txt"
+        assert run(a, STARS + "NLHE-FR-USD-0.01-0.02-201004.4betPF.txt") == (1, 0, 0, 0)
+        assert run(b, MICROGRIND, "regression-test-files/cash/Stars/Draw/3-Draw-Limit-USD-0.10-0.20-200911.txt")[1:] == (0, 0, 0)
+        (stored, dups, partial, errors) = run(a, sixmax)
+        assert stored > 0 and (dups, errors) == (0, 0)
+        assert run(b, sixmax) == (0, stored, 0, 0)
+        for importer in (a, b):
+            importer.closeDBs()
+    finally:
+        shutil.rmtree(dir)
+
+def testTwoImporters():
+    twoImporters(0)
+
+def testTwoImportersWithWriterThread():
+    twoImporters(1)
+
+def testRederiveHandsPlayers():
+    dir = tempfile.mkdtemp()
+    try:
+        config = new_config(dir)
+        config.raw_hands.save = "all"
+        Database.Database(config).recreate_tables()
+        importer = new_importer(config)
+        importer.addBulkImportImportFileOrDir(MICROGRIND, site = "PokerStars")
+        importer.runImport()
+        db = importer.database
+        query = "SELECT sum(street0VPI), sum(street0Aggr), sum(winnings) FROM HandsPlayers"
+        stats = count(db, query)
+        db.get_cursor().execute("UPDATE HandsPlayers SET street0VPI = 0, street0Aggr = 0, winnings = 0")
+        db.commit()
+
+        # tourneysPlayersId is a column but DerivedStats calls it tourneysPlayersIds
+        for columns in (['street0VPI', 'tourneysPlayersId'], ['street0VPI', 'noSuchColumn']):
+            try:
+                importer.rederiveHandsPlayers(columns)
+                assert False, columns
+            except Exceptions.FpdbError:
+                pass
+        assert count(db, query) == (0, 0, 0)
+
+        assert importer.rederiveHandsPlayers(['street0VPI', 'winnings']) == (96, 0)
+        assert count(db, query) == (stats[0], 0, stats[2])
+        importer.closeDBs()
+    finally:
+        shutil.rmtree(dir)
+
+def hudCacheInHalves(upsert):
+    """HudCache after importing MICROGRIND in two halves, the second half adds to the rows
+       of the first"""
+    dir = tempfile.mkdtemp()
+    try:
+        config = new_config(dir)
+        Database.Database(config).recreate_tables()
+        importer = new_importer(config)
+        db = importer.database
+        db.use_date_in_hudcache = False     # day styleKeys move with the clock's tz offset
+        if not upsert:
+            # the path of mysql cash games and older postgres and sqlite
+            db.hudcache_upsert = lambda: False
+        text = open(MICROGRIND, 'rb').read()
+        half = text.index("PokerStars Game #", len(text) / 2)
+        for (name, part) in (('first.txt', text[:half]), ('second.txt', text[half:])):
+            path = os.path.join(dir, name)
+            open(path, 'wb').write(part)
+            importer.clearFileList()
+            importer.addBulkImportImportFileOrDir(path, site = "PokerStars")
+            importer.runImport()
+        assert count(db, "SELECT sum(HDs) FROM HudCache") == count(db, "SELECT count(*) FROM HandsPlayers")
+        c = db.get_cursor()
+        c.execute("SELECT gametypeId, playerId, activeSeats, position, tourneyTypeId, styleKey"
+                  ", HDs, street0VPI, totalProfit FROM HudCache ORDER BY 1, 2, 3, 4, 5, 6")
+        rows = c.fetchall()
+        importer.closeDBs()
+        return rows
+    finally:
+        shutil.rmtree(dir)
+
+def testHudCacheUpdateMatchesUpsert():
+    rows = hudCacheInHalves(True)
+    assert hudCacheInHalves(False) == rows
+
+def testHudStatCacheLoadedDuringImport():
+    """The HUD's stat cache is loaded while the importer has stored hands it has not
+       committed yet, their importTimes are older than the load"""
+    dir = tempfile.mkdtemp()
+    try:
+        config = new_config(dir)
+        Database.Database(config).recreate_tables()
+        importer = new_importer(config)
+        db = importer.database
+        text = open(MICROGRIND, 'rb').read()
+        half = text.index("PokerStars Game #", len(text) / 2)
+        for (name, part) in (('first.txt', text[:half]), ('second.txt', text[half:])):
+            open(os.path.join(dir, name), 'wb').write(part)
+        importer.addBulkImportImportFileOrDir(os.path.join(dir, 'first.txt'), site = "PokerStars")
+        importer.runImport()
+        (first,) = count(db, "SELECT max(id) FROM Hands")
+
+        importer.clearFileList()
+        importer.addBulkImportImportFileOrDir(os.path.join(dir, 'second.txt'), site = "PokerStars")
+        db.prepareBulkImport()      # one transaction, committed by afterBulkImport
+        importer.importFiles(None)
+
+        hud = Database.Database(config)
+        hud_params = dict(config.get_hud_ui_parameters(), hud_style = 'A', h_hud_style = 'A')
+        hud.init_hud_stat_vars(hud_params['hud_days'], hud_params['h_hud_days'])
+        cache = Database.HudStatCache()
+        hands = [(hand, 'ring', hud_params, -1, 9) for hand in range(1, first + 1)]
+        hud.get_stats_from_hands(hands, cache)
+        assert count(hud, "SELECT count(*) FROM Hands") == (first,)
+
+        db.afterBulkImport()
+        # a hand with only players the cache has, sent with the others of the second half
+        c = db.get_cursor()
+        c.execute("SELECT handId, playerId FROM HandsPlayers")
+        players = {}
+        for (hand, player) in c.fetchall():
+            players.setdefault(hand, set()).add(player)
+        cached = set().union(*[players[hand] for hand in range(1, first + 1)])
+        last = max([hand for hand in players if players[hand] <= cached])
+        assert last > first
+        hand = [(last, 'ring', hud_params, -1, 9)]
+        others = [h for h in players if h > first and h != last]
+        stats = hud.get_stats_from_hands(hand, cache, others)
+        assert cache.hits == 1
+        # bigblind only counts for the hand that created a HudCache row, see get_stats_deltas()
+        fresh = hud.get_stats_from_hands(hand)
+        for stat_dict in (stats[last], fresh[last]):
+            for t_dict in stat_dict.itervalues():
+                del t_dict['bigblind']
+        assert stats == fresh
+        importer.closeDBs()
+    finally:
+        shutil.rmtree(dir)
+
+def testHudCacheRebuildResumesItsSlice():
+    dir = tempfile.mkdtemp()
+    try:
+        config = new_config(dir)
+        Database.Database(config).recreate_tables()
+        importer = new_importer(config)
+        for file in (STARS + "NLHE-6max-USD-0.05-0.10-200912.Allin-pre.txt", MICROGRIND):
+            importer.addBulkImportImportFileOrDir(file, site = "PokerStars")
+        importer.runImport()
+        db = importer.database
+        db.rebuild_hudcache()
+        query = "SELECT gametypeId, playerId, position, styleKey, HDs FROM HudCache ORDER BY 1, 2, 3, 4"
+        c = db.get_cursor()
+        c.execute(query)
+        rows = c.fetchall()
+        (gametype,) = count(db, "SELECT DISTINCT gametypeId FROM Hands WHERE startTime > '2010-05-01'")
+
+        # a rebuild of the microgrind's gametype with the hud starting after its hands,
+        # stopped after the first chunk, the one of the december hands
+        db.HUDCACHE_REBUILD_DAYS = 100
+        commits = []
+        def commit():
+            commits.append(1)
+            if len(commits) == 2:
+                raise Exception("interrupted")
+            Database.Database.commit(db)
+        db.commit = commit
+        db.rebuild_hudcache('2010-06-01', '2010-06-01', gametypes = [gametype])
+        del db.commit
+        (day, slice) = db.get_hudcache_resume()
+        assert day < '2010-05-06' and slice == ('2010-06-01', '2010-06-01', None, None, [gametype])
+        c.execute(query)
+        assert c.fetchall() == rows
+
+        # the resume drops the microgrind's rows and keeps the others
+        db.rebuild_hudcache(resume = True)
+        assert db.get_hudcache_resume() is None
+        c.execute(query)
+        assert c.fetchall() == [r for r in rows if r[0] != gametype]
+        importer.closeDBs()
+    finally:
+        shutil.rmtree(dir)
+
+def testImportRatesDecideDropIndexes():
+    dir = tempfile.mkdtemp()
+    try:
+        config = new_config(dir)
+        Database.Database(config).recreate_tables()
+        for (file, drop) in ((MICROGRIND, "drop"), (STARS + "NLHE-6max-USD-0.05-0.10-200911.txt", "don't drop")):
+            importer = new_importer(config, dropIndexes = drop)
+            importer.database.MIN_RATE_HANDS = 1
+            importer.addBulkImportImportFileOrDir(file, site = "PokerStars")
+            importer.runImport()
+            importer.closeDBs()
+
+        # the speeds outlive the connections that measured them
+        db = Database.Database(config)
+        rates = db.getImportRates()
+        assert 'import' in rates and 'import.bulk' in rates and 'HandsPlayers.playerId' in rates
+        assert db.estimateAfterBulkImport(hands = 1000) > 0
+
+        importer = new_importer(config)
+        importer.addBulkImportImportFileOrDir(STARS + "NLHE-FR-USD-0.01-0.02-201004.4betPF.txt", site = "PokerStars")
+        db = importer.database
+        db.setImportRate('import', 0.001)       # indexes slow storing to a crawl
+        assert importer.calculate_auto_indexes(db) == "drop"
+        db.setImportRate('import', rates['import.bulk'])
+        assert importer.calculate_auto_indexes(db) == "don't drop"
+        importer.closeDBs()
+    finally:
+        shutil.rmtree(dir)
@@ -18,6 +18,9 @@
 import PokerStarsToFpdb
 from Hand import *
 import py
+import os
+import shutil
+import tempfile
 
 import Configuration
 import Database
@@ -197,3 +200,33 @@ def testDrawImport():
 
     # Should actually do some testing here
     assert 1 == 1
+
+def testStreamedHandsMatchList():
+    # the streaming splitter must yield exactly what allHandsAsList() returns,
+    # even when hands and splitters are cut by small reads
+    for path in ("regression-test-files/cash/Stars/Flop/NLHE-6max-USD-0.05-0.10-200911.txt",
+                 "regression-test-files/cash/Stars/Stud/Razz-USD-0.04-0.08-200911.txt"):
+        hhc = PokerStarsToFpdb.PokerStars(config, in_path = path, autostart=False)
+        expected = hhc.allHandsAsList()
+        for size in (7, 100, 4096):
+            hhc = PokerStarsToFpdb.PokerStars(config, in_path = path, autostart=False)
+            hhc.STREAM_CHUNK_SIZE = size
+            assert list(hhc.allHandsAsGenerator()) == expected
+
+def testCodecChangesPartWay():
+    # utf8 until the first byte it can't decode, the rest of the file is read as cp1252
+    dir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(dir, 'hands.txt')
+        for data in ("abc " * 5000 + u"Jos\xe9".encode('utf8') + " def" * 100,
+                     "abc " * 5000 + u"Jos\xe9".encode('cp1252') + " def" * 100):
+            open(path, 'wb').write(data)
+            hhc = PokerStarsToFpdb.PokerStars(config, in_path = path, autostart=False)
+            hhc.STREAM_CHUNK_SIZE = 100
+            chunks = hhc.readFileChunks()
+            first = chunks.next()
+            assert hhc.index == 100    # not decoded ahead of the reads
+            assert first + u"".join(chunks) == "abc " * 5000 + u"Jos\xe9" + " def" * 100
+            assert hhc.index == len(data)
+    finally:
+        shutil.rmtree(dir)